@@ -1,14 +1,301 @@
+# pylint: disable=too-many-lines
 import sys
 
+from typing import TYPE_CHECKING, Callable
+
 import click
 
-from .src.carina.db import load_models as load_carina_models
-from .src.generator import generate_account_holders_and_rewards, generate_retailer_base_config
-from .src.polaris.db import load_models as load_polaris_models
-from .src.vela.db import load_models as load_vela_models
+from .src.enums import FetchTypesEnum, LoyaltyTypes, RegenerableTables, ServerSideTables
+from .src.sharding import Shard
+from .src.stages import add_stage_listener, stage
+
+# sqlalchemy, psycopg2, faker and the reflected models are only imported by the commands that use them,
+# so that --help and argument validation stay fast. CI fails if any of them is imported by this module.
+if TYPE_CHECKING:
+    from sqlalchemy.orm import Session
+
+    from .src.instrumentation import QueryCounter
+    from .src.profiling import StageProfiler
+    from .src.psycopg_backend import PsycopgBulkWriter
+
+
+def _parse_shard(ctx: click.Context, param: click.Parameter, value: str) -> Shard:
+    try:
+        return Shard.parse(value)
+    except ValueError as ex:
+        raise click.BadParameter(str(ex), ctx=ctx, param=param) from ex
+
+
+class _DefaultCommandGroup(click.Group):
+    # keeps "account-holders-generator -n 10 ..." working by routing unknown arguments to the generate command
+    def parse_args(self, ctx: click.Context, args: list[str]) -> list[str]:
+        if not args or (args[0] not in self.commands and args[0] not in ctx.help_option_names):
+            args.insert(0, "generate")
+        return super().parse_args(ctx, args)
+
+
+DB_OPTIONS = [
+    click.option(
+        "--host",
+        "db_host",
+        default="localhost",
+        help="database port.",
+    ),
+    click.option(
+        "--port",
+        "db_port",
+        default="5432",
+        help="database port.",
+    ),
+    click.option(
+        "--user",
+        "db_user",
+        default="postgres",
+        help="database user.",
+    ),
+    click.option(
+        "--password",
+        "db_pass",
+        default="",
+        help="database password.",
+    ),
+    click.option(
+        "--polaris-db-name",
+        "polaris_db_name",
+        default="polaris",
+        help="polaris database name.",
+    ),
+    click.option(
+        "--vela-db-name",
+        "vela_db_name",
+        default="vela",
+        help="vela database name.",
+    ),
+    click.option(
+        "--carina-db-name",
+        "carina_db_name",
+        default="carina",
+        help="carina database name.",
+    ),
+]
+
+
+def db_options(fn: Callable) -> Callable:
+    for option in reversed(DB_OPTIONS):
+        fn = option(fn)
+    return fn
+
+
+def _postgres_address(db_host: str, db_port: str, db_user: str, db_pass: str) -> str:
+    return "%s:%s@%s:%s/" % (
+        db_user,
+        db_pass,
+        db_host,
+        db_port,
+    )
+
+
+def _load_db_sessions(
+    db_host: str,
+    db_port: str,
+    db_user: str,
+    db_pass: str,
+    polaris_db_name: str,
+    vela_db_name: str,
+    carina_db_name: str,
+    pooled: bool = False,
+) -> tuple["Session", "Session", "Session"]:
+    db_uri = "postgresql+psycopg2://" + _postgres_address(db_host, db_port, db_user, db_pass)
+
+    from .src.carina.db import load_models as load_carina_models
+    from .src.polaris.db import load_models as load_polaris_models
+    from .src.vela.db import load_models as load_vela_models
+
+    carina_db_session = load_carina_models(db_uri + carina_db_name, pooled)
+    polaris_db_session = load_polaris_models(db_uri + polaris_db_name, pooled)
+    vela_db_session = load_vela_models(db_uri + vela_db_name, pooled)
+    return carina_db_session, polaris_db_session, vela_db_session
+
+
+def _psycopg_bulk_writer(
+    db_host: str, db_port: str, db_user: str, db_pass: str, polaris_db_name: str, carina_db_name: str
+) -> "PsycopgBulkWriter":
+    from .src.psycopg_backend import PsycopgBulkWriter
+
+    address = _postgres_address(db_host, db_port, db_user, db_pass)
+    return PsycopgBulkWriter(
+        {"polaris": "postgresql://" + address + polaris_db_name, "carina": "postgresql://" + address + carina_db_name}
+    )
+
+
+def _configure_generated_values(seed: int | None, history_months: int | None = None) -> None:
+    from .src.pools import get_fake
+    from .src.timestamps import get_timestamp_generator
+
+    if history_months is not None:
+        if history_months < 1:
+            click.echo("--history-months must be at least 1.")
+            sys.exit(-1)
+        get_timestamp_generator().profile.history_months = history_months
+
+    if seed is not None:
+        import random
+
+        random.seed(seed)
+        get_fake().seed_instance(seed)
+        get_timestamp_generator().seed(seed)
+
+
+def _query_counter(
+    query_stats: bool,
+    max_queries_per_batch: int | None,
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    vela_db_session: "Session",
+) -> "QueryCounter | None":
+    if not query_stats and max_queries_per_batch is None:
+        return None
+
+    from .src.instrumentation import QueryCounter
+
+    query_counter = QueryCounter(max_queries_per_batch)
+    query_counter.attach("carina", carina_db_session.get_bind())
+    query_counter.attach("polaris", polaris_db_session.get_bind())
+    query_counter.attach("vela", vela_db_session.get_bind())
+    add_stage_listener(query_counter)
+    return query_counter
+
+
+def _stage_profiler(profile_dir: str | None) -> "StageProfiler | None":
+    if not profile_dir:
+        return None
+
+    from .src.profiling import StageProfiler
+
+    profiler = StageProfiler(profile_dir)
+    add_stage_listener(profiler)
+    return profiler
+
+
+def _plan_and_exit(
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    vela_db_session: "Session",
+    account_holders_to_create: int,
+    retailer: str,
+    campaign: str,
+    max_val: int,
+    unallocated_rewards_to_create: int,
+    refund_window: int,
+    tx_history: bool,
+    loyalty_type: str,
+    shard: Shard,
+    allocate_from_pool: bool,
+) -> None:
+    from .src.planner import plan_generation
+
+    try:
+        plan_generation(
+            carina_db_session,
+            polaris_db_session,
+            vela_db_session,
+            account_holders_to_create,
+            retailer,
+            campaign,
+            max_val,
+            unallocated_rewards_to_create,
+            refund_window,
+            tx_history,
+            loyalty_type,
+            shard,
+            allocate_from_pool,
+        )
+    finally:
+        carina_db_session.close()
+        polaris_db_session.close()
+        vela_db_session.close()
+    sys.exit(0)
+
+
+def _check_generate_values(max_val: int, account_holders_to_create: int) -> None:
+    if max_val < 0:
+        click.echo("maximum balance value must be an integer greater than 1.")
+        sys.exit(-1)
+
+    if not 1000000000 > account_holders_to_create > 0:
+        click.echo("the number of account holders to create must be between 1 and 1,000,000,000.")
+        sys.exit(-1)
+
 
+def _maintain_generated_tables(
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    refund_window: int,
+    tx_history: bool,
+    loyalty_type: str,
+    vacuum: bool,
+    maintenance_jobs: int,
+) -> None:
+    from .src.maintenance import analyze_generated_tables, echo_table_stats, generated_tables
+
+    click.echo("\nAnalyzing generated tables.")
+    with stage("maintenance"):
+        tables_stats = analyze_generated_tables(
+            carina_db_session,
+            polaris_db_session,
+            generated_tables(refund_window, tx_history, loyalty_type),
+            vacuum,
+            maintenance_jobs,
+        )
+    echo_table_stats(tables_stats)
 
-@click.command()
+
+def _check_load_options(
+    staging: bool,
+    load_jobs: int,
+    commit_every: int,
+    server_side_tables: tuple[str, ...],
+    driver: str,
+    allocate_from_pool: bool = False,
+) -> None:
+    if driver == "psycopg" and (staging or load_jobs > 1 or commit_every > 1):
+        click.echo("--driver psycopg cannot be combined with --staging, --load-jobs or --commit-every.")
+        sys.exit(-1)
+
+    if load_jobs < 1:
+        click.echo("--load-jobs must be at least 1.")
+        sys.exit(-1)
+
+    if commit_every < 1:
+        click.echo("--commit-every must be at least 1.")
+        sys.exit(-1)
+
+    if commit_every > 1 and (staging or load_jobs > 1):
+        click.echo("--commit-every cannot be combined with --staging or --load-jobs, they commit on their own.")
+        sys.exit(-1)
+
+    if staging and load_jobs > 1:
+        click.echo(
+            "--staging already loads every table in a single transaction and cannot be combined with --load-jobs."
+        )
+        sys.exit(-1)
+
+    if staging and set(server_side_tables) - {ServerSideTables.UNALLOCATED_REWARD.value}:
+        click.echo("--staging can only be combined with --server-side unallocated_reward.")
+        sys.exit(-1)
+
+    if allocate_from_pool and (driver == "psycopg" or load_jobs > 1):
+        # the claims are made on the carina session, which these loads never commit
+        click.echo("--allocate-from-pool cannot be combined with --driver psycopg or --load-jobs.")
+        sys.exit(-1)
+
+
+@click.group(cls=_DefaultCommandGroup)
+def main() -> None:
+    pass
+
+
+@main.command(help="generate account holders and rewards, this is the default command.")
 @click.option(
     "-n",
     "account_holders_to_create",
@@ -47,48 +334,7 @@ from .src.vela.db import load_models as load_vela_models
     default="10percentoff",
     help="reward_slug to use in case of a --bootstrap-new-retailer.",
 )
-@click.option(
-    "--host",
-    "db_host",
-    default="localhost",
-    help="database port.",
-)
-@click.option(
-    "--port",
-    "db_port",
-    default="5432",
-    help="database port.",
-)
-@click.option(
-    "--user",
-    "db_user",
-    default="postgres",
-    help="database user.",
-)
-@click.option(
-    "--password",
-    "db_pass",
-    default="",
-    help="database password.",
-)
-@click.option(
-    "--polaris-db-name",
-    "polaris_db_name",
-    default="polaris",
-    help="polaris database name.",
-)
-@click.option(
-    "--vela-db-name",
-    "vela_db_name",
-    default="vela",
-    help="vela database name.",
-)
-@click.option(
-    "--carina-db-name",
-    "carina_db_name",
-    default="carina",
-    help="carina database name.",
-)
+@db_options
 @click.option(
     "--unallocated-rewards",
     "unallocated_rewards_to_create",
@@ -120,7 +366,158 @@ from .src.vela.db import load_models as load_vela_models
     default=True,
     help="Sets up transaction history for account holders",
 )
-def main(
+@click.option(
+    "--server-side",
+    "server_side_tables",
+    multiple=True,
+    type=click.Choice([table.value for table in ServerSideTables]),
+    help="generate this table in the database with INSERT ... SELECT instead of in python, can be repeated.",
+)
+@click.option(
+    "--shard",
+    "shard",
+    default="1/1",
+    callback=_parse_shard,
+    help=(
+        "k/N, generate only the k-th of N disjoint slices of account holders and unallocated rewards. "
+        "Retailer bootstrap is done once, by the first shard to find the retailer missing, the others reuse it."
+    ),
+)
+@click.option(
+    "--staging/--no-staging",
+    "staging",
+    default=False,
+    help=(
+        "COPY account holder tables into unlogged staging tables and move them into Polaris in a single "
+        "transaction at the end of the run."
+    ),
+)
+@click.option(
+    "--analyze/--no-analyze",
+    "analyze",
+    default=True,
+    help="ANALYZE the generated Polaris and Carina tables once loaded and report their sizes.",
+)
+@click.option(
+    "--vacuum/--no-vacuum",
+    "vacuum",
+    default=False,
+    help="run VACUUM ANALYZE instead of ANALYZE after the load.",
+)
+@click.option(
+    "--maintenance-jobs",
+    "maintenance_jobs",
+    default=4,
+    help="number of tables analyzed in parallel.",
+)
+@click.option(
+    "--profile",
+    "profile_dir",
+    default=None,
+    type=click.Path(file_okay=False),
+    help="cProfile each generation stage and write one .pstats file per stage into this directory.",
+)
+@click.option(
+    "--query-stats/--no-query-stats",
+    "query_stats",
+    default=False,
+    help="count SQL statements and round trips per database and stage and report them at the end of the run.",
+)
+@click.option(
+    "--max-queries-per-batch",
+    "max_queries_per_batch",
+    default=None,
+    type=int,
+    help="fail the run if a single batch issues more SQL statements than this across all databases.",
+)
+@click.option(
+    "--pool-file",
+    "pool_file",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="sample profile data from a file written by build-pools instead of running faker for every row.",
+)
+@click.option(
+    "--history-months",
+    "history_months",
+    default=6,
+    help="months of history issue and transaction dates are spread over, following a daily seasonality.",
+)
+@click.option(
+    "--seed",
+    default=None,
+    type=int,
+    help="seed the generated values so runs write the same data, except for ids, tokens and reward codes.",
+)
+@click.option(
+    "--load-jobs",
+    "load_jobs",
+    default=1,
+    help=(
+        "write the tables of each batch in parallel over this many connections per database, account_holder is "
+        "committed first and every other table in its own transaction."
+    ),
+)
+@click.option(
+    "--commit-every",
+    "commit_every",
+    default=1,
+    help=(
+        "commit every K batches instead of after each one. A batch failing with a transient error is retried from a "
+        "savepoint and a lost connection retries the K batches, both with exponential backoff."
+    ),
+)
+@click.option(
+    "--driver",
+    "driver",
+    type=click.Choice(["psycopg2", "psycopg"]),
+    default="psycopg2",
+    help=(
+        "write the generated batches with psycopg 3 binary COPY over pooled connections instead of psycopg2, "
+        "needs psycopg[binary,pool] to be installed."
+    ),
+)
+@click.option(
+    "--max-replication-lag",
+    "max_replication_lag",
+    default=None,
+    type=float,
+    help="seconds of replica replay lag above which batches are shrunk and then paused.",
+)
+@click.option(
+    "--max-commit-latency",
+    "max_commit_latency",
+    default=None,
+    type=float,
+    help="milliseconds a probe commit may take to flush, network round trip excluded, before batches are shrunk.",
+)
+@click.option(
+    "--max-waiting-sessions",
+    "max_waiting_sessions",
+    default=None,
+    type=int,
+    help="sessions waiting on locks or IO above which batches are shrunk and then paused.",
+)
+@click.option(
+    "--allocate-from-pool/--no-allocate-from-pool",
+    "allocate_from_pool",
+    default=False,
+    help=(
+        "claim the rewards of account holders from the unallocated carina rewards instead of creating new ones, "
+        "the pool is created with the rewards to claim on top of --unallocated-rewards."
+    ),
+)
+@click.option(
+    "--plan",
+    "plan",
+    is_flag=True,
+    default=False,
+    help=(
+        "only print the rows, disk size and duration this run is expected to take, the duration is measured with "
+        "a calibration batch that is rolled back."
+    ),
+)
+def generate(
     account_holders_to_create: int,
     retailer: str,
     max_val: int,
@@ -139,26 +536,79 @@ def main(
     fetch_type: str,
     tx_history: bool,
     loyalty_type: str,
+    server_side_tables: tuple[str, ...],
+    shard: Shard,
+    staging: bool,
+    analyze: bool,
+    vacuum: bool,
+    maintenance_jobs: int,
+    profile_dir: str | None,
+    query_stats: bool,
+    max_queries_per_batch: int | None,
+    pool_file: str | None,
+    history_months: int,
+    seed: int | None,
+    load_jobs: int,
+    commit_every: int,
+    driver: str,
+    max_replication_lag: float | None,
+    max_commit_latency: float | None,
+    max_waiting_sessions: int | None,
+    allocate_from_pool: bool,
+    plan: bool,
 ) -> None:
 
-    if max_val < 0:
-        click.echo("maximum balance value must be an integer greater than 1.")
-        sys.exit(-1)
+    _check_generate_values(max_val, account_holders_to_create)
+    _check_load_options(staging, load_jobs, commit_every, server_side_tables, driver, allocate_from_pool)
+    _configure_generated_values(seed, history_months)
 
-    if not 1000000000 > account_holders_to_create > 0:
-        click.echo("the number of account holders to create must be between 1 and 1,000,000,000.")
-        sys.exit(-1)
+    from .src.carina.crud import RewardPoolExhausted
+    from .src.generator import generate_account_holders_and_rewards, generate_retailer_base_config
+    from .src.governor import GovernorLimits
+    from .src.instrumentation import QueryBudgetExceeded
+    from .src.pools import FakeDataPools
 
-    db_uri = "postgresql+psycopg2://%s:%s@%s:%s/" % (
-        db_user,
-        db_pass,
-        db_host,
-        db_port,
+    fake_data_pools = FakeDataPools(pool_file) if pool_file else None
+
+    profiler = _stage_profiler(profile_dir)
+
+    with stage("setup_lookups"):
+        carina_db_session, polaris_db_session, vela_db_session = _load_db_sessions(
+            db_host,
+            db_port,
+            db_user,
+            db_pass,
+            polaris_db_name,
+            vela_db_name,
+            carina_db_name,
+            pooled=driver == "psycopg",
+        )
+
+    if plan:
+        _plan_and_exit(
+            carina_db_session,
+            polaris_db_session,
+            vela_db_session,
+            account_holders_to_create,
+            retailer,
+            campaign,
+            max_val,
+            unallocated_rewards_to_create,
+            refund_window,
+            tx_history,
+            loyalty_type,
+            shard,
+            allocate_from_pool,
+        )
+
+    query_counter = _query_counter(
+        query_stats, max_queries_per_batch, carina_db_session, polaris_db_session, vela_db_session
     )
 
-    carina_db_session = load_carina_models(db_uri + carina_db_name)
-    polaris_db_session = load_polaris_models(db_uri + polaris_db_name)
-    vela_db_session = load_vela_models(db_uri + vela_db_name)
+    bulk_writer = None
+    if driver == "psycopg":
+        bulk_writer = _psycopg_bulk_writer(db_host, db_port, db_user, db_pass, polaris_db_name, carina_db_name)
+
     try:
         if setup_retailer is True:
             generate_retailer_base_config(
@@ -171,6 +621,7 @@ def main(
                 refund_window,
                 fetch_type,
                 loyalty_type,
+                shard,
             )
 
         generate_account_holders_and_rewards(
@@ -185,15 +636,559 @@ def main(
             refund_window,
             tx_history,
             loyalty_type,
+            frozenset(ServerSideTables(table) for table in server_side_tables),
+            shard,
+            staging,
+            fake_data_pools,
+            load_jobs,
+            commit_every=commit_every,
+            bulk_writer=bulk_writer,
+            governor_limits=GovernorLimits(max_replication_lag, max_commit_latency, max_waiting_sessions),
+            allocate_from_pool=allocate_from_pool,
         )
+        if analyze or vacuum:
+            _maintain_generated_tables(
+                carina_db_session, polaris_db_session, refund_window, tx_history, loyalty_type, vacuum, maintenance_jobs
+            )
+    except (QueryBudgetExceeded, RewardPoolExhausted) as ex:
+        click.echo(f"\n{ex}")
+        sys.exit(-1)
     finally:
         carina_db_session.close()
         polaris_db_session.close()
         vela_db_session.close()
+        if bulk_writer:
+            bulk_writer.close()
+        if profiler:
+            profiler.dump()
+        if query_counter and query_stats:
+            query_counter.echo_report()
 
     click.echo("\naccount holders and rewards created.")
     sys.exit(0)
 
 
+@main.command(help="dump a retailer's generated rows into a binary COPY bundle.")
+@db_options
+@click.option("-r", "--retailer", required=True, help="retailer whose generated rows are snapshotted.")
+@click.option(
+    "-o",
+    "--output",
+    "bundle_dir",
+    required=True,
+    type=click.Path(file_okay=False),
+    help="directory the snapshot bundle and its manifest are written to.",
+)
+@click.option("-j", "--jobs", default=4, help="number of tables dumped in parallel.")
+def snapshot(
+    retailer: str,
+    bundle_dir: str,
+    jobs: int,
+    db_host: str,
+    db_port: str,
+    db_user: str,
+    db_pass: str,
+    polaris_db_name: str,
+    vela_db_name: str,
+    carina_db_name: str,
+) -> None:
+    from .src.snapshot import create_snapshot
+
+    carina_db_session, polaris_db_session, vela_db_session = _load_db_sessions(
+        db_host, db_port, db_user, db_pass, polaris_db_name, vela_db_name, carina_db_name
+    )
+    try:
+        manifest = create_snapshot(carina_db_session, polaris_db_session, vela_db_session, retailer, bundle_dir, jobs)
+    finally:
+        carina_db_session.close()
+        polaris_db_session.close()
+        vela_db_session.close()
+
+    for snapshot_table in manifest.tables:
+        click.echo(f"{snapshot_table.database}.{snapshot_table.table}: {snapshot_table.rows} rows.")
+    click.echo(f"\nsnapshot written to {bundle_dir}.")
+
+
+@main.command(help="reload a snapshot bundle, remapping account holder ids to the target sequences.")
+@db_options
+@click.option(
+    "-i",
+    "--input",
+    "bundle_dir",
+    required=True,
+    type=click.Path(exists=True, file_okay=False),
+    help="snapshot bundle directory to restore.",
+)
+@click.option("-r", "--retailer", default=None, help="restore into this retailer instead of the snapshotted one.")
+@click.option("-j", "--jobs", default=4, help="number of tables loaded in parallel.")
+def restore(
+    bundle_dir: str,
+    retailer: str | None,
+    jobs: int,
+    db_host: str,
+    db_port: str,
+    db_user: str,
+    db_pass: str,
+    polaris_db_name: str,
+    vela_db_name: str,
+    carina_db_name: str,
+) -> None:
+    from .src.snapshot import restore_snapshot
+
+    carina_db_session, polaris_db_session, vela_db_session = _load_db_sessions(
+        db_host, db_port, db_user, db_pass, polaris_db_name, vela_db_name, carina_db_name
+    )
+    try:
+        restore_snapshot(carina_db_session, polaris_db_session, vela_db_session, bundle_dir, retailer, jobs)
+    finally:
+        carina_db_session.close()
+        polaris_db_session.close()
+        vela_db_session.close()
+
+    click.echo("\nsnapshot restored.")
+
+
+@main.command("build-pools", help="write the fake profile data pools shared by generate --pool-file.")
+@click.option(
+    "-o",
+    "--output",
+    "pool_file",
+    required=True,
+    type=click.Path(dir_okay=False),
+    help="pool file to write, replaced atomically if it exists.",
+)
+@click.option("--size", default=100000, help="number of values in each pool.")
+@click.option("--seed", default=None, type=int, help="seed faker so the same pools are built every time.")
+def build_pools(pool_file: str, size: int, seed: int | None) -> None:
+    if size < 1:
+        click.echo("pool size must be greater than 0.")
+        sys.exit(-1)
+
+    from .src.pools import build_pool_file
+
+    for name, count in build_pool_file(pool_file, size, seed).items():
+        click.echo(f"{name}: {count} values.")
+    click.echo(f"\npools written to {pool_file}.")
+
+
+@main.command(help="run a local http service that keeps connections, models and fake data warm between jobs.")
+@db_options
+@click.option("--bind", "host", default="127.0.0.1", help="address the service listens on.")
+@click.option("--listen-port", "listen_port", default=8765, help="port the service listens on.")
+@click.option(
+    "--pool-file",
+    "pool_file",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="sample profile data from a file written by build-pools instead of running faker for every row.",
+)
+def serve(
+    host: str,
+    listen_port: int,
+    pool_file: str | None,
+    db_host: str,
+    db_port: str,
+    db_user: str,
+    db_pass: str,
+    polaris_db_name: str,
+    vela_db_name: str,
+    carina_db_name: str,
+) -> None:
+    from .src.pools import FakeDataPools
+    from .src.service import GeneratorService
+    from .src.service import serve as serve_jobs
+
+    carina_db_session, polaris_db_session, vela_db_session = _load_db_sessions(
+        db_host, db_port, db_user, db_pass, polaris_db_name, vela_db_name, carina_db_name, pooled=True
+    )
+    service = GeneratorService(
+        carina_db_session,
+        polaris_db_session,
+        vela_db_session,
+        FakeDataPools(pool_file) if pool_file else None,
+    )
+    try:
+        serve_jobs(service, host, listen_port)
+    finally:
+        carina_db_session.close()
+        polaris_db_session.close()
+        vela_db_session.close()
+
+
+@main.command("export-manifest", help="stream generated credentials and reward codes into sharded gzip ndjson files.")
+@db_options
+@click.option("-r", "--retailer", required=True, help="retailer whose generated account holders are exported.")
+@click.option(
+    "-o",
+    "--output",
+    "output_dir",
+    required=True,
+    type=click.Path(file_okay=False),
+    help="directory the manifest files and their index are written to.",
+)
+@click.option("--shards", default=1, help="number of files account holders are dealt into, one per load generator.")
+@click.option("--chunk-size", "chunk_size", default=10000, help="account holders fetched per server side cursor round.")
+def export_manifest(
+    retailer: str,
+    output_dir: str,
+    shards: int,
+    chunk_size: int,
+    db_host: str,
+    db_port: str,
+    db_user: str,
+    db_pass: str,
+    polaris_db_name: str,
+    vela_db_name: str,
+    carina_db_name: str,
+) -> None:
+    if shards < 1 or chunk_size < 1:
+        click.echo("--shards and --chunk-size must be at least 1.")
+        sys.exit(-1)
+
+    from .src.manifest import export_manifest as export_credentials_manifest
+
+    carina_db_session, polaris_db_session, vela_db_session = _load_db_sessions(
+        db_host, db_port, db_user, db_pass, polaris_db_name, vela_db_name, carina_db_name
+    )
+    try:
+        manifest = export_credentials_manifest(
+            carina_db_session, polaris_db_session, retailer, output_dir, shards, chunk_size
+        )
+    finally:
+        carina_db_session.close()
+        polaris_db_session.close()
+        vela_db_session.close()
+
+    click.echo(f"{manifest.account_holders} account holders and {manifest.rewards} rewards exported.")
+    if manifest.rewards_missing_in_carina:
+        click.echo(f"{manifest.rewards_missing_in_carina} rewards have no matching carina reward.")
+    click.echo(f"\nmanifest written to {output_dir}.")
+
+
+@main.command(help="compare allocated rewards in Polaris and Carina and report or repair the ones missing on a side.")
+@db_options
+@click.option("-r", "--retailer", required=True, help="retailer whose rewards are compared.")
+@click.option(
+    "--repair/--no-repair",
+    "repair",
+    default=False,
+    help="recreate Carina rewards missing for Polaris rewards and delete allocated Carina rewards with no owner.",
+)
+@click.option("--show", default=10, help="number of orphaned reward uuids listed for each side.")
+def verify(
+    retailer: str,
+    repair: bool,
+    show: int,
+    db_host: str,
+    db_port: str,
+    db_user: str,
+    db_pass: str,
+    polaris_db_name: str,
+    vela_db_name: str,
+    carina_db_name: str,
+) -> None:
+    from .src.reconcile import reconcile_rewards, repair_orphans
+
+    carina_db_session, polaris_db_session, vela_db_session = _load_db_sessions(
+        db_host, db_port, db_user, db_pass, polaris_db_name, vela_db_name, carina_db_name
+    )
+    try:
+        report = reconcile_rewards(carina_db_session, polaris_db_session, retailer)
+        click.echo(f"{report.buckets_compared} buckets compared, {report.buckets_differing} differ.")
+        for side, orphans in (("Polaris", report.polaris_only), ("Carina", report.carina_only)):
+            click.echo(f"{len(orphans)} rewards only found in {side}.")
+            for reward_uuid in orphans[:show]:
+                click.echo(f"  {reward_uuid}")
+
+        orphans_found = bool(report.polaris_only or report.carina_only)
+        if orphans_found and repair:
+            repair_orphans(carina_db_session, polaris_db_session, retailer, report)
+            click.echo("\norphaned rewards repaired.")
+    finally:
+        carina_db_session.close()
+        polaris_db_session.close()
+        vela_db_session.close()
+
+    sys.exit(-1 if orphans_found and not repair else 0)
+
+
+@main.command(help="write a steady stream of account holders, transactions and reward redemptions for soak tests.")
+@db_options
+@click.option("-r", "--retailer", default="test-retailer", help="retailer the rows are written for.")
+@click.option("-c", "--campaign", default="test-campaign-1", help="campaign used for generated balances.")
+@click.option("--max-val", default=100, help="maximum balance value, decimals will be added at random.")
+@click.option(
+    "--loyalty-type",
+    "loyalty_type",
+    type=click.Choice(["STAMPS", "ACCUMULATOR"]),
+    default="ACCUMULATOR",
+    help="Select campaign loyalty type.",
+)
+@click.option("--refund-window", "refund_window", default=0, help="creates pending rewards for new account holders.")
+@click.option(
+    "--account-holders-per-second",
+    "account_holders_rate",
+    default=1.0,
+    help="new account holders, with their profiles, balances and rewards, created per second.",
+)
+@click.option(
+    "--transactions-per-second",
+    "transactions_rate",
+    default=10.0,
+    help="transaction history rows appended to existing account holders per second.",
+)
+@click.option(
+    "--redemptions-per-second",
+    "redemptions_rate",
+    default=1.0,
+    help="issued rewards marked as redeemed per second.",
+)
+@click.option("--duration", default=None, type=float, help="seconds to run for, until interrupted when not set.")
+@click.option("--report-every", "report_every", default=10.0, help="seconds between write latency reports.")
+@click.option(
+    "--seed",
+    default=None,
+    type=int,
+    help="seed the generated values so runs write the same data, except for ids, tokens and reward codes.",
+)
+@click.option(
+    "--pool-file",
+    "pool_file",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="sample profile data from a file written by build-pools instead of running faker for every row.",
+)
+def trickle(
+    retailer: str,
+    campaign: str,
+    max_val: int,
+    loyalty_type: str,
+    refund_window: int,
+    account_holders_rate: float,
+    transactions_rate: float,
+    redemptions_rate: float,
+    duration: float | None,
+    report_every: float,
+    seed: int | None,
+    pool_file: str | None,
+    db_host: str,
+    db_port: str,
+    db_user: str,
+    db_pass: str,
+    polaris_db_name: str,
+    vela_db_name: str,
+    carina_db_name: str,
+) -> None:
+    rates = (account_holders_rate, transactions_rate, redemptions_rate)
+    if min(rates) < 0 or not any(rates):
+        click.echo("rates must not be negative and at least one of them must be greater than 0.")
+        sys.exit(-1)
+
+    if report_every <= 0:
+        click.echo("--report-every must be greater than 0.")
+        sys.exit(-1)
+
+    from .src.pools import FakeDataPools
+    from .src.trickle import trickle as run_trickle
+
+    _configure_generated_values(seed)
+
+    carina_db_session, polaris_db_session, vela_db_session = _load_db_sessions(
+        db_host, db_port, db_user, db_pass, polaris_db_name, vela_db_name, carina_db_name, pooled=True
+    )
+    try:
+        run_trickle(
+            carina_db_session,
+            polaris_db_session,
+            vela_db_session,
+            retailer,
+            campaign,
+            max_val,
+            refund_window,
+            loyalty_type,
+            account_holders_rate,
+            transactions_rate,
+            redemptions_rate,
+            duration,
+            report_every,
+            FakeDataPools(pool_file) if pool_file else None,
+        )
+    finally:
+        carina_db_session.close()
+        polaris_db_session.close()
+        vela_db_session.close()
+
+
+@main.command(help="rebuild only the selected child tables of a retailer's existing generated account holders.")
+@db_options
+@click.option("-r", "--retailer", default="test-retailer", help="retailer whose account holders are regenerated.")
+@click.option("-c", "--campaign", default="test-campaign-1", help="campaign used for generated balances.")
+@click.option(
+    "--tables",
+    "table_names",
+    multiple=True,
+    required=True,
+    type=click.Choice([table.value for table in RegenerableTables]),
+    help="table whose rows are deleted and generated again, can be repeated.",
+)
+@click.option("--max-val", default=100, help="maximum balance value, decimals will be added at random.")
+@click.option(
+    "--loyalty-type",
+    "loyalty_type",
+    type=click.Choice(["STAMPS", "ACCUMULATOR"]),
+    default="ACCUMULATOR",
+    help="Select campaign loyalty type.",
+)
+@click.option("--refund-window", "refund_window", default=0, help="refund window of regenerated pending rewards.")
+@click.option("--chunk-size", "chunk_size", default=1000, help="account holders whose rows are replaced per commit.")
+@click.option(
+    "--pool-file",
+    "pool_file",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="sample regenerated profiles from the fake data pools built by build-pools.",
+)
+def regenerate(
+    retailer: str,
+    campaign: str,
+    table_names: tuple[str, ...],
+    max_val: int,
+    loyalty_type: str,
+    refund_window: int,
+    chunk_size: int,
+    pool_file: str | None,
+    db_host: str,
+    db_port: str,
+    db_user: str,
+    db_pass: str,
+    polaris_db_name: str,
+    vela_db_name: str,
+    carina_db_name: str,
+) -> None:
+    if chunk_size < 1:
+        click.echo("--chunk-size must be at least 1.")
+        sys.exit(-1)
+
+    if RegenerableTables.PENDING_REWARD.value in table_names and (loyalty_type == "STAMPS" or refund_window <= 0):
+        click.echo("pending rewards are only generated for ACCUMULATOR campaigns with a --refund-window.")
+        sys.exit(-1)
+
+    from .src.pools import FakeDataPools
+    from .src.regenerate import regenerate_tables
+
+    # --tables may be repeated, each table is only rebuilt once
+    unique_table_names = list(dict.fromkeys(table_names))
+
+    carina_db_session, polaris_db_session, vela_db_session = _load_db_sessions(
+        db_host, db_port, db_user, db_pass, polaris_db_name, vela_db_name, carina_db_name
+    )
+    try:
+        account_holders = regenerate_tables(
+            carina_db_session,
+            polaris_db_session,
+            vela_db_session,
+            retailer,
+            campaign,
+            max_val,
+            refund_window,
+            loyalty_type,
+            unique_table_names,
+            chunk_size,
+            FakeDataPools(pool_file) if pool_file else None,
+        )
+    finally:
+        carina_db_session.close()
+        polaris_db_session.close()
+        vela_db_session.close()
+
+    click.echo(f"\n{', '.join(unique_table_names)} regenerated for {account_holders} account holders.")
+
+
+@main.command(help="set up many retailers, campaigns and reward configs with a few set based statements per database.")
+@db_options
+@click.option(
+    "--specs",
+    "specs_file",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help=(
+        "csv file with a header naming any of retailer_slug, campaign_slug, reward_slug, loyalty_type, "
+        "refund_window and fetch_type, missing values are taken from the options below."
+    ),
+)
+@click.option(
+    "--count",
+    default=None,
+    type=int,
+    help="set up this many numbered retailers, e.g. test-retailer-1, test-campaign-1 and 10percentoff-1.",
+)
+@click.option("-r", "--retailer", default="test-retailer", help="retailer slug, or slug prefix with --count.")
+@click.option("-c", "--campaign", default="test-campaign", help="campaign slug, or slug prefix with --count.")
+@click.option("--reward-slug", default="10percentoff", help="reward slug, or slug prefix with --count.")
+@click.option(
+    "--loyalty-type",
+    "loyalty_type",
+    type=click.Choice([loyalty_type.value for loyalty_type in LoyaltyTypes]),
+    default="ACCUMULATOR",
+    help="campaign loyalty type, BOTH sets up an ACCUMULATOR and a STAMPS retailer for each spec.",
+)
+@click.option("--refund-window", "refund_window", default=0, help="refund window of the reward rules.")
+@click.option(
+    "--fetch-type",
+    "fetch_type",
+    type=click.Choice([fetch_type.name for fetch_type in FetchTypesEnum]),
+    default="PRE_LOADED",
+    help="fetch type of the reward configs.",
+)
+def bootstrap(
+    specs_file: str | None,
+    count: int | None,
+    retailer: str,
+    campaign: str,
+    reward_slug: str,
+    loyalty_type: str,
+    refund_window: int,
+    fetch_type: str,
+    db_host: str,
+    db_port: str,
+    db_user: str,
+    db_pass: str,
+    polaris_db_name: str,
+    vela_db_name: str,
+    carina_db_name: str,
+) -> None:
+    if (specs_file is None) == (count is None):
+        click.echo("exactly one of --specs or --count is required.")
+        sys.exit(-1)
+
+    if count is not None and count < 1:
+        click.echo("--count must be at least 1.")
+        sys.exit(-1)
+
+    from .src.bootstrap import bootstrap_retailers, numbered_retailer_specs, read_retailer_specs
+    from .src.fixtures import RetailerSpec
+
+    defaults = RetailerSpec(retailer, campaign, reward_slug, loyalty_type, refund_window, fetch_type)
+    retailer_specs = (
+        read_retailer_specs(specs_file, defaults) if specs_file else numbered_retailer_specs(count or 0, defaults)
+    )
+    if not retailer_specs:
+        click.echo(f"{specs_file} has no retailer specs.")
+        sys.exit(-1)
+
+    carina_db_session, polaris_db_session, vela_db_session = _load_db_sessions(
+        db_host, db_port, db_user, db_pass, polaris_db_name, vela_db_name, carina_db_name
+    )
+    try:
+        with stage("bootstrap"):
+            retailer_specs = bootstrap_retailers(carina_db_session, polaris_db_session, vela_db_session, retailer_specs)
+    finally:
+        carina_db_session.close()
+        polaris_db_session.close()
+        vela_db_session.close()
+
+    click.echo(f"{len(retailer_specs)} retailers set up in Polaris, Vela and Carina.")
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,115 @@
+import csv
+import sys
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import fields, replace
+from typing import TYPE_CHECKING, Callable
+
+import click
+
+from sqlalchemy.orm import Session
+
+from .carina.crud import bulk_setup_reward_configs
+from .enums import FetchTypesEnum, LoyaltyTypes
+from .fixtures import RetailerSpec
+from .polaris.crud import bulk_setup_retailer_configs
+from .vela.crud import bulk_setup_retailer_rewards_and_campaigns
+
+if TYPE_CHECKING:
+    from sqlalchemy.engine import Engine
+
+# retailers written per set based round, keeps the multi row inserts well below the bind parameter limit
+BOOTSTRAP_CHUNK_SIZE = 1000
+
+
+def read_retailer_specs(specs_file: str, defaults: RetailerSpec) -> list[RetailerSpec]:
+    # csv with a header naming any of the spec fields, missing columns and empty cells take the defaults
+    field_names = {spec_field.name for spec_field in fields(RetailerSpec)}
+    with open(specs_file, newline="", encoding="utf-8") as spec_file:
+        reader = csv.DictReader(spec_file)
+        if unknown_columns := set(reader.fieldnames or ()) - field_names:
+            click.echo(f"unknown columns in {specs_file}: {', '.join(sorted(unknown_columns))}.")
+            sys.exit(-1)
+
+        retailer_specs = []
+        for row in reader:
+            values: dict = {name: value for name, value in row.items() if value}
+            try:
+                retailer_specs.append(_retailer_spec(defaults, values))
+            except ValueError as ex:
+                # checked up front, a bad value would otherwise only fail inside one of the database workers
+                raise click.BadParameter(f"row {reader.line_num} of {specs_file}: {ex}", param_hint="--specs") from ex
+    return retailer_specs
+
+
+def _retailer_spec(defaults: RetailerSpec, values: dict) -> RetailerSpec:
+    if "refund_window" in values:
+        if not values["refund_window"].isdigit():
+            raise ValueError(f"refund_window must be a number of days, got '{values['refund_window']}'.")
+        values["refund_window"] = int(values["refund_window"])
+
+    retailer_spec = replace(defaults, **values)
+    if retailer_spec.loyalty_type not in {loyalty_type.value for loyalty_type in LoyaltyTypes}:
+        raise ValueError(
+            f"unknown loyalty_type '{retailer_spec.loyalty_type}', "
+            f"expected one of {', '.join(loyalty_type.value for loyalty_type in LoyaltyTypes)}."
+        )
+    if not hasattr(FetchTypesEnum, retailer_spec.fetch_type):
+        raise ValueError(
+            f"unknown fetch_type '{retailer_spec.fetch_type}', "
+            f"expected one of {', '.join(fetch_type.name for fetch_type in FetchTypesEnum)}."
+        )
+    return retailer_spec
+
+
+def numbered_retailer_specs(count: int, defaults: RetailerSpec) -> list[RetailerSpec]:
+    return [
+        replace(
+            defaults,
+            retailer_slug=f"{defaults.retailer_slug}-{k}",
+            campaign_slug=f"{defaults.campaign_slug}-{k}",
+            reward_slug=f"{defaults.reward_slug}-{k}",
+        )
+        for k in range(1, count + 1)
+    ]
+
+
+def _setup_database(
+    engine: "Engine", bulk_setup: Callable[[Session, list[RetailerSpec]], None], retailer_specs: list[RetailerSpec]
+) -> None:
+    # a session of its own, the scoped sessions are not shared between threads
+    with Session(bind=engine) as db_session:
+        for i in range(0, len(retailer_specs), BOOTSTRAP_CHUNK_SIZE):
+            bulk_setup(db_session, retailer_specs[i : i + BOOTSTRAP_CHUNK_SIZE])
+
+
+def bootstrap_retailers(
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    vela_db_session: "Session",
+    retailer_specs: list[RetailerSpec],
+) -> list[RetailerSpec]:
+    retailer_specs = [spec for retailer_spec in retailer_specs for spec in retailer_spec.by_loyalty_type()]
+    for slug_field in ("retailer_slug", "campaign_slug"):
+        duplicates = [
+            slug for slug, n in Counter(getattr(spec, slug_field) for spec in retailer_specs).items() if n > 1
+        ]
+        if duplicates:
+            click.echo(f"{slug_field} values must be unique, found duplicates: {', '.join(sorted(duplicates)[:10])}.")
+            sys.exit(-1)
+
+    # the databases hold no references to each other's ids, each one is set up by its own worker
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [
+            executor.submit(
+                _setup_database, polaris_db_session.get_bind(), bulk_setup_retailer_configs, retailer_specs
+            ),
+            executor.submit(
+                _setup_database, vela_db_session.get_bind(), bulk_setup_retailer_rewards_and_campaigns, retailer_specs
+            ),
+            executor.submit(_setup_database, carina_db_session.get_bind(), bulk_setup_reward_configs, retailer_specs),
+        ]
+        for future in futures:
+            future.result()
+    return retailer_specs
@@ -1,20 +1,30 @@
 import sys
 
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Sequence
 
 import click
 
 from hashids import Hashids
-from sqlalchemy import delete
+from sqlalchemy import Text, delete, exists, false, func, insert, literal, update
+from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.future import select
 
+from ..columnar import ColumnarBatch, id_column
 from ..enums import FetchTypesEnum
 from ..fixtures import carina_retailer_payload, retailer_fetch_type_payload, reward_config_payload
+from ..ids import uuid4_strings
+from ..pg_copy import copy_batch
 from .db import FetchType, Retailer, RetailerFetchType, Reward, RewardConfig
 
 if TYPE_CHECKING:
     from sqlalchemy.orm import Session
 
+    from ..fixtures import RetailerSpec
+
+
+class RewardPoolExhausted(Exception):
+    pass
+
 
 def _get_retailer(db_session: "Session", retailer_slug: str) -> Retailer:
     return db_session.execute(select(Retailer).where(Retailer.slug == retailer_slug)).scalar()
@@ -30,29 +40,104 @@ def get_reward_config_and_retailer(db_session: "Session", retailer_slug: str) ->
     return reward_config, retailer
 
 
+def reward_config_exists(db_session: "Session", retailer_slug: str) -> bool:
+    return db_session.scalar(
+        select(exists().where(RewardConfig.retailer_id == Retailer.id, Retailer.slug == retailer_slug))
+    )
+
+
 def create_unallocated_rewards(
-    unallocated_rewards_to_create: int, batch_reward_salt: str, reward_config: RewardConfig
-) -> list[Reward]:
+    db_session: "Session", unallocated_rewards_to_create: int, batch_reward_salt: str, reward_config: RewardConfig
+) -> None:
     hashids = Hashids(batch_reward_salt, min_length=15)
-    unallocated_rewards = []
-    for i in range(unallocated_rewards_to_create):
-        code = (hashids.encode(i),)
-        unallocated_rewards.append(
-            Reward(
-                code=code,
-                reward_config_id=reward_config.id,
-                allocated=False,
-                retailer_id=reward_config.retailer_id,
-                deleted=False,
-            )
+    unallocated_rewards = ColumnarBatch(
+        Reward.__tablename__,
+        {
+            "id": uuid4_strings(unallocated_rewards_to_create),
+            "code": [hashids.encode(i) for i in range(unallocated_rewards_to_create)],
+            "reward_config_id": id_column([reward_config.id] * unallocated_rewards_to_create),
+            "allocated": [False] * unallocated_rewards_to_create,
+            "retailer_id": id_column([reward_config.retailer_id] * unallocated_rewards_to_create),
+            "deleted": [False] * unallocated_rewards_to_create,
+        },
+    )
+    copy_batch(db_session.connection(), unallocated_rewards)
+
+
+def server_side_create_unallocated_rewards(
+    db_session: "Session", unallocated_rewards_to_create: int, batch_reward_salt: str, reward_config: RewardConfig
+) -> None:
+    reward_n = func.generate_series(1, unallocated_rewards_to_create).table_valued("n")
+    salted_n = literal(batch_reward_salt) + reward_n.c.n.cast(Text)
+    db_session.execute(
+        insert(Reward).from_select(
+            ["id", "code", "reward_config_id", "allocated", "retailer_id", "deleted"],
+            select(
+                func.md5(salted_n).cast(UUID),
+                func.upper(func.substr(func.md5(salted_n + literal("code")), 1, 15)),
+                literal(reward_config.id),
+                false(),
+                literal(reward_config.retailer_id),
+                false(),
+            ),
+        )
+    )
+
+
+def claim_unallocated_rewards(
+    db_session: "Session", reward_config: RewardConfig, how_many: int
+) -> tuple[list, list[str]]:
+    if not how_many:
+        return [], []
+
+    # pool rows locked by a concurrent allocation are skipped rather than waited on, the way carina allocates
+    claimable_rewards = (
+        select(Reward.id)
+        .where(
+            Reward.reward_config_id == reward_config.id,
+            Reward.allocated.is_(false()),
+            Reward.deleted.is_(false()),
+        )
+        .limit(how_many)
+        .with_for_update(skip_locked=True)
+        .subquery()
+    )
+    claimed_rewards = db_session.execute(
+        update(Reward)
+        .where(Reward.id == claimable_rewards.c.id)
+        .values(allocated=True)
+        .returning(Reward.id, Reward.code)
+        .execution_options(synchronize_session=False)
+    ).all()
+    if len(claimed_rewards) < how_many:
+        raise RewardPoolExhausted(
+            f"only {len(claimed_rewards)} of the {how_many} rewards needed are left unallocated for "
+            f"'{reward_config.reward_slug}', they were allocated or deleted by another process."
         )
 
-    return unallocated_rewards
+    return [reward_id for reward_id, _ in claimed_rewards], [code for _, code in claimed_rewards]
 
 
-def persist_allocated_rewards(db_session: "Session", matching_rewards_payloads: list[dict]) -> None:
-    db_session.bulk_save_objects([Reward(**payload) for payload in matching_rewards_payloads])
-    db_session.commit()
+def persist_allocated_rewards(db_session: "Session", rewards_batch: ColumnarBatch, commit: bool = True) -> None:
+    copy_batch(db_session.connection(), rewards_batch)
+    if commit:
+        db_session.commit()
+
+
+def delete_rewards(db_session: "Session", reward_ids: Sequence, commit: bool = True) -> None:
+    if reward_ids:
+        db_session.execute(delete(Reward).where(Reward.id.in_(reward_ids)).execution_options(synchronize_session=False))
+    if commit:
+        db_session.commit()
+
+
+def delete_retailer_rewards(db_session: "Session", retailer_slug: str) -> None:
+    retailer = _get_retailer(db_session, retailer_slug)
+    if retailer:
+        db_session.execute(
+            delete(Reward).where(Reward.retailer_id == retailer.id).execution_options(synchronize_session=False)
+        )
+        db_session.commit()
 
 
 def _clean_carina_db(db_session: "Session", retailer_slug: str) -> None:
@@ -96,3 +181,48 @@ def setup_reward_config(db_session: "Session", retailer_slug: str, reward_slug:
     fetch_type = _get_fetch_type(db_session, fetch_type_name)
     _create_reward_config(db_session, retailer.id, fetch_type.id, reward_slug)
     db_session.commit()
+
+
+def bulk_setup_reward_configs(db_session: "Session", retailer_specs: list["RetailerSpec"]) -> None:
+    fetch_type_names = {spec.fetch_type for spec in retailer_specs}
+    if unknown_fetch_types := {name for name in fetch_type_names if not hasattr(FetchTypesEnum, name)}:
+        raise ValueError(f"Unknown fetch types: {', '.join(sorted(unknown_fetch_types))}")
+    fetch_type_ids = dict(
+        db_session.execute(select(FetchType.name, FetchType.id).where(FetchType.name.in_(fetch_type_names))).all()
+    )
+
+    existing_retailer_ids = select(Retailer.id).where(
+        Retailer.slug.in_([spec.retailer_slug for spec in retailer_specs])
+    )
+    for model in (RetailerFetchType, Reward, RewardConfig):
+        db_session.execute(
+            delete(model)
+            .where(model.retailer_id.in_(existing_retailer_ids))
+            .execution_options(synchronize_session=False)
+        )
+    db_session.execute(
+        delete(Retailer).where(Retailer.id.in_(existing_retailer_ids)).execution_options(synchronize_session=False)
+    )
+
+    retailer_ids = dict(
+        db_session.execute(
+            insert(Retailer)
+            .values([carina_retailer_payload(spec.retailer_slug) for spec in retailer_specs])
+            .returning(Retailer.slug, Retailer.id)
+        ).all()
+    )
+    db_session.execute(
+        insert(RetailerFetchType),
+        [
+            retailer_fetch_type_payload(retailer_ids[spec.retailer_slug], fetch_type_ids[spec.fetch_type])
+            for spec in retailer_specs
+        ],
+    )
+    db_session.execute(
+        insert(RewardConfig),
+        [
+            reward_config_payload(retailer_ids[spec.retailer_slug], spec.reward_slug, fetch_type_ids[spec.fetch_type])
+            for spec in retailer_specs
+        ],
+    )
+    db_session.commit()
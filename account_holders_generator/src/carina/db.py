@@ -6,7 +6,7 @@ from sqlalchemy import Column, ForeignKey, Integer, create_engine
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import NullPool, QueuePool
 from sqlalchemy.sql.schema import MetaData
 
 if TYPE_CHECKING:
@@ -41,8 +41,8 @@ class RetailerFetchType(Base):
     __tablename__ = "retailer_fetch_type"
 
 
-def load_models(db_uri: str) -> "Session":
-    engine = create_engine(db_uri, poolclass=NullPool)
+def load_models(db_uri: str, pooled: bool = False) -> "Session":
+    engine = create_engine(db_uri, poolclass=QueuePool if pooled else NullPool, pool_pre_ping=pooled)
 
     Base.prepare(engine, reflect=True)
     return scoped_session(sessionmaker(bind=engine))
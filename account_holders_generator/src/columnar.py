@@ -0,0 +1,30 @@
+from array import array
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, MutableSequence
+
+
+@dataclass
+class ColumnarBatch:
+    table_name: str
+    # one sequence per column, integer id columns are kept in compact array("q") buffers
+    columns: dict[str, MutableSequence] = field(default_factory=dict)
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()), ()))
+
+    @property
+    def column_names(self) -> list[str]:
+        return list(self.columns)
+
+    def rows(self) -> Iterator[tuple]:
+        return zip(*self.columns.values())
+
+    def extend(self, other: "ColumnarBatch") -> None:
+        if not self.columns:
+            self.columns = {name: values[:0] for name, values in other.columns.items()}
+        for name, values in other.columns.items():
+            self.columns[name].extend(values)
+
+
+def id_column(values: Iterable[int] = ()) -> array:
+    return array("q", values)
@@ -20,6 +20,27 @@ class AccountHolderRewardStatuses(Enum):
     PENDING = "PENDING"  # This is actually AccountHolderPendingReward but putting this here for simplicity
 
 
+class LoyaltyTypes(str, Enum):
+    ACCUMULATOR = "ACCUMULATOR"
+    STAMPS = "STAMPS"
+    BOTH = "BOTH"  # an ACCUMULATOR and a STAMPS retailer, set up side by side
+
+
 class FetchTypesEnum(Enum):
     PRE_LOADED = "PRE_LOADED"
     JIGSAW_EGIFT = "JIGSAW_EGIFT"
+
+
+class ServerSideTables(str, Enum):
+    MARKETING_PREFERENCE = "account_holder_marketing_preference"
+    CAMPAIGN_BALANCE = "account_holder_campaign_balance"
+    UNALLOCATED_REWARD = "unallocated_reward"
+
+
+class RegenerableTables(str, Enum):
+    # account holder child tables that can be rebuilt on their own, rewards are shared with carina and are not
+    PROFILE = "account_holder_profile"
+    MARKETING_PREFERENCE = "account_holder_marketing_preference"
+    CAMPAIGN_BALANCE = "account_holder_campaign_balance"
+    PENDING_REWARD = "account_holder_pending_reward"
+    TRANSACTION_HISTORY = "account_holder_transaction_history"
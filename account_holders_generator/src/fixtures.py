@@ -1,22 +1,37 @@
 import json
 
+from array import array
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from random import randint
-from typing import TYPE_CHECKING, Any
-from uuid import UUID, uuid4
+from typing import TYPE_CHECKING, Any, Callable, Sequence
 
-from faker import Faker
+from hashids import Hashids
 
+from .columnar import ColumnarBatch, id_column
 from .enums import AccountHolderRewardStatuses
+from .ids import uuid4_strings
 from .polaris.utils import generate_account_number, generate_email
+from .registry import (
+    BatchContext,
+    Constant,
+    Derived,
+    FakePoolSample,
+    FKReference,
+    Param,
+    Rows,
+    SequenceNumber,
+    TableSpec,
+    register_table,
+)
+from .timestamps import DAY_SECONDS, epoch_to_datetime, get_timestamp_generator, to_datetimes
 
 if TYPE_CHECKING:
-    from .enums import AccountHolderTypes
-    from .polaris.db import AccountHolder, RetailerConfig
+    from .carina.db import RewardConfig
 
+# claims the given number of carina rewards, returning their ids and codes
+ClaimRewards = Callable[[int], tuple[list, list[str]]]
 
-fake = Faker(["en-GB"])
 
 ACCOUNT_HOLDER_REWARD_SWITCHER: dict[int, list] = {
     0: [],
@@ -96,147 +111,303 @@ def generate_tx_rows(reward_goal: int, retailer_slug: str) -> list[TxHistoryRows
     return tx_history_list
 
 
-def account_holder_payload(
-    account_holder_n: int, account_holder_type: "AccountHolderTypes", retailer_config: "RetailerConfig"
-) -> dict:
-    return {
-        "email": generate_email(account_holder_type, account_holder_n),
-        "retailer_id": retailer_config.id,
-        "status": "ACTIVE",
-        "account_number": generate_account_number(
-            retailer_config.account_number_prefix, account_holder_type, account_holder_n
-        ),
-    }
+register_table(
+    TableSpec(
+        "account_holder",
+        {
+            "id": FKReference(),
+            "email": Derived(
+                lambda rows: [
+                    generate_email(rows.param("account_holder_type"), n) for n in rows.batch.account_holder_ns
+                ]
+            ),
+            "retailer_id": Param("retailer_id"),
+            "status": Constant("ACTIVE"),
+            "account_number": Derived(
+                lambda rows: [
+                    generate_account_number(rows.param("account_number_prefix"), rows.param("account_holder_type"), n)
+                    for n in rows.batch.account_holder_ns
+                ]
+            ),
+            "account_holder_uuid": Derived(lambda rows: uuid4_strings(rows.size)),
+            "opt_out_token": Derived(lambda rows: uuid4_strings(rows.size)),
+        },
+    )
+)
+
+
+register_table(
+    TableSpec(
+        "account_holder_profile",
+        {
+            "account_holder_id": FKReference(),
+            "date_of_birth": FakePoolSample("date_of_birth"),
+            "first_name": FakePoolSample("first_name"),
+            "last_name": FakePoolSample("last_name"),
+            "phone": FakePoolSample("phone"),
+            "_street_address": FakePoolSample("street_address"),
+            "_address": Derived(lambda rows: [address.split("\n") for address in rows.columns["_street_address"]]),
+            "address_line1": Derived(lambda rows: [address[0] for address in rows.columns["_address"]]),
+            "address_line2": Derived(
+                lambda rows: [address[1] if len(address) > 1 else "" for address in rows.columns["_address"]]
+            ),
+            "postcode": FakePoolSample("postcode"),
+            "city": FakePoolSample("city"),
+        },
+    )
+)
+
+
+MARKETING_PREFERENCE_VALUES = {
+    "key_name": "marketing_pref",
+    "value": "False",
+    "value_type": "BOOLEAN",
+}
 
+register_table(
+    TableSpec(
+        "account_holder_marketing_preference",
+        {
+            "account_holder_id": FKReference(),
+            **{name: Constant(value) for name, value in MARKETING_PREFERENCE_VALUES.items()},
+        },
+    )
+)
 
-def account_holder_profile_payload(account_holder: "AccountHolder") -> dict:
-    phone_prefix = "0" if randint(0, 1) else "+44"
-    address = fake.street_address().split("\n")
-    address_1 = address[0]
-    if len(address) > 1:
-        address_2 = address[1]
-    else:
-        address_2 = ""
 
-    return {
-        "account_holder_id": account_holder.id,
-        "date_of_birth": fake.date(),
-        "first_name": fake.first_name(),
-        "last_name": fake.last_name(),
-        "phone": phone_prefix + fake.msisdn(),
-        "address_line1": address_1,
-        "address_line2": address_2,
-        "postcode": fake.postcode(),
-        "city": fake.city(),
-    }
+# account holders cycle through the first 11 reward switcher entries
+ACCOUNT_HOLDER_REWARD_TYPES = 11
 
 
-def account_holder_marketing_preference_payload(account_holder: "AccountHolder") -> dict:
-    return {
-        "account_holder_id": account_holder.id,
-        "key_name": "marketing_pref",
-        "value": "False",
-        "value_type": "BOOLEAN",
-    }
+def rewards_required(account_holder_n: int) -> list[tuple[int, AccountHolderRewardStatuses]]:
+    return ACCOUNT_HOLDER_REWARD_SWITCHER[account_holder_n % ACCOUNT_HOLDER_REWARD_TYPES]
 
 
-def account_holder_reward_payload(
-    account_holder_id: int,
-    retailer_slug: str,
-    reward_uuid: UUID,
-    reward_code: str,
-    reward_slug: str,
-    reward_status: AccountHolderRewardStatuses,
-    issue_date: datetime,
-) -> dict:
-    now = datetime.now(tz=timezone.utc).replace(microsecond=0)
+def _count_with_residue(first_n: int, last_n: int, residue: int, modulus: int) -> int:
+    return (last_n - residue) // modulus - (first_n - 1 - residue) // modulus
 
-    return {
-        "account_holder_id": account_holder_id,
-        "retailer_slug": retailer_slug,
-        "reward_uuid": reward_uuid,
-        "code": reward_code,
-        "reward_slug": reward_slug,
-        "status": AccountHolderRewardStatuses.ISSUED.value
-        if reward_status == AccountHolderRewardStatuses.EXPIRED
-        else reward_status.value,
-        "issued_date": issue_date,
-        "expiry_date": now - timedelta(days=randint(2, 10))
-        if reward_status == AccountHolderRewardStatuses.EXPIRED
-        else datetime(2030, 1, 1),
-        "redeemed_date": now - timedelta(days=randint(2, 10))
-        if reward_status == AccountHolderRewardStatuses.REDEEMED
-        else None,
-        "cancelled_date": now - timedelta(days=randint(2, 10))
-        if reward_status == AccountHolderRewardStatuses.CANCELLED
-        else None,
-        "idempotency_token": str(uuid4()),
-    }
 
+def reward_rows(first_n: int, last_n: int, pending: bool) -> int:
+    # rewards of the account holders numbered first_n to last_n of one type, without generating them
+    if first_n > last_n:
+        return 0
+    return sum(
+        _count_with_residue(first_n, last_n, residue, ACCOUNT_HOLDER_REWARD_TYPES)
+        * sum(
+            how_many
+            for how_many, status in rewards_required(residue)
+            if (status == AccountHolderRewardStatuses.PENDING) == pending
+        )
+        for residue in range(ACCOUNT_HOLDER_REWARD_TYPES)
+    )
 
-def account_holder_pending_reward_payload(
-    account_holder_id: int,
-    retailer_slug: str,
-    reward_slug: str,
-    campaign_slug: str,
-    refund_window: int,
-    enqueued: bool,
-) -> dict:
-    now = datetime.now(tz=timezone.utc).replace(microsecond=0)
-    pending_reward_value = 200
-    count = 1
 
+def _reward_dates(statuses: list[AccountHolderRewardStatuses]) -> dict[str, list]:
+    timestamps = get_timestamp_generator()
+    now = datetime.now(tz=timezone.utc).replace(microsecond=0)
+    now_epoch = int(now.timestamp())
+    now_epochs = array("q", [now_epoch]) * len(statuses)
+    last_expiries = array("q", [now_epoch + timestamps.profile.validity_days * DAY_SECONDS]) * len(statuses)
+
+    issued = timestamps.history(len(statuses), now)
+    # redemptions, cancellations and past expiries all happen between the issue and now
+    used = timestamps.between(issued, now_epochs)
+    past_expiries = array("q", map(max, issued, timestamps.clustered(used, round_up=False)))
+    future_expiries = timestamps.clustered(timestamps.between(now_epochs, last_expiries))
     return {
-        "created_date": now,
-        "conversion_date": now + timedelta(days=refund_window),
-        "value": 200,
-        "account_holder_id": account_holder_id,
-        "retailer_slug": retailer_slug,
-        "campaign_slug": campaign_slug,
-        "reward_slug": reward_slug,
-        "idempotency_token": str(uuid4()),
-        "enqueued": enqueued,
-        "count": count,
-        "total_cost_to_user": pending_reward_value * count,
-        "pending_reward_uuid": str(uuid4()),
+        "issued_date": to_datetimes(issued),
+        "expiry_date": [
+            epoch_to_datetime(past if status == AccountHolderRewardStatuses.EXPIRED else future)
+            for status, past, future in zip(statuses, past_expiries, future_expiries)
+        ],
+        "redeemed_date": [
+            epoch_to_datetime(used_at) if status == AccountHolderRewardStatuses.REDEEMED else None
+            for status, used_at in zip(statuses, used)
+        ],
+        "cancelled_date": [
+            epoch_to_datetime(used_at) if status == AccountHolderRewardStatuses.CANCELLED else None
+            for status, used_at in zip(statuses, used)
+        ],
     }
 
 
-def account_holder_transaction_history_payload(
-    account_holder_id: int,
-    tx_amount: str,
-    location: str,
-    loyalty_type: str,
-) -> dict:
-    now = datetime.now(tz=timezone.utc).replace(microsecond=0)
-    if loyalty_type == "STAMPS":
-        if float(tx_amount) <= 0:
-            value = "0"
-        else:
-            value = "1"
+def account_holder_reward_batches(
+    account_holder_ids: Sequence[int],
+    account_holder_ns: Sequence[int],
+    batch_reward_salt: str,
+    reward_config: "RewardConfig",
+    retailer_id: int,
+    retailer_slug: str,
+    claim_rewards: ClaimRewards | None = None,
+) -> tuple[ColumnarBatch, ColumnarBatch]:
+    holder_ids = id_column()
+    statuses: list[AccountHolderRewardStatuses] = []
+    code_numbers: list[tuple[int, int, int]] = []
+    for account_holder_id, account_holder_n in zip(account_holder_ids, account_holder_ns):
+        for i, (how_many, reward_status) in enumerate(rewards_required(account_holder_n)):
+            if reward_status == AccountHolderRewardStatuses.PENDING:
+                continue
+            for reward_n in range(how_many):
+                holder_ids.append(account_holder_id)
+                statuses.append(reward_status)
+                code_numbers.append((i, reward_n, account_holder_n))
+
+    if claim_rewards:
+        # allocated from the unallocated carina pool, no carina rows are written
+        reward_uuids, codes = claim_rewards(len(holder_ids))
     else:
-        value = "£" + tx_amount
-
-    return {
-        "transaction_id": f"{account_holder_id}{randint(1, 1000000)}",
-        "datetime": now,
-        "amount": tx_amount,
-        "amount_currency": "GBP",
-        "location_name": location,
-        "earned": [{"type": loyalty_type, "value": value}],
-        "account_holder_id": account_holder_id,
-    }
+        hashids = Hashids(batch_reward_salt, min_length=15)
+        reward_uuids, codes = uuid4_strings(len(holder_ids)), [hashids.encode(*numbers) for numbers in code_numbers]
+
+    account_holder_rewards = ColumnarBatch(
+        "account_holder_reward",
+        {
+            "account_holder_id": holder_ids,
+            "retailer_slug": [retailer_slug] * len(holder_ids),
+            "reward_uuid": reward_uuids,
+            "code": codes,
+            "reward_slug": [reward_config.reward_slug] * len(holder_ids),
+            "status": [
+                AccountHolderRewardStatuses.ISSUED.value
+                if status == AccountHolderRewardStatuses.EXPIRED
+                else status.value
+                for status in statuses
+            ],
+            **_reward_dates(statuses),
+            "idempotency_token": uuid4_strings(len(holder_ids)),
+        },
+    )
+    if claim_rewards:
+        return account_holder_rewards, ColumnarBatch("reward")
+
+    # the carina side of every allocated reward shares its uuid and code with the polaris row
+    rewards = ColumnarBatch(
+        "reward",
+        {
+            "id": reward_uuids,
+            "code": codes,
+            "reward_config_id": id_column([reward_config.id] * len(holder_ids)),
+            "allocated": [True] * len(holder_ids),
+            "retailer_id": id_column([retailer_id] * len(holder_ids)),
+            "deleted": [False] * len(holder_ids),
+        },
+    )
+    return account_holder_rewards, rewards
+
+
+def _pending_rewards_required(context: BatchContext) -> list[int]:
+    return [
+        sum(how_many for how_many, status in rewards_required(n) if status == AccountHolderRewardStatuses.PENDING)
+        for n in context.account_holder_ns
+    ]
 
 
-def reward_payload(reward_uuid: UUID, reward_code: str, reward_config_id: int, retailer_id: int) -> dict:
-    return {
-        "id": reward_uuid,
-        "code": reward_code,
-        "reward_config_id": reward_config_id,
-        "allocated": True,
-        "retailer_id": retailer_id,
-        "deleted": False,
-    }
+def _pending_reward_created_epochs(rows: Rows) -> array:
+    # still pending, so created within the last refund window
+    now_epoch = int(rows.batch.now.timestamp())
+    return get_timestamp_generator().between(
+        array("q", [now_epoch - rows.param("refund_window") * DAY_SECONDS]) * rows.size,
+        array("q", [now_epoch]) * rows.size,
+    )
+
+
+PENDING_REWARD_VALUE = 200
+
+register_table(
+    TableSpec(
+        "account_holder_pending_reward",
+        {
+            "_created_epoch": Derived(_pending_reward_created_epochs),
+            "created_date": Derived(lambda rows: to_datetimes(rows.columns["_created_epoch"])),
+            "conversion_date": Derived(
+                lambda rows: to_datetimes(
+                    created_epoch + rows.param("refund_window") * DAY_SECONDS
+                    for created_epoch in rows.columns["_created_epoch"]
+                )
+            ),
+            "value": Constant(PENDING_REWARD_VALUE),
+            "account_holder_id": FKReference(),
+            "retailer_slug": Param("retailer_slug"),
+            "campaign_slug": Derived(lambda rows: [rows.param("active_campaigns")[0]] * rows.size),
+            "reward_slug": Param("reward_slug"),
+            "idempotency_token": Derived(lambda rows: uuid4_strings(rows.size)),
+            "enqueued": Constant(False),
+            "count": Constant(1),
+            "total_cost_to_user": Constant(PENDING_REWARD_VALUE * 1),
+            "pending_reward_uuid": Derived(lambda rows: uuid4_strings(rows.size)),
+        },
+        rows_per_parent=_pending_rewards_required,
+    )
+)
+
+
+def _earned_value(tx_amount: str, loyalty_type: str) -> str:
+    if loyalty_type == "STAMPS":
+        return "0" if float(tx_amount) <= 0 else "1"
+    return "£" + tx_amount
+
+
+def _tx_history_rows(rows: Rows) -> list[TxHistoryRowsData]:
+    tx_history_rows = generate_tx_rows(rows.param("reward_goal"), retailer_slug=rows.param("retailer_slug"))
+    return [tx_history_rows[tx_n] for tx_n in rows.columns["_tx_n"]]
+
+
+register_table(
+    TableSpec(
+        "account_holder_transaction_history",
+        {
+            "_tx_n": SequenceNumber(per_parent=True),
+            "_tx_row": Derived(_tx_history_rows),
+            "account_holder_id": FKReference(),
+            # fixed width suffix keeps ids unique and derived only from the database assigned account holder id
+            "transaction_id": Derived(
+                lambda rows: [
+                    f"{account_holder_id}{tx_n:02d}"
+                    for account_holder_id, tx_n in zip(rows.columns["account_holder_id"], rows.columns["_tx_n"])
+                ]
+            ),
+            "datetime": Derived(
+                lambda rows: to_datetimes(get_timestamp_generator().history(rows.size, rows.batch.now))
+            ),
+            "amount": Derived(lambda rows: [str(tx_row.tx_amount) for tx_row in rows.columns["_tx_row"]]),
+            "amount_currency": Constant("GBP"),
+            "location_name": Derived(lambda rows: [tx_row.location for tx_row in rows.columns["_tx_row"]]),
+            "earned": Derived(
+                lambda rows: [
+                    [{"type": rows.param("loyalty_type"), "value": _earned_value(amount, rows.param("loyalty_type"))}]
+                    for amount in rows.columns["amount"]
+                ]
+            ),
+        },
+        rows_per_parent=lambda context: [randint(1, 10) for _ in context.account_holder_ids],
+    )
+)
+
+
+@dataclass(frozen=True)
+class RetailerSpec:
+    retailer_slug: str
+    campaign_slug: str
+    reward_slug: str
+    loyalty_type: str
+    refund_window: int
+    fetch_type: str
+
+    def by_loyalty_type(self) -> list["RetailerSpec"]:
+        # BOTH stands for an ACCUMULATOR and a STAMPS retailer, named the same way as by generate --setup-retailer
+        if self.loyalty_type != "BOTH":
+            return [self]
+        return [
+            RetailerSpec(
+                self.retailer_slug + "-" + loyalty,
+                self.campaign_slug + "-" + loyalty,
+                self.reward_slug + "-" + loyalty,
+                loyalty,
+                self.refund_window,
+                self.fetch_type,
+            )
+            for loyalty in ["ACCUMULATOR", "STAMPS"]
+        ]
 
 
 def retailer_config_payload(retailer_slug: str) -> dict:
@@ -1,29 +1,300 @@
-from typing import TYPE_CHECKING
-from uuid import uuid4
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import partial
+from itertools import islice
+from time import sleep
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator
 
 import click
 
 from progressbar import ProgressBar
+from sqlalchemy.exc import OperationalError
 
 from .carina.crud import (
+    claim_unallocated_rewards,
     create_unallocated_rewards,
+    delete_rewards,
     get_reward_config_and_retailer,
     persist_allocated_rewards,
+    reward_config_exists,
+    server_side_create_unallocated_rewards,
     setup_reward_config,
 )
-from .enums import AccountHolderTypes
+from .enums import AccountHolderTypes, ServerSideTables
+from .fixtures import reward_rows
+from .governor import GovernorLimits, LoadGovernor
+from .ids import random_salt
+from .loader import ParallelLoader
 from .polaris.crud import (
     batch_create_account_holders_and_rewards,
     clear_existing_account_holders,
+    clear_existing_account_holders_slice,
+    get_max_generated_account_holder_n,
     get_retailer_by_slug,
+    retailer_config_exists,
     setup_retailer_config,
+    shard_setup_lock,
 )
-from .vela.crud import get_active_campaigns, get_reward_rule, setup_retailer_reward_and_campaign
+from .sharding import NO_SHARDING, Shard
+from .stages import stage
+from .staging import StagingLoader
+from .vela.crud import campaign_exists, get_active_campaigns, get_reward_rule, setup_retailer_reward_and_campaign
 
 if TYPE_CHECKING:
     from sqlalchemy.orm import Session
 
+    from .carina.db import RewardConfig
+    from .columnar import ColumnarBatch
+    from .pools import FakeDataPools
+    from .psycopg_backend import PsycopgBulkWriter
+
 BATCH_SIZE = 1000
+# attempts at a batch, or at the batches committed together, before a transient error stops the run
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF_SECONDS = 0.5
+
+
+def _clear_existing_account_holders(
+    polaris_db_session: "Session", retailer_id: int, shard: Shard, first_n: int, last_n: int, commit: bool = True
+) -> None:
+    if not shard.is_sharded:
+        clear_existing_account_holders(polaris_db_session, retailer_id, commit=commit)
+        return
+
+    for account_holder_type in AccountHolderTypes:
+        clear_existing_account_holders_slice(
+            polaris_db_session, retailer_id, account_holder_type, first_n, last_n, commit=commit
+        )
+
+
+def _create_unallocated_rewards(
+    carina_db_session: "Session",
+    reward_config: "RewardConfig",
+    unallocated_rewards_to_create: int,
+    server_side_tables: frozenset[ServerSideTables],
+    shard: Shard,
+    rewards_to_claim: int = 0,
+) -> None:
+    first_unallocated_n, last_unallocated_n = shard.slice(unallocated_rewards_to_create)
+    # every shard adds the rewards it is going to claim before claiming any, so the pool can never run dry
+    shard_unallocated_rewards_to_create = max(last_unallocated_n - first_unallocated_n + 1, 0) + rewards_to_claim
+    if ServerSideTables.UNALLOCATED_REWARD in server_side_tables:
+        server_side_create_unallocated_rewards(
+            carina_db_session,
+            unallocated_rewards_to_create=shard_unallocated_rewards_to_create,
+            batch_reward_salt=random_salt(),
+            reward_config=reward_config,
+        )
+    else:
+        create_unallocated_rewards(
+            carina_db_session,
+            unallocated_rewards_to_create=shard_unallocated_rewards_to_create,
+            batch_reward_salt=random_salt(),
+            reward_config=reward_config,
+        )
+    carina_db_session.commit()
+
+
+def _rewards_to_claim(first_n: int, last_n: int) -> int:
+    rewards_to_claim = reward_rows(first_n, last_n, pending=False) * len(AccountHolderTypes)
+    click.echo(f"Creating {rewards_to_claim} more unallocated rewards for the account holders to claim.")
+    return rewards_to_claim
+
+
+def _prepare_account_holder_range(
+    polaris_db_session: "Session", retailer_id: int, ah_to_create: int, shard: Shard, staging: bool, top_up: bool
+) -> tuple[int, int]:
+    first_n, last_n = shard.slice(ah_to_create)
+    if top_up:
+        # numbered after the existing account holders, which are kept
+        offset = get_max_generated_account_holder_n(polaris_db_session, retailer_id)
+        first_n, last_n = first_n + offset, last_n + offset
+    if shard.is_sharded:
+        click.echo(f"Shard {shard.index}/{shard.count} owns account holders {first_n} to {last_n} of each type.")
+    if top_up:
+        click.echo(f"Topping up with account holders {first_n} to {last_n} of each type.")
+    elif staging:
+        click.echo("Previously generated account holders will be replaced once all batches are staged.")
+    else:
+        click.echo("Deleting previously generated account holders for requested retailer.")
+        with stage("cleanup"):
+            _clear_existing_account_holders(polaris_db_session, retailer_id, shard, first_n, last_n)
+
+    return first_n, last_n
+
+
+def _batch_ranges(first_n: int, last_n: int, governor: LoadGovernor | None = None) -> Iterator[tuple[int, int]]:
+    # batches count down from last_n, each covers the account holder numbers in (batch_end, batch_start]
+    batch_start = last_n
+    while batch_start >= first_n:
+        if governor:
+            # sized and paced by the governor right before each batch is written
+            governor.throttle()
+        batch_end = max(batch_start - (governor.batch_size if governor else BATCH_SIZE), first_n - 1)
+        yield batch_start, batch_end
+        batch_start = batch_end
+
+
+def _write_loaded_batches(
+    carina_db_session: "Session",
+    create_batch: Callable[..., tuple[int, "ColumnarBatch"]],
+    batch_ranges: Iterable[tuple[int, int]],
+    persist_rewards: bool,
+    persisted_reward_ids: list,
+) -> None:
+    # staged, parallel and psycopg 3 loads commit on their own, batch by batch
+    progress_counter = 0
+    for batch_start, batch_end in batch_ranges:
+        with stage("batch"):
+            progress_counter, rewards_batch = create_batch(
+                batch_start=batch_start,
+                batch_end=batch_end,
+                progress_counter=progress_counter,
+                account_holder_type_reward_code_salt=random_salt(),
+            )
+            if persist_rewards:
+                with stage("carina_write"):
+                    persist_allocated_rewards(carina_db_session, rewards_batch)
+                persisted_reward_ids.extend(rewards_batch.columns.get("id", ()))
+
+
+def _retry_delay(attempt: int) -> float:
+    return RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1)
+
+
+def _write_batch(
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    create_batch: Callable[..., tuple[int, "ColumnarBatch"]],
+    batch_start: int,
+    batch_end: int,
+    progress_counter: int,
+    savepoint: bool,
+) -> tuple[int, "ColumnarBatch"]:
+    attempt = 0
+    while True:
+        # a batch sharing its transaction with others is retried from a savepoint, so the batches already written
+        # by the transaction are kept
+        polaris_savepoint = polaris_db_session.begin_nested() if savepoint else None
+        carina_savepoint = carina_db_session.begin_nested() if savepoint else None
+        try:
+            with stage("batch"):
+                batch_progress_counter, rewards_batch = create_batch(
+                    batch_start=batch_start,
+                    batch_end=batch_end,
+                    progress_counter=progress_counter,
+                    account_holder_type_reward_code_salt=random_salt(),
+                    commit=False,
+                )
+                with stage("carina_write"):
+                    persist_allocated_rewards(carina_db_session, rewards_batch, commit=False)
+        except OperationalError as ex:
+            # a lost connection takes the savepoints with it, the whole transaction is retried by _write_unit
+            if polaris_savepoint is None or carina_savepoint is None or ex.connection_invalidated:
+                raise
+            attempt += 1
+            if attempt >= MAX_ATTEMPTS:
+                raise
+            polaris_savepoint.rollback()
+            carina_savepoint.rollback()
+            click.echo(f"\nbatch {batch_start} failed: {ex.orig}, retrying it from its savepoint.")
+            sleep(_retry_delay(attempt))
+            continue
+
+        if polaris_savepoint is not None and carina_savepoint is not None:
+            polaris_savepoint.commit()
+            carina_savepoint.commit()
+        return batch_progress_counter, rewards_batch
+
+
+def _write_unit(
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    create_batch: Callable[..., tuple[int, "ColumnarBatch"]],
+    batch_ranges: list[tuple[int, int]],
+    progress_counter: int,
+    clear_slice: Callable[..., None],
+) -> int:
+    reward_ids: list = []
+    attempt = 0
+    while True:
+        try:
+            if attempt:
+                # the failed attempt may have been committed on one side only, its rows are removed before the
+                # batches are written again so that a retry never duplicates them
+                polaris_db_session.rollback()
+                carina_db_session.rollback()
+                with stage("cleanup"):
+                    clear_slice(first_n=batch_ranges[-1][1] + 1, last_n=batch_ranges[0][0])
+                    delete_rewards(carina_db_session, reward_ids)
+                reward_ids = []
+
+            unit_progress_counter = progress_counter
+            for batch_start, batch_end in batch_ranges:
+                unit_progress_counter, rewards_batch = _write_batch(
+                    carina_db_session,
+                    polaris_db_session,
+                    create_batch,
+                    batch_start,
+                    batch_end,
+                    unit_progress_counter,
+                    savepoint=len(batch_ranges) > 1,
+                )
+                # empty when the rewards were claimed from the pool, claims are rolled back with the transaction
+                reward_ids.extend(rewards_batch.columns.get("id", ()))
+
+            with stage("polaris_write"):
+                polaris_db_session.commit()
+            with stage("carina_write"):
+                carina_db_session.commit()
+            return unit_progress_counter
+        except OperationalError as ex:
+            attempt += 1
+            if attempt >= MAX_ATTEMPTS:
+                raise
+            click.echo(
+                f"\nbatches {batch_ranges[0][0]} to {batch_ranges[-1][1] + 1} failed: {ex.orig}, "
+                f"retrying in {_retry_delay(attempt):.1f}s."
+            )
+            sleep(_retry_delay(attempt))
+
+
+@dataclass
+class _BatchLoaders:
+    staging_loader: StagingLoader | None
+    parallel_loader: ParallelLoader | None
+    governor: LoadGovernor | None
+    # the rewards of staged batches are committed as they are written, they are deleted again unless the swap succeeds
+    staged_reward_ids: list = field(default_factory=list)
+
+
+@contextmanager
+def _batch_loaders(
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    staging: bool,
+    load_jobs: int,
+    governor_limits: GovernorLimits | None,
+) -> Iterator[_BatchLoaders]:
+    engines = {"polaris": polaris_db_session.get_bind(), "carina": carina_db_session.get_bind()}
+    loaders = _BatchLoaders(
+        StagingLoader(polaris_db_session) if staging else None,
+        ParallelLoader(engines, load_jobs) if load_jobs > 1 and not staging else None,
+        LoadGovernor(engines, governor_limits, BATCH_SIZE) if governor_limits and governor_limits.enabled else None,
+    )
+    try:
+        yield loaders
+    finally:
+        if loaders.staging_loader:
+            loaders.staging_loader.discard()
+        if loaders.staged_reward_ids:
+            carina_db_session.rollback()
+            with stage("cleanup"):
+                delete_rewards(carina_db_session, loaders.staged_reward_ids)
+        if loaders.parallel_loader:
+            loaders.parallel_loader.close()
+        if loaders.governor:
+            loaders.governor.close()
 
 
 def _generate_account_holders_and_rewards_data(
@@ -38,59 +309,114 @@ def _generate_account_holders_and_rewards_data(
     refund_window: int | None,
     tx_history: bool,
     loyalty_type: str,
+    server_side_tables: frozenset[ServerSideTables],
+    shard: Shard,
+    staging: bool,
+    fake_data_pools: "FakeDataPools | None",
+    load_jobs: int,
+    top_up: bool,
+    commit_every: int,
+    bulk_writer: "PsycopgBulkWriter | None",
+    governor_limits: GovernorLimits | None,
+    allocate_from_pool: bool,
 ) -> None:
     if loyalty_type == "STAMPS":
         refund_window = None
-    retailer_config = get_retailer_by_slug(polaris_db_session, retailer_slug)
-    click.echo("Selected retailer: %s" % retailer_config.name)
-    reward_config, retailer = get_reward_config_and_retailer(carina_db_session, retailer_slug)
-    click.echo(f"Reward slug for {retailer_config.name}: {reward_config.reward_slug}")
-    active_campaigns = get_active_campaigns(vela_db_session, retailer_config, campaign_slug, loyalty_type)
-    click.echo("Selected campaign %s." % campaign_slug)
-    click.echo("Deleting previously generated account holders for requested retailer.")
-    reward_rule = get_reward_rule(vela_db_session, campaign_slug)
-    clear_existing_account_holders(polaris_db_session, retailer_config.id)
-    unallocated_rewards_batch = create_unallocated_rewards(
-        unallocated_rewards_to_create=unallocated_rewards_to_create,
-        batch_reward_salt=str(uuid4()),
-        reward_config=reward_config,
+    with stage("setup_lookups"):
+        retailer_config = get_retailer_by_slug(polaris_db_session, retailer_slug)
+        click.echo("Selected retailer: %s" % retailer_config.name)
+        reward_config, retailer = get_reward_config_and_retailer(carina_db_session, retailer_slug)
+        click.echo(f"Reward slug for {retailer_config.name}: {reward_config.reward_slug}")
+        active_campaigns = get_active_campaigns(vela_db_session, retailer_config, campaign_slug, loyalty_type)
+        click.echo("Selected campaign %s." % campaign_slug)
+        reward_rule = get_reward_rule(vela_db_session, campaign_slug)
+    first_n, last_n = _prepare_account_holder_range(
+        polaris_db_session, retailer_config.id, ah_to_create, shard, staging, top_up
     )
-    carina_db_session.bulk_save_objects(unallocated_rewards_batch)
-    carina_db_session.commit()
 
-    for account_holder_type in AccountHolderTypes:
-        click.echo("\ncreating %s users." % account_holder_type.value)
-        batch_start = ah_to_create
-        progress_counter = 0
+    with stage("carina_write"):
+        _create_unallocated_rewards(
+            carina_db_session,
+            reward_config,
+            unallocated_rewards_to_create,
+            server_side_tables,
+            shard,
+            _rewards_to_claim(first_n, last_n) if allocate_from_pool else 0,
+        )
 
-        with ProgressBar(max_value=ah_to_create) as progress_bar:
-            while batch_start > 0:
+    if first_n > last_n:
+        click.echo(f"Shard {shard.index}/{shard.count} has no account holders to create.")
+        return
 
-                if batch_start <= BATCH_SIZE:
-                    batch_end = 0
-                else:
-                    batch_end = batch_start - BATCH_SIZE
+    with _batch_loaders(carina_db_session, polaris_db_session, staging, load_jobs, governor_limits) as loaders:
+        staging_loader, parallel_loader, governor = loaders.staging_loader, loaders.parallel_loader, loaders.governor
+        for account_holder_type in AccountHolderTypes:
+            click.echo("\ncreating %s users." % account_holder_type.value)
+            progress_counter = 0
 
-                progress_counter, matching_reward_payloads_batch, = batch_create_account_holders_and_rewards(
+            with ProgressBar(max_value=last_n - first_n + 1) as progress_bar:
+                create_batch = partial(
+                    batch_create_account_holders_and_rewards,
                     db_session=polaris_db_session,
-                    batch_start=batch_start,
-                    batch_end=batch_end,
                     account_holder_type=account_holder_type,
                     retailer=retailer,
                     retailer_config=retailer_config,
                     active_campaigns=active_campaigns,
                     max_val=max_val,
                     bar=progress_bar,
-                    progress_counter=progress_counter,
-                    account_holder_type_reward_code_salt=str(uuid4()),
                     reward_config=reward_config,
                     refund_window=refund_window,
                     tx_history=tx_history,
                     reward_goal=reward_rule.reward_goal,
                     loyalty_type=loyalty_type,
+                    server_side_tables=server_side_tables,
+                    staging_loader=staging_loader,
+                    fake_data_pools=fake_data_pools,
+                    parallel_loader=parallel_loader,
+                    bulk_writer=bulk_writer,
+                    claim_rewards=(
+                        partial(claim_unallocated_rewards, carina_db_session, reward_config)
+                        if allocate_from_pool
+                        else None
+                    ),
                 )
-                persist_allocated_rewards(carina_db_session, matching_reward_payloads_batch)
-                batch_start = batch_end
+                batch_ranges = _batch_ranges(first_n, last_n, governor)
+                if staging_loader or parallel_loader or bulk_writer:
+                    _write_loaded_batches(
+                        carina_db_session,
+                        create_batch,
+                        batch_ranges,
+                        not (parallel_loader or bulk_writer),
+                        loaders.staged_reward_ids,
+                    )
+                    continue
+
+                while unit_batch_ranges := list(islice(batch_ranges, commit_every)):
+                    progress_counter = _write_unit(
+                        carina_db_session,
+                        polaris_db_session,
+                        create_batch,
+                        unit_batch_ranges,
+                        progress_counter,
+                        partial(
+                            clear_existing_account_holders_slice,
+                            polaris_db_session,
+                            retailer_config.id,
+                            account_holder_type,
+                        ),
+                    )
+
+        if staging_loader:
+            click.echo("\nSwapping staged account holders into Polaris.")
+            with stage("polaris_write"):
+                staging_loader.swap(
+                    None
+                    if top_up
+                    else lambda db_session: _clear_existing_account_holders(
+                        db_session, retailer_config.id, shard, first_n, last_n, commit=False
+                    )
+                )
+            loaders.staged_reward_ids.clear()
 
 
 def generate_account_holders_and_rewards(
@@ -105,6 +431,16 @@ def generate_account_holders_and_rewards(
     refund_window: int,
     tx_history: bool,
     loyalty_type: str,
+    server_side_tables: frozenset[ServerSideTables] = frozenset(),
+    shard: Shard = NO_SHARDING,
+    staging: bool = False,
+    fake_data_pools: "FakeDataPools | None" = None,
+    load_jobs: int = 1,
+    top_up: bool = False,
+    commit_every: int = 1,
+    bulk_writer: "PsycopgBulkWriter | None" = None,
+    governor_limits: GovernorLimits | None = None,
+    allocate_from_pool: bool = False,
 ) -> None:
     if loyalty_type == "BOTH":
         for loyalty in ["ACCUMULATOR", "STAMPS"]:
@@ -122,6 +458,16 @@ def generate_account_holders_and_rewards(
                 refund_window,
                 tx_history,
                 loyalty_type=loyalty,
+                server_side_tables=server_side_tables,
+                shard=shard,
+                staging=staging,
+                fake_data_pools=fake_data_pools,
+                load_jobs=load_jobs,
+                top_up=top_up,
+                commit_every=commit_every,
+                bulk_writer=bulk_writer,
+                governor_limits=governor_limits,
+                allocate_from_pool=allocate_from_pool,
             )
     else:
         _generate_account_holders_and_rewards_data(
@@ -136,10 +482,20 @@ def generate_account_holders_and_rewards(
             refund_window,
             tx_history,
             loyalty_type,
+            server_side_tables,
+            shard,
+            staging,
+            fake_data_pools,
+            load_jobs,
+            top_up,
+            commit_every,
+            bulk_writer,
+            governor_limits,
+            allocate_from_pool,
         )
 
 
-def generate_retailer_base_config(
+def _generate_retailer_base_config(
     carina_db_session: "Session",
     polaris_db_session: "Session",
     vela_db_session: "Session",
@@ -177,3 +533,75 @@ def generate_retailer_base_config(
         )
         click.echo("Creating '%s' reward config in Carina." % reward_slug)
         setup_reward_config(carina_db_session, retailer_slug, reward_slug, fetch_type)
+
+
+def _retailer_setup_exists(
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    vela_db_session: "Session",
+    retailer_slug: str,
+    campaign_slug: str,
+    loyalty_type: str,
+) -> bool:
+    if loyalty_type == "BOTH":
+        slugs = [
+            (retailer_slug + "-" + loyalty, campaign_slug + "-" + loyalty) for loyalty in ["ACCUMULATOR", "STAMPS"]
+        ]
+    else:
+        slugs = [(retailer_slug, campaign_slug)]
+
+    # the setup commits polaris, vela and carina in turn, a shard stopped half way leaves it incomplete
+    return all(
+        retailer_config_exists(polaris_db_session, loyalty_retailer_slug)
+        and campaign_exists(vela_db_session, loyalty_retailer_slug, loyalty_campaign_slug)
+        and reward_config_exists(carina_db_session, loyalty_retailer_slug)
+        for loyalty_retailer_slug, loyalty_campaign_slug in slugs
+    )
+
+
+def generate_retailer_base_config(
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    vela_db_session: "Session",
+    retailer_slug: str,
+    campaign_slug: str,
+    reward_slug: str,
+    refund_window: int,
+    fetch_type: str,
+    loyalty_type: str,
+    shard: Shard = NO_SHARDING,
+) -> None:
+    if not shard.is_sharded:
+        _generate_retailer_base_config(
+            carina_db_session,
+            polaris_db_session,
+            vela_db_session,
+            retailer_slug,
+            campaign_slug,
+            reward_slug,
+            refund_window,
+            fetch_type,
+            loyalty_type,
+        )
+        return
+
+    # every shard queues on the same lock and the first one to find the setup missing makes it, an existing setup is
+    # never made again once a shard may have started generating against it
+    with shard_setup_lock(polaris_db_session, retailer_slug):
+        if _retailer_setup_exists(
+            carina_db_session, polaris_db_session, vela_db_session, retailer_slug, campaign_slug, loyalty_type
+        ):
+            click.echo(f"Retailer '{retailer_slug}' is already set up, shard {shard.index}/{shard.count} reuses it.")
+            return
+
+        _generate_retailer_base_config(
+            carina_db_session,
+            polaris_db_session,
+            vela_db_session,
+            retailer_slug,
+            campaign_slug,
+            reward_slug,
+            refund_window,
+            fetch_type,
+            loyalty_type,
+        )
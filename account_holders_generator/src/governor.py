@@ -0,0 +1,121 @@
+from dataclasses import dataclass
+from time import monotonic, perf_counter, sleep
+from typing import TYPE_CHECKING
+
+import click
+
+from sqlalchemy import text
+
+if TYPE_CHECKING:
+    from sqlalchemy.engine import Connection, Engine
+
+REPLICATION_LAG_QUERY = text("SELECT coalesce(max(extract(epoch FROM replay_lag)), 0) FROM pg_stat_replication")
+WAITING_SESSIONS_QUERY = text(
+    "SELECT count(*) FROM pg_stat_activity WHERE datname = current_database() AND state = 'active' "
+    "AND wait_event_type IN ('Lock', 'LWLock', 'IO') AND pid <> pg_backend_pid()"
+)
+# assigning a transaction id makes the commit flush a WAL record, and wait for synchronous replicas if there are any
+COMMIT_PROBE_QUERY = text("SELECT txid_current()")
+ROUND_TRIP_QUERY = text("SELECT 1")
+
+MIN_BATCH_SIZE = 100
+BATCH_SIZE_STEP = 100
+MIN_PAUSE_SECONDS = 0.25
+MAX_PAUSE_SECONDS = 30.0
+
+
+@dataclass(frozen=True)
+class GovernorLimits:
+    # seconds the slowest replica is behind in replaying the primary's WAL
+    max_replication_lag: float | None = None
+    # milliseconds a commit takes to be flushed
+    max_commit_latency: float | None = None
+    # other sessions of the database stuck on locks or IO
+    max_waiting_sessions: int | None = None
+    sample_every: float = 5.0
+
+    @property
+    def enabled(self) -> bool:
+        return any(
+            limit is not None
+            for limit in (self.max_replication_lag, self.max_commit_latency, self.max_waiting_sessions)
+        )
+
+
+@dataclass(frozen=True)
+class HealthSample:
+    database: str
+    replication_lag: float
+    commit_latency: float
+    waiting_sessions: int
+
+    def breaches(self, limits: GovernorLimits) -> list[str]:
+        breaches = []
+        if limits.max_replication_lag is not None and self.replication_lag > limits.max_replication_lag:
+            breaches.append(f"{self.database} replication lag {self.replication_lag:.1f}s")
+        if limits.max_commit_latency is not None and self.commit_latency > limits.max_commit_latency:
+            breaches.append(f"{self.database} commit latency {self.commit_latency:.0f}ms")
+        if limits.max_waiting_sessions is not None and self.waiting_sessions > limits.max_waiting_sessions:
+            breaches.append(f"{self.database} {self.waiting_sessions} waiting sessions")
+        return breaches
+
+
+def _sample(database: str, connection: "Connection") -> HealthSample:
+    # a transaction per sample, pg_stat_activity is only read once per transaction
+    with connection.begin():
+        replication_lag = float(connection.scalar(REPLICATION_LAG_QUERY))
+        waiting_sessions = connection.scalar(WAITING_SESSIONS_QUERY)
+
+    with connection.begin() as transaction:
+        connection.execute(COMMIT_PROBE_QUERY)
+        # the round trip of a statement that writes nothing is taken off the commit's, leaving its WAL flush
+        started = perf_counter()
+        connection.execute(ROUND_TRIP_QUERY)
+        round_trip = perf_counter() - started
+        started = perf_counter()
+        transaction.commit()
+        commit_latency = max(perf_counter() - started - round_trip, 0.0)
+    return HealthSample(database, replication_lag, commit_latency * 1000, waiting_sessions)
+
+
+class LoadGovernor:
+    # additive increase, multiplicative decrease: the batch size grows while every database is within its limits and
+    # is halved as soon as one is not, once at its minimum the batches are paused for longer and longer instead
+    def __init__(self, engines: dict[str, "Engine"], limits: GovernorLimits, max_batch_size: int) -> None:
+        self.limits = limits
+        self.max_batch_size = max_batch_size
+        self.batch_size = max_batch_size
+        self.pause = 0.0
+        self.next_sample = monotonic()
+        # connections of its own, kept outside of the transactions of the batches
+        self.connections = {database: engine.connect() for database, engine in engines.items()}
+
+    def _adjust(self, breaches: list[str]) -> None:
+        batch_size, pause = self.batch_size, self.pause
+        if breaches:
+            if self.batch_size > MIN_BATCH_SIZE:
+                self.batch_size = max(self.batch_size // 2, MIN_BATCH_SIZE)
+            else:
+                self.pause = min(max(self.pause * 2, MIN_PAUSE_SECONDS), MAX_PAUSE_SECONDS)
+        elif self.pause:
+            self.pause = self.pause / 2 if self.pause > MIN_PAUSE_SECONDS else 0.0
+        else:
+            self.batch_size = min(self.batch_size + BATCH_SIZE_STEP, self.max_batch_size)
+
+        if breaches and (batch_size, pause) != (self.batch_size, self.pause):
+            click.echo(
+                f"\n{', '.join(breaches)} over the limit, batch size {self.batch_size}, "
+                f"pausing {self.pause:.2f}s between batches."
+            )
+
+    def throttle(self) -> None:
+        if monotonic() >= self.next_sample:
+            samples = [_sample(database, connection) for database, connection in self.connections.items()]
+            self._adjust([breach for sample in samples for breach in sample.breaches(self.limits)])
+            self.next_sample = monotonic() + self.limits.sample_every
+        if self.pause:
+            sleep(self.pause)
+
+    def close(self) -> None:
+        for connection in self.connections.values():
+            connection.close()
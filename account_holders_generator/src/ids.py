@@ -0,0 +1,44 @@
+import os
+
+from functools import cache
+
+UUID_BYTES = 16
+
+
+class IdGenerator:
+    # random bytes for a whole batch of ids are drawn at once from os.urandom, never seeded, so that seeded reruns and
+    # shards sharing a seed still write unique ids and tokens
+    def random_bytes(self, size: int) -> bytearray:
+        return bytearray(os.urandom(size))
+
+    def uuid4_block(self, how_many: int) -> bytearray:
+        block = self.random_bytes(how_many * UUID_BYTES)
+        # version 4 and RFC 4122 variant bits, set on the same bytes uuid.uuid4 sets them on
+        block[6::UUID_BYTES] = bytes(byte & 0x0F | 0x40 for byte in block[6::UUID_BYTES])
+        block[8::UUID_BYTES] = bytes(byte & 0x3F | 0x80 for byte in block[8::UUID_BYTES])
+        return block
+
+
+@cache
+def get_id_generator() -> IdGenerator:
+    return IdGenerator()
+
+
+def uuid4_strings(how_many: int) -> list[str]:
+    # text form, written as is by the text COPY and cheaply turned back into bytes by the binary one
+    hex_block = get_id_generator().uuid4_block(how_many).hex()
+    return [
+        f"{hex_block[i:i + 8]}-{hex_block[i + 8:i + 12]}-{hex_block[i + 12:i + 16]}-"
+        f"{hex_block[i + 16:i + 20]}-{hex_block[i + 20:i + 32]}"
+        for i in range(0, len(hex_block), 2 * UUID_BYTES)
+    ]
+
+
+def random_tokens(how_many: int, token_bytes: int) -> list[str]:
+    hex_block = get_id_generator().random_bytes(how_many * token_bytes).hex()
+    return [hex_block[i : i + 2 * token_bytes] for i in range(0, len(hex_block), 2 * token_bytes)]
+
+
+def random_salt() -> str:
+    # hashids salts drawn like every other id, so that reward codes are not repeated by a seeded rerun
+    return random_tokens(1, UUID_BYTES)[0]
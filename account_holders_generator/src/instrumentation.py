@@ -0,0 +1,129 @@
+import threading
+
+from bisect import bisect_left
+from collections import Counter
+from math import ceil
+from typing import TYPE_CHECKING, Any
+
+import click
+
+from sqlalchemy import event
+
+from .stages import current_stage, stage_owner
+
+if TYPE_CHECKING:
+    from sqlalchemy.engine import Connection, Engine
+
+# psycopg2 executemany sends INSERTs as execute_values pages and everything else as execute_batch pages
+INSERT_PAGE_SIZE = 1000
+BATCH_PAGE_SIZE = 100
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryCounter:
+    def __init__(self, max_queries_per_batch: int | None = None) -> None:
+        self.max_queries_per_batch = max_queries_per_batch
+        self.statements: Counter[tuple[str, str]] = Counter()
+        self.round_trips: Counter[tuple[str, str]] = Counter()
+        # statements of the batch each thread is running, loader threads count towards the thread they load for
+        self.batch_statements: Counter[int] = Counter()
+        self.batches_statements = 0
+        self.batches = 0
+        self._lock = threading.Lock()
+
+    def attach(self, database: str, engine: "Engine") -> None:
+        def before_cursor_execute(  # pylint: disable=unused-argument
+            conn: "Connection",
+            cursor: Any,
+            statement: str,
+            parameters: Any,
+            context: Any,
+            executemany: bool,
+        ) -> None:
+            round_trips = 1
+            if executemany:
+                page_size = INSERT_PAGE_SIZE if statement.lstrip().upper().startswith("INSERT") else BATCH_PAGE_SIZE
+                round_trips = ceil(len(parameters) / page_size)
+            self._count(database, 1, round_trips)
+
+        def commit(conn: "Connection") -> None:  # pylint: disable=unused-argument
+            self._count(database, 0, 1)
+
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "commit", commit)
+
+    def _count(self, database: str, statements: int, round_trips: int) -> None:
+        key = (database, current_stage() or "other")
+        with self._lock:
+            self.statements[key] += statements
+            self.round_trips[key] += round_trips
+            self.batch_statements[stage_owner()] += statements
+
+    def stage_started(self, name: str) -> None:
+        if name == "batch":
+            with self._lock:
+                self.batch_statements[threading.get_ident()] = 0
+
+    def stage_finished(self, name: str) -> None:
+        if name != "batch":
+            return
+
+        with self._lock:
+            batch_statements = self.batch_statements.pop(threading.get_ident(), 0)
+            self.batches += 1
+            self.batches_statements += batch_statements
+            batch = self.batches
+        if self.max_queries_per_batch is not None and batch_statements > self.max_queries_per_batch:
+            raise QueryBudgetExceeded(
+                f"batch {batch} issued {batch_statements} statements, "
+                f"more than the allowed {self.max_queries_per_batch} per batch."
+            )
+
+    def echo_report(self) -> None:
+        click.echo(f"\n{'database':<10}{'stage':<20}{'statements':>14}{'round trips':>14}")
+        for database, stage_name in sorted(self.round_trips):
+            click.echo(
+                f"{database:<10}{stage_name:<20}{self.statements[database, stage_name]:>14}"
+                f"{self.round_trips[database, stage_name]:>14}"
+            )
+        if self.batches:
+            click.echo(f"\n{self.batches_statements / self.batches:.1f} statements per batch on average.")
+
+
+class LatencyHistogram:
+    # upper bounds in milliseconds, percentiles are reported as the bound of the bucket they fall in
+    BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.rows = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, milliseconds: float, rows: int) -> None:
+        self.buckets[bisect_left(self.BOUNDS, milliseconds)] += 1
+        self.count += 1
+        self.rows += rows
+        self.total += milliseconds
+        self.max = max(self.max, milliseconds)
+
+    def percentile(self, fraction: float) -> float:
+        rank, seen = fraction * self.count, 0
+        for bound, in_bucket in zip(self.BOUNDS, self.buckets):
+            seen += in_bucket
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def summary(self) -> str:
+        if not self.count:
+            return "no writes"
+        return (
+            f"{self.count} writes, {self.rows} rows, mean {self.total / self.count:.1f}ms, "
+            f"p50 <={self.percentile(0.5):g}ms, p95 <={self.percentile(0.95):g}ms, "
+            f"p99 <={self.percentile(0.99):g}ms, max {self.max:.1f}ms"
+        )
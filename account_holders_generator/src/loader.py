@@ -0,0 +1,72 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from queue import Queue
+from typing import TYPE_CHECKING, Callable
+
+from .stages import inherited_stages, stage, stage_context
+
+if TYPE_CHECKING:
+    from sqlalchemy.engine import Connection, Engine
+
+# tables each generated table must be committed after, every child row references account_holder.id
+TABLE_DEPENDENCIES: dict[str, tuple[str, ...]] = {
+    "account_holder": (),
+    "account_holder_profile": ("account_holder",),
+    "account_holder_marketing_preference": ("account_holder",),
+    "account_holder_reward": ("account_holder",),
+    "account_holder_pending_reward": ("account_holder",),
+    "account_holder_campaign_balance": ("account_holder",),
+    "account_holder_transaction_history": ("account_holder",),
+    "reward": (),
+}
+
+
+@dataclass
+class LoadTask:
+    database: str
+    table_name: str
+    write: Callable[["Connection"], None]
+    depends_on: tuple[str, ...] = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.depends_on = TABLE_DEPENDENCIES.get(self.table_name, ())
+
+
+class ParallelLoader:
+    # each table of a batch is written and committed on its own pooled connection, a table only waits for the
+    # tables it depends on, so a batch takes as long as account_holder plus its slowest child
+    def __init__(self, engines: dict[str, "Engine"], jobs: int) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="loader")
+        self.connections: dict[str, Queue["Connection"]] = {}
+        for database, engine in engines.items():
+            self.connections[database] = Queue()
+            for _ in range(jobs):
+                self.connections[database].put(engine.connect())
+
+    def _run(self, task: LoadTask, dependencies: list[Future], context: tuple[int, tuple[str, ...]]) -> None:
+        # dependencies were submitted first, so they are already running or ahead in the executor queue
+        for dependency in dependencies:
+            dependency.result()
+
+        connection = self.connections[task.database].get()
+        try:
+            with inherited_stages(context), stage(f"{task.database}_write"), connection.begin():
+                task.write(connection)
+        finally:
+            self.connections[task.database].put(connection)
+
+    def load(self, tasks: list[LoadTask]) -> None:
+        futures: dict[str, Future] = {}
+        context = stage_context()
+        for task in sorted(tasks, key=lambda task: len(task.depends_on)):
+            dependencies = [futures[table_name] for table_name in task.depends_on if table_name in futures]
+            futures[task.table_name] = self.executor.submit(self._run, task, dependencies, context)
+
+        for future in futures.values():
+            future.result()
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        for connections in self.connections.values():
+            while not connections.empty():
+                connections.get().close()
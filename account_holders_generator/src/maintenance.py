@@ -0,0 +1,90 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+import click
+
+from sqlalchemy import text
+
+from .carina.db import Reward
+from .polaris.db import (
+    AccountHolder,
+    AccountHolderCampaignBalance,
+    AccountHolderMarketingPreference,
+    AccountHolderPendingReward,
+    AccountHolderProfile,
+    AccountHolderReward,
+    AccountHolderTransactionHistory,
+)
+
+if TYPE_CHECKING:
+    from sqlalchemy.engine import Engine
+    from sqlalchemy.orm import Session
+
+
+@dataclass
+class TableStats:
+    database: str
+    table: str
+    rows: int
+    table_size: str
+    indexes_size: str
+
+
+def generated_tables(refund_window: int, tx_history: bool, loyalty_type: str) -> dict[str, list[str]]:
+    polaris_models: list[type] = [
+        AccountHolder,
+        AccountHolderProfile,
+        AccountHolderMarketingPreference,
+        AccountHolderReward,
+        AccountHolderCampaignBalance,
+    ]
+    if refund_window > 0 and loyalty_type != "STAMPS":
+        polaris_models.append(AccountHolderPendingReward)
+    if tx_history:
+        polaris_models.append(AccountHolderTransactionHistory)
+
+    return {
+        "polaris": [model.__tablename__ for model in polaris_models],
+        "carina": [Reward.__tablename__],
+    }
+
+
+def _analyze_table(engine: "Engine", database: str, table_name: str, vacuum: bool) -> TableStats:
+    # VACUUM refuses to run inside a transaction block
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text(f"{'VACUUM ANALYZE' if vacuum else 'ANALYZE'} {table_name}"))
+        rows, table_size, indexes_size = connection.execute(
+            text(
+                "SELECT reltuples::bigint, pg_size_pretty(pg_table_size(oid)), pg_size_pretty(pg_indexes_size(oid)) "
+                "FROM pg_class WHERE oid = CAST(:table_name AS regclass)"
+            ),
+            {"table_name": table_name},
+        ).one()
+
+    return TableStats(database, table_name, rows, table_size, indexes_size)
+
+
+def analyze_generated_tables(
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    tables: dict[str, list[str]],
+    vacuum: bool,
+    jobs: int,
+) -> list[TableStats]:
+    engines = {"polaris": polaris_db_session.get_bind(), "carina": carina_db_session.get_bind()}
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [
+            executor.submit(_analyze_table, engines[database], database, table_name, vacuum)
+            for database, table_names in tables.items()
+            for table_name in table_names
+        ]
+        return [future.result() for future in futures]
+
+
+def echo_table_stats(tables_stats: list[TableStats]) -> None:
+    click.echo(f"\n{'table':<45}{'rows':>14}{'table size':>14}{'index size':>14}")
+    for stats in tables_stats:
+        click.echo(
+            f"{stats.database + '.' + stats.table:<45}{stats.rows:>14}{stats.table_size:>14}{stats.indexes_size:>14}"
+        )
@@ -0,0 +1,137 @@
+import gzip
+import json
+import os
+
+from contextlib import ExitStack
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Sequence
+
+from sqlalchemy import String, func, select, true
+
+from .carina.db import Reward
+from .polaris.crud import get_retailer_by_slug
+from .polaris.db import AccountHolder, AccountHolderReward
+from .polaris.utils import GENERATED_EMAIL_PATTERN
+
+if TYPE_CHECKING:
+    from sqlalchemy.engine import Row
+    from sqlalchemy.orm import Session
+    from sqlalchemy.sql import Select
+
+INDEX_FILE_NAME = "index.json"
+
+
+@dataclass
+class ExportManifest:
+    created_at: str
+    retailer_slug: str
+    account_holders: int
+    rewards: int
+    # rewards found in polaris without a carina row sharing their uuid
+    rewards_missing_in_carina: int
+    files: list[str]
+
+    def dump(self, output_dir: str) -> None:
+        with open(os.path.join(output_dir, INDEX_FILE_NAME), "w", encoding="utf-8") as manifest_file:
+            json.dump(asdict(self), manifest_file, indent=2)
+
+
+def _account_holders_query(retailer_id: int) -> "Select":
+    rewards = (
+        select(
+            func.array_agg(AccountHolderReward.reward_uuid).label("reward_uuids"),
+            func.array_agg(AccountHolderReward.code).label("codes"),
+            func.array_agg(AccountHolderReward.status.cast(String)).label("statuses"),
+        )
+        .where(AccountHolderReward.account_holder_id == AccountHolder.id)
+        .lateral()
+    )
+    return (
+        select(
+            AccountHolder.id,
+            AccountHolder.email,
+            AccountHolder.account_number,
+            AccountHolder.account_holder_uuid,
+            rewards.c.reward_uuids,
+            rewards.c.codes,
+            rewards.c.statuses,
+        )
+        .outerjoin(rewards, true())
+        .where(AccountHolder.retailer_id == retailer_id, AccountHolder.email.like(GENERATED_EMAIL_PATTERN))
+        .order_by(AccountHolder.id)
+    )
+
+
+def _carina_reward_ids(carina_db_session: "Session", partition: Sequence["Row"]) -> set:
+    reward_uuids = [str(reward_uuid) for row in partition for reward_uuid in row.reward_uuids or () if reward_uuid]
+    if not reward_uuids:
+        return set()
+    return {
+        str(reward_id) for reward_id in carina_db_session.scalars(select(Reward.id).where(Reward.id.in_(reward_uuids)))
+    }
+
+
+def _manifest_record(row: "Row", carina_reward_ids: set) -> dict:
+    return {
+        "email": row.email,
+        "account_number": row.account_number,
+        "account_holder_uuid": str(row.account_holder_uuid),
+        "rewards": [
+            {
+                "reward_uuid": str(reward_uuid),
+                "code": code,
+                "status": status,
+                "carina_reward_id": str(reward_uuid) if str(reward_uuid) in carina_reward_ids else None,
+            }
+            for reward_uuid, code, status in zip(row.reward_uuids or (), row.codes or (), row.statuses or ())
+            if reward_uuid
+        ],
+    }
+
+
+def export_manifest(
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    retailer_slug: str,
+    output_dir: str,
+    shards: int,
+    chunk_size: int,
+) -> ExportManifest:
+    retailer_config = get_retailer_by_slug(polaris_db_session, retailer_slug)
+    os.makedirs(output_dir, exist_ok=True)
+    file_names = [f"manifest-{k:03d}-of-{shards:03d}.ndjson.gz" for k in range(1, shards + 1)]
+    account_holders = rewards = rewards_missing_in_carina = 0
+
+    with ExitStack() as stack:
+        shard_files = [
+            stack.enter_context(gzip.open(os.path.join(output_dir, file_name), "wt", encoding="utf-8"))
+            for file_name in file_names
+        ]
+        # server side cursor, only one chunk of account holders and their carina lookups is held at a time
+        result = polaris_db_session.execute(
+            _account_holders_query(retailer_config.id).execution_options(yield_per=chunk_size)
+        )
+        for partition in result.partitions():
+            carina_reward_ids = _carina_reward_ids(carina_db_session, partition)
+            for row in partition:
+                record = _manifest_record(row, carina_reward_ids)
+                # account holders are dealt round robin so every worker gets the same share of each type
+                shard_files[account_holders % shards].write(json.dumps(record) + "\n")
+                account_holders += 1
+                rewards += len(record["rewards"])
+                rewards_missing_in_carina += sum(reward["carina_reward_id"] is None for reward in record["rewards"])
+
+        polaris_db_session.commit()
+        carina_db_session.commit()
+
+    manifest = ExportManifest(
+        created_at=datetime.now(tz=timezone.utc).isoformat(),
+        retailer_slug=retailer_slug,
+        account_holders=account_holders,
+        rewards=rewards,
+        rewards_missing_in_carina=rewards_missing_in_carina,
+        files=file_names,
+    )
+    manifest.dump(output_dir)
+    return manifest
@@ -0,0 +1,87 @@
+import io
+import json
+
+from array import array
+from enum import Enum
+from typing import IO, TYPE_CHECKING, Any, Iterable, Sequence
+
+from sqlalchemy import text
+
+if TYPE_CHECKING:
+    from sqlalchemy.engine import Connection
+    from sqlalchemy.sql import Select
+
+    from .columnar import ColumnarBatch
+
+
+def column_list(connection: "Connection", columns: list[str]) -> str:
+    return ", ".join(connection.dialect.identifier_preparer.quote(column) for column in columns)
+
+
+def _execute_copy(connection: "Connection", sql: str, fileobj: IO) -> int:
+    cursor = connection.connection.cursor()
+    # COPY runs on the raw DBAPI cursor, dispatching the event keeps it visible to engine listeners
+    connection.dispatch.before_cursor_execute(connection, cursor, sql, None, None, False)
+    cursor.copy_expert(sql, fileobj)
+    return cursor.rowcount
+
+
+def copy_query_to(connection: "Connection", query: "Select", fileobj: IO[bytes]) -> int:
+    compiled = query.compile(dialect=connection.dialect)
+    sql = connection.connection.cursor().mogrify(str(compiled), compiled.params).decode()
+    return _execute_copy(connection, f"COPY ({sql}) TO STDOUT WITH (FORMAT binary)", fileobj)
+
+
+def _copy_text_value(value: Any) -> str:
+    if value is None:
+        return r"\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    elif isinstance(value, Enum):
+        value = value.value
+
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _copy_text_column(values: Sequence) -> Iterable[str]:
+    # integer buffers never need escaping
+    if isinstance(values, array):
+        return map(str, values)
+    return map(_copy_text_value, values)
+
+
+def copy_batch(connection: "Connection", batch: "ColumnarBatch", table_name: str | None = None) -> int:
+    if not batch:
+        return 0
+
+    # serialised column by column, rows only exist as the transient tuples zip hands to join
+    text_columns = [_copy_text_column(values) for values in batch.columns.values()]
+    buffer = io.StringIO("\n".join(map("\t".join, zip(*text_columns))) + "\n")
+    return _execute_copy(
+        connection,
+        f"COPY {table_name or batch.table_name} ({column_list(connection, batch.column_names)}) FROM STDIN",
+        buffer,
+    )
+
+
+def copy_into(connection: "Connection", table_name: str, columns: list[str], fileobj: IO[bytes]) -> int:
+    return _execute_copy(
+        connection,
+        f"COPY {table_name} ({column_list(connection, columns)}) FROM STDIN WITH (FORMAT binary)",
+        fileobj,
+    )
+
+
+def create_staging_table(
+    connection: "Connection", staging_table_name: str, table_name: str, columns: list[str], temporary: bool = True
+) -> None:
+    # same column types as the source table, but none of its indexes, constraints or triggers
+    connection.execute(
+        text(
+            f"CREATE {'TEMPORARY' if temporary else 'UNLOGGED'} TABLE {staging_table_name} "
+            f"{'ON COMMIT DROP ' if temporary else ''}"
+            f"AS SELECT {column_list(connection, columns)} FROM {table_name} WITH NO DATA"
+        )
+    )
@@ -0,0 +1,281 @@
+from dataclasses import dataclass
+from time import perf_counter
+from typing import TYPE_CHECKING
+
+import click
+
+from progressbar import NullBar
+from sqlalchemy import text
+from sqlalchemy.future import select
+from sqlalchemy.orm import Session
+
+from .carina.crud import get_reward_config_and_retailer, persist_allocated_rewards
+from .carina.db import Reward
+from .enums import AccountHolderTypes
+from .fixtures import reward_rows
+from .ids import random_salt
+from .polaris.crud import batch_create_account_holders_and_rewards
+from .polaris.db import (
+    AccountHolder,
+    AccountHolderCampaignBalance,
+    AccountHolderMarketingPreference,
+    AccountHolderPendingReward,
+    AccountHolderProfile,
+    AccountHolderReward,
+    AccountHolderTransactionHistory,
+    RetailerConfig,
+)
+from .sharding import Shard
+from .vela.crud import get_active_campaigns, get_reward_rule
+
+if TYPE_CHECKING:
+    from sqlalchemy.engine import Engine
+
+CALIBRATION_ACCOUNT_HOLDERS = 220
+# tuple header and line pointer of every heap row
+ROW_OVERHEAD_BYTES = 28
+# transaction history has between 1 and 10 rows per account holder
+EXPECTED_TX_HISTORY_ROWS = 5.5
+
+
+@dataclass
+class TablePlan:
+    database: str
+    table: str
+    rows: float
+    exact: bool
+    bytes_per_row: float = 0.0
+    # existing rows updated by the run, each update writes a new version of the row until it is vacuumed
+    updated_rows: float = 0.0
+
+    @property
+    def size(self) -> float:
+        return (self.rows + self.updated_rows) * self.bytes_per_row
+
+
+def expected_rows(
+    ah_to_create: int,
+    shard: Shard,
+    active_campaigns: int,
+    unallocated_rewards_to_create: int,
+    refund_window: int | None,
+    tx_history: bool,
+    allocate_from_pool: bool = False,
+) -> list[TablePlan]:
+    first_n, last_n = shard.slice(ah_to_create)
+    types = len(AccountHolderTypes)
+    holders = max(last_n - first_n + 1, 0) * types
+    rewards = reward_rows(first_n, last_n, pending=False) * types
+    first_unallocated_n, last_unallocated_n = shard.slice(unallocated_rewards_to_create)
+
+    plans = [
+        TablePlan("polaris", AccountHolder.__tablename__, holders, True),
+        TablePlan("polaris", AccountHolderProfile.__tablename__, holders, True),
+        TablePlan("polaris", AccountHolderMarketingPreference.__tablename__, holders, True),
+        TablePlan("polaris", AccountHolderCampaignBalance.__tablename__, holders * active_campaigns, True),
+        TablePlan("polaris", AccountHolderReward.__tablename__, rewards, True),
+    ]
+    if refund_window:
+        plans.append(
+            TablePlan(
+                "polaris", AccountHolderPendingReward.__tablename__, reward_rows(first_n, last_n, True) * types, True
+            )
+        )
+    if tx_history:
+        plans.append(
+            TablePlan(
+                "polaris", AccountHolderTransactionHistory.__tablename__, holders * EXPECTED_TX_HISTORY_ROWS, False
+            )
+        )
+    # claimed rewards are created unallocated, as part of the pool, and then updated by the claims
+    plans.append(
+        TablePlan(
+            "carina",
+            Reward.__tablename__,
+            rewards + max(last_unallocated_n - first_unallocated_n + 1, 0),
+            True,
+            updated_rows=rewards if allocate_from_pool else 0,
+        )
+    )
+    return plans
+
+
+def _bytes_per_row(engine: "Engine", table_name: str) -> float:
+    with engine.connect() as connection:
+        # measured from the existing rows, indexes included, when the table has been analyzed with data in it,
+        # otherwise from the column widths, which leaves out indexes
+        return float(
+            connection.execute(
+                text(
+                    "SELECT CASE WHEN c.reltuples > 0 THEN pg_total_relation_size(c.oid) / c.reltuples "
+                    "ELSE :overhead + ("
+                    "SELECT sum(CASE WHEN a.attlen > 0 THEN a.attlen ELSE coalesce(s.avg_width, 32) END) "
+                    "FROM pg_attribute a LEFT JOIN pg_stats s ON s.schemaname = current_schema() "
+                    "AND s.tablename = c.relname AND s.attname = a.attname "
+                    "WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped) END "
+                    "FROM pg_class c WHERE c.oid = CAST(:table_name AS regclass)"
+                ),
+                {"table_name": table_name, "overhead": ROW_OVERHEAD_BYTES},
+            ).scalar_one()
+        )
+
+
+def _calibrate(
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    vela_db_session: "Session",
+    retailer_config: RetailerConfig,
+    campaign_slug: str,
+    max_val: int,
+    refund_window: int | None,
+    tx_history: bool,
+    loyalty_type: str,
+) -> float:
+    reward_config, retailer = get_reward_config_and_retailer(carina_db_session, retailer_config.slug)
+    active_campaigns = get_active_campaigns(vela_db_session, retailer_config, campaign_slug, loyalty_type)
+    reward_rule = get_reward_rule(vela_db_session, campaign_slug)
+
+    polaris_connection = polaris_db_session.get_bind().connect()
+    carina_connection = carina_db_session.get_bind().connect()
+    polaris_transaction = polaris_connection.begin()
+    carina_transaction = carina_connection.begin()
+    # sessions joined to an outer transaction, their commits are rolled back with it below.
+    # account holder ids drawn from the sequence are not given back.
+    polaris_calibration_session = Session(bind=polaris_connection)
+    carina_calibration_session = Session(bind=carina_connection)
+    try:
+        started = perf_counter()
+        _, rewards_batch = batch_create_account_holders_and_rewards(
+            db_session=polaris_calibration_session,
+            batch_start=CALIBRATION_ACCOUNT_HOLDERS,
+            batch_end=0,
+            account_holder_type=AccountHolderTypes.FLOAT_BALANCE,
+            retailer=retailer,
+            retailer_config=retailer_config,
+            active_campaigns=active_campaigns,
+            max_val=max_val,
+            bar=NullBar(),
+            progress_counter=0,
+            account_holder_type_reward_code_salt=random_salt(),
+            reward_config=reward_config,
+            refund_window=refund_window,
+            tx_history=tx_history,
+            reward_goal=reward_rule.reward_goal,
+            loyalty_type=loyalty_type,
+        )
+        persist_allocated_rewards(carina_calibration_session, rewards_batch)
+        return (perf_counter() - started) / CALIBRATION_ACCOUNT_HOLDERS
+    finally:
+        polaris_calibration_session.close()
+        carina_calibration_session.close()
+        polaris_transaction.rollback()
+        carina_transaction.rollback()
+        polaris_connection.close()
+        carina_connection.close()
+
+
+def _pretty_size(size: float) -> str:
+    for unit in ("B", "kB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def plan_generation(
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    vela_db_session: "Session",
+    ah_to_create: int,
+    retailer_slug: str,
+    campaign_slug: str,
+    max_val: int,
+    unallocated_rewards_to_create: int,
+    refund_window: int,
+    tx_history: bool,
+    loyalty_type: str,
+    shard: Shard,
+    allocate_from_pool: bool = False,
+) -> None:
+    if loyalty_type == "BOTH":
+        runs = [
+            (retailer_slug + "-" + loyalty, campaign_slug + "-" + loyalty, loyalty)
+            for loyalty in ["ACCUMULATOR", "STAMPS"]
+        ]
+    else:
+        runs = [(retailer_slug, campaign_slug, loyalty_type)]
+
+    engines = {"polaris": polaris_db_session.get_bind(), "carina": carina_db_session.get_bind()}
+    plans: dict[tuple[str, str], TablePlan] = {}
+    seconds = 0.0
+    calibrated = True
+    for run_retailer_slug, run_campaign_slug, run_loyalty_type in runs:
+        run_refund_window = None if run_loyalty_type == "STAMPS" else refund_window
+        retailer_config = polaris_db_session.scalar(
+            select(RetailerConfig).where(RetailerConfig.slug == run_retailer_slug)
+        )
+        # a retailer about to be bootstrapped gets a single campaign
+        active_campaigns = (
+            get_active_campaigns(vela_db_session, retailer_config, run_campaign_slug, run_loyalty_type)
+            if retailer_config
+            else [run_campaign_slug]
+        )
+        run_plans = expected_rows(
+            ah_to_create,
+            shard,
+            len(active_campaigns),
+            unallocated_rewards_to_create,
+            run_refund_window,
+            tx_history,
+            allocate_from_pool,
+        )
+        for table_plan in run_plans:
+            key = (table_plan.database, table_plan.table)
+            if key in plans:
+                plans[key].rows += table_plan.rows
+                plans[key].updated_rows += table_plan.updated_rows
+            else:
+                plans[key] = table_plan
+
+        if not retailer_config:
+            click.echo(f"Retailer {run_retailer_slug} does not exist yet, skipping the calibration batch.")
+            calibrated = False
+            continue
+
+        seconds_per_account_holder = _calibrate(
+            carina_db_session,
+            polaris_db_session,
+            vela_db_session,
+            retailer_config,
+            run_campaign_slug,
+            max_val,
+            run_refund_window,
+            tx_history,
+            run_loyalty_type,
+        )
+        seconds += seconds_per_account_holder * run_plans[0].rows
+
+    for table_plan in plans.values():
+        table_plan.bytes_per_row = _bytes_per_row(engines[table_plan.database], table_plan.table)
+
+    click.echo(f"\n{'table':<45}{'rows':>16}{'estimated size':>16}")
+    for table_plan in plans.values():
+        rows = f"{table_plan.rows:,.0f}" if table_plan.exact else f"~{table_plan.rows:,.0f}"
+        click.echo(f"{table_plan.database + '.' + table_plan.table:<45}{rows:>16}{_pretty_size(table_plan.size):>16}")
+
+    if allocate_from_pool:
+        reward_plan = plans["carina", Reward.__tablename__]
+        click.echo(
+            f"\nreward pool: {reward_plan.rows:,.0f} unallocated rewards created, {reward_plan.updated_rows:,.0f} "
+            f"of them claimed by the account holders."
+        )
+
+    total_size = sum(table_plan.size for table_plan in plans.values())
+    click.echo(f"\nestimated disk size: {_pretty_size(total_size)}")
+    # every new heap and index page is written to the WAL at least once
+    click.echo(f"estimated WAL: at least {_pretty_size(total_size)}")
+    if calibrated:
+        click.echo(
+            f"estimated duration: {seconds / 60:.1f} minutes, "
+            f"from a {CALIBRATION_ACCOUNT_HOLDERS} account holder calibration batch"
+        )
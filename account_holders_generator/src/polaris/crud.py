@@ -1,47 +1,50 @@
 import sys
 
-from datetime import datetime, timedelta, timezone
-from random import randint
-from typing import TYPE_CHECKING
-from uuid import uuid4
+from contextlib import contextmanager
+from functools import partial
+from typing import TYPE_CHECKING, Generator, Iterator, Sequence
 
 import click
 
-from hashids import Hashids
-from sqlalchemy import delete
+from sqlalchemy import BIGINT, String, delete, exists, func, insert, literal, true, update
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.future import select
 
 from account_holders_generator.src.carina.db import Retailer
-from account_holders_generator.src.enums import AccountHolderRewardStatuses, AccountHolderTypes
-
-from ..fixtures import (
-    ACCOUNT_HOLDER_REWARD_SWITCHER,
-    account_holder_marketing_preference_payload,
-    account_holder_payload,
-    account_holder_pending_reward_payload,
-    account_holder_profile_payload,
-    account_holder_reward_payload,
-    account_holder_transaction_history_payload,
-    generate_tx_rows,
-    retailer_config_payload,
-    reward_payload,
-)
+from account_holders_generator.src.enums import AccountHolderRewardStatuses, AccountHolderTypes, ServerSideTables
+
+from ..columnar import ColumnarBatch
+from ..fixtures import MARKETING_PREFERENCE_VALUES, account_holder_reward_batches, retailer_config_payload
+from ..loader import LoadTask
+from ..pg_copy import copy_batch
+from ..registry import BatchContext, build_batch
+from ..stages import stage
 from .db import (
     AccountHolder,
+    AccountHolderCampaignBalance,
     AccountHolderMarketingPreference,
     AccountHolderPendingReward,
     AccountHolderProfile,
     AccountHolderReward,
     AccountHolderTransactionHistory,
     RetailerConfig,
+    metadata,
 )
-from .utils import generate_account_holder_campaign_balances
+from .utils import GENERATED_EMAIL_PATTERN, generate_balance_expression
 
 if TYPE_CHECKING:
     from progressbar import ProgressBar
+    from sqlalchemy.engine import Connection, Row
     from sqlalchemy.orm import Session
+    from sqlalchemy.sql.dml import Insert
+    from sqlalchemy.sql.selectable import TableValuedAlias
 
     from ..carina.db import RewardConfig
+    from ..fixtures import ClaimRewards, RetailerSpec
+    from ..loader import ParallelLoader
+    from ..pools import FakeDataPools
+    from ..psycopg_backend import PsycopgBulkWriter
+    from ..staging import StagingLoader
 
 
 def get_retailer_by_slug(db_session: "Session", retailer_slug: str) -> RetailerConfig:
@@ -53,6 +56,25 @@ def get_retailer_by_slug(db_session: "Session", retailer_slug: str) -> RetailerC
     return retailer
 
 
+def retailer_config_exists(db_session: "Session", retailer_slug: str) -> bool:
+    return db_session.scalar(select(exists().where(RetailerConfig.slug == retailer_slug)))
+
+
+def _generated_table_names(
+    server_side_tables: frozenset[ServerSideTables], refund_window: int, tx_history: bool
+) -> list[str]:
+    table_names = [AccountHolder.__tablename__, AccountHolderProfile.__tablename__]
+    if ServerSideTables.MARKETING_PREFERENCE not in server_side_tables:
+        table_names.append(AccountHolderMarketingPreference.__tablename__)
+    if ServerSideTables.CAMPAIGN_BALANCE not in server_side_tables:
+        table_names.append(AccountHolderCampaignBalance.__tablename__)
+    if refund_window > 0:
+        table_names.append(AccountHolderPendingReward.__tablename__)
+    if tx_history:
+        table_names.append(AccountHolderTransactionHistory.__tablename__)
+    return table_names
+
+
 def batch_create_account_holders_and_rewards(
     *,
     db_session: "Session",
@@ -71,184 +93,325 @@ def batch_create_account_holders_and_rewards(
     tx_history: bool,
     reward_goal: int,
     loyalty_type: str,
-) -> tuple[int, list[dict]]:
+    server_side_tables: frozenset[ServerSideTables] = frozenset(),
+    staging_loader: "StagingLoader | None" = None,
+    fake_data_pools: "FakeDataPools | None" = None,
+    parallel_loader: "ParallelLoader | None" = None,
+    bulk_writer: "PsycopgBulkWriter | None" = None,
+    commit: bool = True,
+    claim_rewards: "ClaimRewards | None" = None,
+) -> tuple[int, ColumnarBatch]:
     if refund_window is None:
         refund_window = 0
-    account_holders_batch = []
-    account_holders_profile_batch = []
-    account_holders_marketing_batch = []
-    account_holder_balance_batch = []
-
-    account_holder_rewards_batch = []
-    matching_rewards_payloads_batch = []
-    account_holder_transaction_history_batch = []
-    batch_range = range(batch_start, batch_end, -1)
-
-    account_holders_batch = [
-        AccountHolder(**account_holder_payload(i, account_holder_type, retailer_config)) for i in batch_range
-    ]
-    db_session.add_all(account_holders_batch)
-    db_session.flush()
-
-    for account_holder, i in zip(account_holders_batch, batch_range):
-        if tx_history:
-            account_holder_transaction_history_batch.extend(
-                _generate_account_holder_transaction_history(account_holder, retailer_config, reward_goal, loyalty_type)
-            )
-        account_holder_balance_batch.extend(
-            generate_account_holder_campaign_balances(account_holder, active_campaigns, account_holder_type, max_val)
+    account_holder_ns = list(range(batch_start, batch_end, -1))
+
+    with stage("polaris_write"):
+        # ids come from the sequence up front so every table of the batch can be built and copied independently
+        if bulk_writer:
+            account_holder_ids = bulk_writer.reserve_ids("polaris", AccountHolder.__tablename__, len(account_holder_ns))
+        else:
+            account_holder_ids = reserve_account_holder_ids(db_session, len(account_holder_ns))
+
+    with stage("payload_build"):
+        context = BatchContext(
+            account_holder_ids,
+            account_holder_ns,
+            params={
+                "account_holder_type": account_holder_type,
+                "retailer_id": retailer_config.id,
+                "retailer_slug": retailer_config.slug,
+                "account_number_prefix": retailer_config.account_number_prefix,
+                "active_campaigns": active_campaigns,
+                "max_val": max_val,
+                "reward_slug": reward_config.reward_slug,
+                "refund_window": refund_window,
+                "reward_goal": reward_goal,
+                "loyalty_type": loyalty_type,
+            },
+            fake_data_pools=fake_data_pools,
         )
-        account_holders_profile_batch.append(AccountHolderProfile(**account_holder_profile_payload(account_holder)))
-        account_holders_marketing_batch.append(
-            AccountHolderMarketingPreference(**account_holder_marketing_preference_payload(account_holder))
+        batches = [
+            build_batch(table_name, context)
+            for table_name in _generated_table_names(server_side_tables, refund_window, tx_history)
+        ]
+
+        # polaris and carina reward rows share their uuids and codes, so they are built together
+        account_holder_rewards_batch, rewards_batch = account_holder_reward_batches(
+            account_holder_ids,
+            account_holder_ns,
+            account_holder_type_reward_code_salt,
+            reward_config,
+            retailer.id,
+            retailer_config.slug,
+            claim_rewards,
         )
-        account_holder_rewards, matching_rewards_payloads = _generate_account_holder_rewards(
-            i, account_holder, account_holder_type_reward_code_salt, reward_config, retailer, retailer_config
+        batches.append(account_holder_rewards_batch)
+
+    if bulk_writer:
+        with stage("polaris_write"):
+            bulk_writer.write(
+                "polaris",
+                batches,
+                _server_side_statements(
+                    server_side_tables, account_holder_ids, active_campaigns, account_holder_type, max_val
+                ),
+            )
+        with stage("carina_write"):
+            bulk_writer.write("carina", [rewards_batch])
+    elif parallel_loader:
+        # the reserved ids are not part of any transaction, the session only has to end its read
+        db_session.commit()
+        parallel_loader.load(
+            [
+                *(LoadTask("polaris", batch.table_name, partial(copy_batch, batch=batch)) for batch in batches),
+                *_server_side_create_tasks(
+                    server_side_tables, account_holder_ids, active_campaigns, account_holder_type, max_val
+                ),
+                LoadTask("carina", rewards_batch.table_name, partial(copy_batch, batch=rewards_batch)),
+            ]
         )
-        matching_rewards_payloads_batch.extend(matching_rewards_payloads)
-        account_holder_rewards_batch.extend(account_holder_rewards)
-        if refund_window > 0:
-            account_holder_pending_rewards = _generate_account_holder_pending_rewards(
-                i, account_holder, reward_config, retailer_config, active_campaigns, refund_window
+    else:
+        with stage("polaris_write"):
+            # account_holder is first in the list, so the rows its children reference always exist
+            for batch in batches:
+                if staging_loader:
+                    staging_loader.stage(batch)
+                else:
+                    copy_batch(db_session.connection(), batch)
+
+            _server_side_create_batch(
+                db_session, server_side_tables, account_holder_ids, active_campaigns, account_holder_type, max_val
             )
-            db_session.bulk_save_objects(account_holder_pending_rewards)
-        progress_counter += 1
-        bar.update(progress_counter)
-
-    db_session.bulk_save_objects(account_holder_transaction_history_batch)
-    db_session.bulk_save_objects(account_holders_profile_batch)
-    db_session.bulk_save_objects(account_holders_marketing_batch)
-    db_session.bulk_save_objects(account_holder_rewards_batch)
-    db_session.bulk_save_objects(account_holder_balance_batch)
-    db_session.commit()
+            if commit:
+                db_session.commit()
 
-    return progress_counter, matching_rewards_payloads_batch
+    progress_counter += len(account_holder_ns)
+    bar.update(progress_counter)
+    return progress_counter, rewards_batch
 
 
-def _generate_account_holder_rewards(
-    account_holder_n: int | str,
-    account_holder: AccountHolder,
-    batch_reward_salt: str,
-    reward_config: "RewardConfig",
-    retailer: Retailer,
-    retailer_config: RetailerConfig,
-) -> tuple[list[AccountHolderReward], list[dict]]:
-    hashids = Hashids(batch_reward_salt, min_length=15)
-
-    def _generate_rewards(
-        rewards_required: list[tuple[int, AccountHolderRewardStatuses]]
-    ) -> tuple[list[AccountHolderReward], list[dict]]:
-        account_holder_rewards: list[AccountHolderReward] = []
-        matching_rewards_payloads: list[dict] = []
-        for i, (how_many, reward_status) in enumerate(rewards_required):
-            if reward_status == AccountHolderRewardStatuses.PENDING:
-                continue
-            issue_date = datetime.now(tz=timezone.utc) - timedelta(days=14)
-            for reward_n in range(how_many):
-                reward_uuid = uuid4()
-                reward_code = hashids.encode(i, reward_n, account_holder_n)
-                reward_slug = reward_config.reward_slug
-                account_holder_rewards.append(
-                    AccountHolderReward(
-                        **account_holder_reward_payload(
-                            account_holder_id=account_holder.id,
-                            retailer_slug=retailer_config.slug,
-                            reward_uuid=reward_uuid,
-                            reward_code=reward_code,
-                            reward_slug=reward_slug,
-                            reward_status=reward_status,
-                            issue_date=issue_date,
-                        )
-                    )
-                )
-
-                matching_rewards_payloads.append(
-                    reward_payload(
-                        reward_uuid=reward_uuid,
-                        reward_code=reward_code,
-                        reward_config_id=reward_config.id,
-                        retailer_id=retailer.id,
-                    )
-                )
-
-        return account_holder_rewards, matching_rewards_payloads
-
-    account_holder_reward_type = int(account_holder_n) % 11
-    return _generate_rewards(ACCOUNT_HOLDER_REWARD_SWITCHER[account_holder_reward_type])
-
-
-def _generate_account_holder_pending_rewards(
-    account_holder_n: int | str,
-    account_holder: AccountHolder,
-    reward_config: "RewardConfig",
-    retailer_config: RetailerConfig,
+def _server_side_create_batch(
+    db_session: "Session",
+    server_side_tables: frozenset[ServerSideTables],
+    account_holder_ids: list[int],
     active_campaigns: list[str],
-    refund_window: int,
-) -> list[AccountHolderPendingReward]:
-    def _generate_pending_rewards(
-        pending_rewards_required: list[tuple[int, AccountHolderRewardStatuses]]
-    ) -> list[AccountHolderPendingReward]:
-        account_holder_pending_rewards: list[AccountHolderPendingReward] = []
-        for _, (how_many, reward_status) in enumerate(pending_rewards_required):
-            if reward_status != AccountHolderRewardStatuses.PENDING:
-                continue
-            for _ in range(how_many):
-                reward_slug = reward_config.reward_slug
-                account_holder_pending_rewards.append(
-                    AccountHolderPendingReward(
-                        **account_holder_pending_reward_payload(
-                            account_holder_id=account_holder.id,
-                            retailer_slug=retailer_config.slug,
-                            reward_slug=reward_slug,
-                            campaign_slug=active_campaigns[0],
-                            refund_window=refund_window,
-                            enqueued=False,
-                        )
-                    )
-                )
-
-        return account_holder_pending_rewards
-
-    account_holder_reward_type = int(account_holder_n) % 11
-    return _generate_pending_rewards(ACCOUNT_HOLDER_REWARD_SWITCHER[account_holder_reward_type])
-
-
-def _generate_account_holder_transaction_history(
-    account_holder: AccountHolder,
-    retailer_config: RetailerConfig,
-    reward_goal: int,
-    loyalty_type: str,
-) -> list[AccountHolderTransactionHistory]:
-    account_holder_transaction_history: list[AccountHolderTransactionHistory] = []
-    how_many = randint(1, 10)
-    tx_history_rows = generate_tx_rows(reward_goal, retailer_slug=retailer_config.slug)
-    for tx_history in tx_history_rows[:how_many]:
-        account_holder_transaction_history.append(
-            AccountHolderTransactionHistory(
-                **account_holder_transaction_history_payload(
-                    account_holder_id=account_holder.id,
-                    tx_amount=str(tx_history.tx_amount),
-                    location=tx_history.location,
-                    loyalty_type=loyalty_type,
-                )
+    account_holder_type: AccountHolderTypes,
+    max_val: int,
+) -> None:
+    for task in _server_side_create_tasks(
+        server_side_tables, account_holder_ids, active_campaigns, account_holder_type, max_val
+    ):
+        task.write(db_session.connection())
+
+
+def _server_side_create_tasks(
+    server_side_tables: frozenset[ServerSideTables],
+    account_holder_ids: list[int],
+    active_campaigns: list[str],
+    account_holder_type: AccountHolderTypes,
+    max_val: int,
+) -> list[LoadTask]:
+    tasks = []
+    if ServerSideTables.MARKETING_PREFERENCE in server_side_tables:
+        tasks.append(
+            LoadTask(
+                "polaris",
+                AccountHolderMarketingPreference.__tablename__,
+                partial(server_side_create_marketing_preferences, account_holder_ids=account_holder_ids),
             )
         )
+    if ServerSideTables.CAMPAIGN_BALANCE in server_side_tables:
+        tasks.append(
+            LoadTask(
+                "polaris",
+                AccountHolderCampaignBalance.__tablename__,
+                partial(
+                    server_side_create_campaign_balances,
+                    account_holder_ids=account_holder_ids,
+                    active_campaigns=active_campaigns,
+                    account_holder_type=account_holder_type,
+                    max_val=max_val,
+                ),
+            )
+        )
+    return tasks
+
+
+def _server_side_statements(
+    server_side_tables: frozenset[ServerSideTables],
+    account_holder_ids: list[int],
+    active_campaigns: list[str],
+    account_holder_type: AccountHolderTypes,
+    max_val: int,
+) -> list["Insert"]:
+    statements = []
+    if ServerSideTables.MARKETING_PREFERENCE in server_side_tables:
+        statements.append(marketing_preferences_insert(account_holder_ids))
+    if ServerSideTables.CAMPAIGN_BALANCE in server_side_tables:
+        statements.append(campaign_balances_insert(account_holder_ids, active_campaigns, account_holder_type, max_val))
+    return statements
+
+
+def reserve_account_holder_ids(db_session: "Session", how_many: int) -> list[int]:
+    sequence = func.pg_get_serial_sequence(AccountHolder.__tablename__, "id")
+    return (
+        db_session.execute(select(func.nextval(sequence)).select_from(func.generate_series(1, how_many)))
+        .scalars()
+        .all()
+    )
+
+
+def _account_holder_ids_table(account_holder_ids: list[int]) -> "TableValuedAlias":
+    # the whole batch travels as a single array parameter and is expanded by postgres
+    return func.unnest(literal(account_holder_ids, ARRAY(BIGINT))).table_valued("id")
+
+
+def marketing_preferences_insert(account_holder_ids: list[int]) -> "Insert":
+    ids = _account_holder_ids_table(account_holder_ids)
+    return insert(AccountHolderMarketingPreference).from_select(
+        ["account_holder_id", *MARKETING_PREFERENCE_VALUES],
+        select(ids.c.id, *(literal(value) for value in MARKETING_PREFERENCE_VALUES.values())),
+    )
+
+
+def server_side_create_marketing_preferences(connection: "Connection", account_holder_ids: list[int]) -> None:
+    connection.execute(marketing_preferences_insert(account_holder_ids))
+
+
+def campaign_balances_insert(
+    account_holder_ids: list[int], active_campaigns: list[str], account_holder_type: AccountHolderTypes, max_val: int
+) -> "Insert":
+    ids = _account_holder_ids_table(account_holder_ids)
+    campaigns = func.unnest(literal(active_campaigns, ARRAY(String))).table_valued("slug")
+    return insert(AccountHolderCampaignBalance).from_select(
+        ["account_holder_id", "campaign_slug", "balance"],
+        select(ids.c.id, campaigns.c.slug, generate_balance_expression(account_holder_type, max_val)).select_from(
+            ids.join(campaigns, true())
+        ),
+    )
 
-    return account_holder_transaction_history
 
+def server_side_create_campaign_balances(
+    connection: "Connection",
+    account_holder_ids: list[int],
+    active_campaigns: list[str],
+    account_holder_type: AccountHolderTypes,
+    max_val: int,
+) -> None:
+    connection.execute(campaign_balances_insert(account_holder_ids, active_campaigns, account_holder_type, max_val))
 
-def clear_existing_account_holders(db_session: "Session", retailer_id: int) -> None:
+
+def clear_existing_account_holders(db_session: "Session", retailer_id: int, commit: bool = True) -> None:
     db_session.execute(
         delete(AccountHolder)
         .where(
             AccountHolder.retailer_id == retailer_id,
-            AccountHolder.email.like(r"test_%_user_%@autogen.bpl"),
+            AccountHolder.email.like(GENERATED_EMAIL_PATTERN),
         )
         .execution_options(synchronize_session=False)
     )
+    if commit:
+        db_session.commit()
+
+
+def clear_existing_account_holders_slice(
+    db_session: "Session",
+    retailer_id: int,
+    account_holder_type: AccountHolderTypes,
+    first_n: int,
+    last_n: int,
+    commit: bool = True,
+) -> None:
+    account_holder_n = func.substring(AccountHolder.email, r"_user_(\d+)@").cast(BIGINT)
+    db_session.execute(
+        delete(AccountHolder)
+        .where(
+            AccountHolder.retailer_id == retailer_id,
+            AccountHolder.email.like(f"test_{account_holder_type.value}_user_%@autogen.bpl"),
+            account_holder_n.between(first_n, last_n),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    if commit:
+        db_session.commit()
+
+
+def get_max_generated_account_holder_n(db_session: "Session", retailer_id: int) -> int:
+    account_holder_n = func.substring(AccountHolder.email, r"_user_(\d+)@").cast(BIGINT)
+    return (
+        db_session.scalar(
+            select(func.max(account_holder_n)).where(
+                AccountHolder.retailer_id == retailer_id,
+                AccountHolder.email.like(GENERATED_EMAIL_PATTERN),
+            )
+        )
+        or 0
+    )
+
+
+def get_generated_account_holder_ids(db_session: "Session", retailer_id: int, limit: int) -> list[int]:
+    return list(
+        db_session.scalars(
+            select(AccountHolder.id)
+            .where(AccountHolder.retailer_id == retailer_id, AccountHolder.email.like(GENERATED_EMAIL_PATTERN))
+            .order_by(AccountHolder.id.desc())
+            .limit(limit)
+        )
+    )
+
+
+def stream_generated_account_holders(
+    connection: "Connection", retailer_id: int, chunk_size: int
+) -> Iterator[Sequence["Row"]]:
+    # server side cursor on a connection of its own, it survives the commits of the session writing the chunks
+    result = connection.execute(
+        select(AccountHolder.id, AccountHolder.email)
+        .where(AccountHolder.retailer_id == retailer_id, AccountHolder.email.like(GENERATED_EMAIL_PATTERN))
+        .order_by(AccountHolder.id)
+        .execution_options(yield_per=chunk_size)
+    )
+    yield from result.partitions()
+
+
+def replace_account_holders_rows(
+    db_session: "Session", table_names: list[str], account_holder_ids: list[int], batches: list[ColumnarBatch]
+) -> None:
+    for table_name in table_names:
+        table = metadata.tables[table_name]
+        db_session.execute(delete(table).where(table.c.account_holder_id.in_(account_holder_ids)))
+    for batch in batches:
+        copy_batch(db_session.connection(), batch)
     db_session.commit()
 
 
+def append_transactions(db_session: "Session", transactions_batch: ColumnarBatch) -> None:
+    copy_batch(db_session.connection(), transactions_batch)
+    db_session.commit()
+
+
+def redeem_issued_rewards(db_session: "Session", retailer_slug: str, how_many: int) -> int:
+    # rows locked by a concurrent redemption are skipped rather than waited on
+    issued_reward_ids = (
+        select(AccountHolderReward.id)
+        .where(
+            AccountHolderReward.retailer_slug == retailer_slug,
+            AccountHolderReward.status == AccountHolderRewardStatuses.ISSUED.value,
+            AccountHolderReward.expiry_date > func.now(),
+        )
+        .limit(how_many)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    redeemed = db_session.execute(
+        update(AccountHolderReward)
+        .where(AccountHolderReward.id.in_(issued_reward_ids))
+        .values(status=AccountHolderRewardStatuses.REDEEMED.value, redeemed_date=func.now())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db_session.commit()
+    return redeemed
+
+
 def setup_retailer_config(db_session: "Session", retailer_slug: str) -> None:
     db_session.execute(
         delete(AccountHolder)
@@ -260,3 +423,35 @@ def setup_retailer_config(db_session: "Session", retailer_slug: str) -> None:
     )
     db_session.add(RetailerConfig(**retailer_config_payload(retailer_slug)))
     db_session.commit()
+
+
+def bulk_setup_retailer_configs(db_session: "Session", retailer_specs: list["RetailerSpec"]) -> None:
+    retailer_slugs = [spec.retailer_slug for spec in retailer_specs]
+    existing_retailer_ids = select(RetailerConfig.id).where(RetailerConfig.slug.in_(retailer_slugs))
+    db_session.execute(
+        delete(AccountHolder)
+        .where(AccountHolder.retailer_id.in_(existing_retailer_ids))
+        .execution_options(synchronize_session=False)
+    )
+    db_session.execute(
+        delete(RetailerConfig)
+        .where(RetailerConfig.slug.in_(retailer_slugs))
+        .execution_options(synchronize_session=False)
+    )
+    db_session.execute(
+        insert(RetailerConfig), [retailer_config_payload(retailer_slug) for retailer_slug in retailer_slugs]
+    )
+    db_session.commit()
+
+
+@contextmanager
+def shard_setup_lock(db_session: "Session", retailer_slug: str) -> Generator[None, None, None]:
+    # session level advisory lock held on a dedicated connection, a session gives its connection back at every commit
+    # and NullPool closes it, releasing the lock with it
+    lock_key = func.hashtext(literal("bestla:") + retailer_slug)
+    with db_session.get_bind().connect() as connection:
+        connection.execute(select(func.pg_advisory_lock(lock_key)))
+        try:
+            yield
+        finally:
+            connection.execute(select(func.pg_advisory_unlock(lock_key)))
@@ -6,7 +6,7 @@ from sqlalchemy import BIGINT, Column, ForeignKey, create_engine
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import NullPool, QueuePool
 from sqlalchemy.sql.schema import MetaData
 
 from config import settings
@@ -67,8 +67,21 @@ class AccountHolderCampaignBalance(Base):
     account_holder_id = Column(BIGINT, ForeignKey("account_holder.id", ondelete="CASCADE"))
 
 
-def load_models(db_uri: str) -> "Session":
-    engine = create_engine(db_uri, poolclass=NullPool, echo=settings.SQL_DEBUG)
+# every table holding generated rows keyed on account_holder.id
+ACCOUNT_HOLDER_CHILD_MODELS = (
+    AccountHolderProfile,
+    AccountHolderMarketingPreference,
+    AccountHolderReward,
+    AccountHolderPendingReward,
+    AccountHolderTransactionHistory,
+    AccountHolderCampaignBalance,
+)
+
+
+def load_models(db_uri: str, pooled: bool = False) -> "Session":
+    engine = create_engine(
+        db_uri, poolclass=QueuePool if pooled else NullPool, pool_pre_ping=pooled, echo=settings.SQL_DEBUG
+    )
 
     Base.prepare(engine, reflect=True)
     return scoped_session(sessionmaker(bind=engine))
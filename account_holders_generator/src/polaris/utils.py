@@ -1,12 +1,17 @@
+import re
+
 from random import randint
 from typing import TYPE_CHECKING
 
+from sqlalchemy import Integer, func, literal
+
 from account_holders_generator.src.enums import AccountHolderTypes
 
+from ..registry import Derived, FKReference, SequenceNumber, TableSpec, register_table
 from .db import AccountHolderCampaignBalance
 
 if TYPE_CHECKING:
-    from .db import AccountHolder
+    from sqlalchemy.sql.elements import ColumnElement
 
 
 def generate_account_number(prefix: str, account_holder_type: AccountHolderTypes, account_holder_n: int) -> str:
@@ -32,19 +37,57 @@ def _generate_balance(account_holder_type: AccountHolderTypes, max_val: int) ->
     return value
 
 
-def generate_account_holder_campaign_balances(
-    account_holder: "AccountHolder", active_campaigns: list[str], account_holder_type: AccountHolderTypes, max_val: int
-) -> list[AccountHolderCampaignBalance]:
-    return [
-        AccountHolderCampaignBalance(
-            account_holder_id=account_holder.id,
-            campaign_slug=campaign,
-            balance=_generate_balance(account_holder_type, max_val),
-        )
-        for campaign in active_campaigns
-    ]
+def _random_int_expression(low: int, high: int) -> "ColumnElement":
+    return func.floor(func.random() * (high - low + 1)).cast(Integer) + low
+
+
+def generate_balance_expression(account_holder_type: AccountHolderTypes, max_val: int) -> "ColumnElement":
+    # server side equivalent of _generate_balance, evaluated once per row by postgres
+    if account_holder_type == AccountHolderTypes.ZERO_BALANCE:
+        return literal(0)
+
+    value = _random_int_expression(1, max_val) * 100
+    if account_holder_type == AccountHolderTypes.FLOAT_BALANCE:
+        value += _random_int_expression(1, 99)
+
+    return value
+
+
+register_table(
+    TableSpec(
+        AccountHolderCampaignBalance.__tablename__,
+        {
+            "_campaign_n": SequenceNumber(per_parent=True),
+            "account_holder_id": FKReference(),
+            "campaign_slug": Derived(
+                lambda rows: [rows.param("active_campaigns")[campaign_n] for campaign_n in rows.columns["_campaign_n"]]
+            ),
+            "balance": Derived(
+                lambda rows: [
+                    _generate_balance(rows.param("account_holder_type"), rows.param("max_val"))
+                    for _ in range(rows.size)
+                ]
+            ),
+        },
+        rows_per_parent=lambda context: [len(context.params["active_campaigns"])] * len(context.account_holder_ids),
+    )
+)
+
+
+GENERATED_EMAIL_PATTERN = r"test_%_user_%@autogen.bpl"
 
 
 def generate_email(account_holder_type: AccountHolderTypes, account_holder_n: int | str) -> str:
     account_holder_n = str(account_holder_n).rjust(2, "0")
     return f"test_{account_holder_type.value}_user_{account_holder_n}@autogen.bpl"
+
+
+GENERATED_EMAIL_REGEX = re.compile(r"^test_(\w+)_user_(\d+)@autogen\.bpl$")
+
+
+def parse_generated_email(email: str) -> tuple[AccountHolderTypes, int]:
+    # inverse of generate_email, the account holder type and number are only recorded in the email
+    match = GENERATED_EMAIL_REGEX.match(email)
+    if not match:
+        raise ValueError(f"{email} is not a generated account holder email")
+    return AccountHolderTypes(match[1]), int(match[2])
@@ -0,0 +1,128 @@
+import json
+import mmap
+import os
+import struct
+import sys
+
+from array import array
+from functools import cache
+from random import randint, randrange
+from typing import TYPE_CHECKING, Callable
+
+import click
+
+if TYPE_CHECKING:
+    from faker import Faker
+
+POOL_FILE_MAGIC = b"BESTLAP1"
+POOL_FILE_VERSION = 1
+_HEADER_LENGTH = struct.Struct("<Q")
+_ALIGNMENT = 8
+
+
+@cache
+def get_fake() -> "Faker":
+    # loading faker and its locale is the slowest import of the package, only pay for it when profiles are built
+    from faker import Faker
+
+    return Faker(["en-GB"])
+
+
+def fake_value_generators() -> dict[str, Callable[[], str]]:
+    fake = get_fake()
+    return {
+        "date_of_birth": fake.date,
+        "first_name": fake.first_name,
+        "last_name": fake.last_name,
+        "phone": lambda: ("0" if randint(0, 1) else "+44") + fake.msisdn(),
+        "street_address": fake.street_address,
+        "postcode": fake.postcode,
+        "city": fake.city,
+    }
+
+
+class StringPool:
+    # utf-8 strings laid out back to back in the mapped file, indexed by an array of end offsets
+    def __init__(self, data: memoryview, offsets: memoryview) -> None:
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return str(self.data[self.offsets[i] : self.offsets[i + 1]], "utf-8")
+
+    def sample(self, k: int) -> list[str]:
+        size = len(self)
+        return [self[randrange(size)] for _ in range(k)]
+
+
+def _padding(length: int) -> bytes:
+    return b"\0" * (-length % _ALIGNMENT)
+
+
+def build_pool_file(path: str, size: int, seed: int | None = None) -> dict[str, int]:
+    if seed is not None:
+        get_fake().seed_instance(seed)
+
+    header: dict = {"version": POOL_FILE_VERSION, "pools": {}}
+    sections: list[bytes] = []
+    position = 0
+    for name, fake_value in fake_value_generators().items():
+        encoded = [fake_value().encode() for _ in range(size)]
+        offsets = array("Q", [0])
+        for value in encoded:
+            offsets.append(offsets[-1] + len(value))
+        data = b"".join(encoded)
+        header["pools"][name] = {
+            "count": size,
+            "offsets": position,
+            "data": position + len(offsets) * offsets.itemsize,
+            "data_length": len(data),
+        }
+        section = offsets.tobytes() + data
+        sections.append(section + _padding(len(section)))
+        position += len(sections[-1])
+
+    encoded_header = json.dumps(header).encode()
+    encoded_header += _padding(len(POOL_FILE_MAGIC) + _HEADER_LENGTH.size + len(encoded_header))
+    # written aside and renamed, so workers mapping the previous file never see a partial one
+    with open(path + ".tmp", "wb") as pool_file:
+        pool_file.write(POOL_FILE_MAGIC + _HEADER_LENGTH.pack(len(encoded_header)) + encoded_header)
+        for section in sections:
+            pool_file.write(section)
+    os.replace(path + ".tmp", path)
+
+    return {name: pool["count"] for name, pool in header["pools"].items()}
+
+
+class FakeDataPools:
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as pool_file:
+            # read only shared mapping, every process using the same file shares the same page cache pages
+            self._mmap = mmap.mmap(pool_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(self._mmap)
+        if bytes(view[: len(POOL_FILE_MAGIC)]) != POOL_FILE_MAGIC:
+            click.echo(f"{path} is not a fake data pool file.")
+            sys.exit(-1)
+
+        (header_length,) = _HEADER_LENGTH.unpack_from(view, len(POOL_FILE_MAGIC))
+        sections_start = len(POOL_FILE_MAGIC) + _HEADER_LENGTH.size + header_length
+        header = json.loads(bytes(view[len(POOL_FILE_MAGIC) + _HEADER_LENGTH.size : sections_start]).rstrip(b"\0"))
+        if header["version"] != POOL_FILE_VERSION:
+            click.echo(f"unsupported pool file version {header['version']}, expected {POOL_FILE_VERSION}.")
+            sys.exit(-1)
+
+        self.pools: dict[str, StringPool] = {}
+        for name, pool in header["pools"].items():
+            offsets_start = sections_start + pool["offsets"]
+            data_start = sections_start + pool["data"]
+            self.pools[name] = StringPool(
+                view[data_start : data_start + pool["data_length"]],
+                view[offsets_start:data_start].cast("Q"),
+            )
+
+    def __getitem__(self, name: str) -> StringPool:
+        return self.pools[name]
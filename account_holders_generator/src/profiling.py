@@ -0,0 +1,56 @@
+import cProfile
+import io
+import os
+import pstats
+import threading
+
+import click
+
+PROFILE_TOP_N = 15
+
+
+class StageProfiler:
+    def __init__(self, output_dir: str, top_n: int = PROFILE_TOP_N) -> None:
+        self.output_dir = output_dir
+        self.top_n = top_n
+        self.profiles: dict[str, cProfile.Profile] = {}
+        self.active: list[str] = []
+        # cProfile only follows the thread that enabled it, stages entered by worker threads are not profiled
+        self.thread_id = threading.get_ident()
+
+    def stage_started(self, name: str) -> None:
+        if threading.get_ident() != self.thread_id:
+            return
+
+        # only one profiler can be enabled at a time, nested stages pause their parent
+        if self.active:
+            self.profiles[self.active[-1]].disable()
+        self.active.append(name)
+        self.profiles.setdefault(name, cProfile.Profile()).enable()
+
+    def stage_finished(self, name: str) -> None:
+        if threading.get_ident() != self.thread_id:
+            return
+
+        self.profiles[name].disable()
+        self.active.pop()
+        if self.active:
+            self.profiles[self.active[-1]].enable()
+
+    def dump(self) -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+        click.echo("\nprofiled stages:")
+        for name, profile in self.profiles.items():
+            file_name = os.path.join(self.output_dir, f"{name}.pstats")
+            profile.dump_stats(file_name)
+            total_time = pstats.Stats(profile).total_tt  # type: ignore[attr-defined]
+            click.echo(f"  {name:<20}{total_time:>10.2f}s  {file_name}")
+
+        if not self.profiles:
+            return
+
+        output = io.StringIO()
+        stats = pstats.Stats(*self.profiles.values(), stream=output)  # type: ignore[arg-type]
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(self.top_n)
+        click.echo(f"\ntop {self.top_n} functions by own time across all stages:")
+        click.echo(output.getvalue().rstrip())
@@ -0,0 +1,151 @@
+import sys
+
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from enum import Enum
+from typing import TYPE_CHECKING, Any, Callable, Sequence
+from uuid import UUID
+
+import click
+
+from sqlalchemy.dialects.postgresql.psycopg2 import PGDialect_psycopg2
+
+if TYPE_CHECKING:
+    from psycopg import Connection
+    from psycopg_pool import ConnectionPool
+    from sqlalchemy.sql import Executable
+
+    from .columnar import ColumnarBatch
+
+    CopyColumn = tuple[str, Callable[[Any], Any]]
+
+RESERVE_IDS_QUERY = "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)"
+COLUMN_TYPES_QUERY = (
+    "SELECT a.attname, t.typname, t.typtype, t.typcategory FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid "
+    "WHERE a.attrelid = CAST(%s AS regclass) AND a.attnum > 0 AND NOT a.attisdropped"
+)
+
+
+def _to_text(value: Any) -> str:
+    return value.value if isinstance(value, Enum) else str(value)
+
+
+def _to_uuid_bytes(value: Any) -> bytes:
+    # generated uuids are text, their 16 raw bytes are the uuid binary format without parsing a UUID object
+    return value.bytes if isinstance(value, UUID) else bytes.fromhex(value.replace("-", ""))
+
+
+def _to_date(value: Any) -> date:
+    return value if isinstance(value, date) else date.fromisoformat(value)
+
+
+def _to_timestamptz(value: datetime) -> datetime:
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def _to_timestamp(value: datetime) -> datetime:
+    # postgres ignores the offset of a timestamp without time zone, it is dropped the same way
+    return value.replace(tzinfo=None)
+
+
+def _to_decimal(value: Any) -> Decimal:
+    return Decimal(str(value))
+
+
+# binary COPY sends every value in the exact binary format of its column, the generated values are coerced to it
+CONVERTERS: dict[str, Callable[[Any], Any]] = {
+    "int2": int,
+    "int4": int,
+    "int8": int,
+    "numeric": _to_decimal,
+    "date": _to_date,
+    "timestamp": _to_timestamp,
+    "timestamptz": _to_timestamptz,
+}
+
+
+def _copy_column(typname: str, typtype: str, typcategory: str) -> "CopyColumn":
+    # enums and varchars are sent in the text binary format, which their receive functions accept
+    if typtype == "e" or typcategory == "S":
+        typname, convert = "text", _to_text
+    elif typname == "uuid":
+        # binary COPY carries no type oids, raw bytes dumped as bytea are read by the uuid column as is
+        typname, convert = "bytea", _to_uuid_bytes
+    else:
+        convert = CONVERTERS.get(typname, lambda value: value)
+
+    def convert_nullable(value: Any) -> Any:
+        return None if value is None else convert(value)
+
+    return typname, convert_nullable
+
+
+def _compile(statement: "Executable") -> tuple[str, dict[str, Any]]:
+    # psycopg 3 accepts the pyformat placeholders of the psycopg2 dialect, sqlalchemy 1.4 has no psycopg 3 dialect
+    compiled = statement.compile(dialect=PGDialect_psycopg2())
+    return str(compiled), compiled.params
+
+
+def _connection_pool(conninfo: str, pool_size: int) -> "ConnectionPool":
+    try:
+        from psycopg_pool import ConnectionPool  # pylint: disable=redefined-outer-name
+    except ImportError:
+        click.echo(
+            "--driver psycopg needs psycopg 3 and its pool, install them with: pip install 'psycopg[binary,pool]'"
+        )
+        sys.exit(-1)
+
+    return ConnectionPool(conninfo, min_size=1, max_size=pool_size)
+
+
+class PsycopgBulkWriter:
+    # writes the generated batches over psycopg 3 pooled connections kept open for the whole run, next to the
+    # sqlalchemy sessions that still do the lookups and cleanups
+    def __init__(self, conninfos: dict[str, str], pool_size: int = 2) -> None:
+        self.pools = {database: _connection_pool(conninfo, pool_size) for database, conninfo in conninfos.items()}
+        self._copy_columns_cache: dict[tuple[str, str], dict[str, "CopyColumn"]] = {}
+
+    def reserve_ids(self, database: str, table_name: str, how_many: int) -> list[int]:
+        with self.pools[database].connection() as connection:
+            return [
+                account_holder_id
+                for account_holder_id, in connection.execute(RESERVE_IDS_QUERY, (table_name, how_many), prepare=True)
+            ]
+
+    def _copy_columns(self, database: str, connection: "Connection", table_name: str) -> dict[str, "CopyColumn"]:
+        if (database, table_name) not in self._copy_columns_cache:
+            self._copy_columns_cache[database, table_name] = {
+                name: _copy_column(typname, typtype, typcategory)
+                for name, typname, typtype, typcategory in connection.execute(
+                    COLUMN_TYPES_QUERY, (table_name,), prepare=True
+                )
+            }
+        return self._copy_columns_cache[database, table_name]
+
+    def _copy(self, database: str, connection: "Connection", batch: "ColumnarBatch") -> None:
+        copy_columns = self._copy_columns(database, connection, batch.table_name)
+        types, converters = zip(*(copy_columns[name] for name in batch.column_names))
+        with connection.cursor() as cursor, cursor.copy(
+            f"COPY {batch.table_name} ({', '.join(batch.column_names)}) FROM STDIN WITH (FORMAT binary)"
+        ) as copy:
+            copy.set_types(list(types))
+            for row in batch.rows():
+                copy.write_row([convert(value) for convert, value in zip(converters, row)])
+
+    def write(self, database: str, batches: list["ColumnarBatch"], statements: Sequence["Executable"] = ()) -> None:
+        # a single transaction, committed when the connection goes back to the pool
+        with self.pools[database].connection() as connection:
+            for batch in batches:
+                if batch:
+                    self._copy(database, connection, batch)
+
+            if not statements:
+                return
+            # COPY cannot be pipelined, the remaining statements are sent without waiting for each other's results
+            with connection.pipeline(), connection.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(*_compile(statement))
+
+    def close(self) -> None:
+        for pool in self.pools.values():
+            pool.close()
@@ -0,0 +1,149 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from typing import TYPE_CHECKING, Any
+from uuid import UUID
+
+from sqlalchemy import String, func, select, true
+
+from .carina.crud import delete_rewards, get_reward_config_and_retailer
+from .carina.db import Reward
+from .columnar import ColumnarBatch, id_column
+from .pg_copy import copy_batch
+from .polaris.db import AccountHolderReward
+
+if TYPE_CHECKING:
+    from sqlalchemy.engine import Engine
+    from sqlalchemy.orm import Session
+    from sqlalchemy.sql.elements import ColumnElement
+
+# hex digits of the uuid added to the bucket key at every level, 256 buckets per level
+BUCKET_DIGITS = 2
+# the first uuid group, deeper keys would have to step over its hyphen
+MAX_BUCKET_DIGITS = 8
+# buckets this small are compared id by id instead of split further
+LEAF_ROWS = 5000
+REPAIR_CHUNK_SIZE = 10000
+
+
+@dataclass
+class RewardSide:
+    engine: "Engine"
+    uuid_column: "ColumnElement"
+    filters: list["ColumnElement"]
+
+    def _bucket_filters(self, prefix: str) -> list["ColumnElement"]:
+        if not prefix:
+            return self.filters
+
+        # uuid ranges rather than text prefixes, so that drilling down is served by the uuid indexes
+        first = int(prefix, 16) << (128 - 4 * len(prefix))
+        last = first + (1 << (128 - 4 * len(prefix))) - 1
+        return [*self.filters, self.uuid_column.between(UUID(int=first), UUID(int=last))]
+
+    def digests(self, prefix: str) -> dict[str, tuple[int, int]]:
+        # row count and order independent sum of hashes of every bucket one level below the prefix
+        bucket = func.substr(self.uuid_column.cast(String), 1, len(prefix) + BUCKET_DIGITS)
+        with self.engine.connect() as connection:
+            return {
+                key: (rows, digest)
+                for key, rows, digest in connection.execute(
+                    select(bucket, func.count(), func.sum(func.hashtext(self.uuid_column.cast(String))))
+                    .where(*self._bucket_filters(prefix))
+                    .group_by(bucket)
+                )
+            }
+
+    def uuids(self, prefix: str) -> set[str]:
+        with self.engine.connect() as connection:
+            return {
+                str(value)
+                for value in connection.execute(select(self.uuid_column).where(*self._bucket_filters(prefix))).scalars()
+            }
+
+
+@dataclass
+class ReconciliationReport:
+    buckets_compared: int = 0
+    buckets_differing: int = 0
+    # reward uuids only found on one side
+    polaris_only: list[str] = field(default_factory=list)
+    carina_only: list[str] = field(default_factory=list)
+
+
+def _compare(
+    executor: ThreadPoolExecutor, polaris: RewardSide, carina: RewardSide, prefix: str, report: ReconciliationReport
+) -> None:
+    polaris_digests, carina_digests = executor.map(partial(RewardSide.digests, prefix=prefix), (polaris, carina))
+    for key in sorted(polaris_digests.keys() | carina_digests.keys()):
+        report.buckets_compared += 1
+        polaris_digest, carina_digest = polaris_digests.get(key, (0, 0)), carina_digests.get(key, (0, 0))
+        if polaris_digest == carina_digest:
+            continue
+
+        report.buckets_differing += 1
+        if max(polaris_digest[0], carina_digest[0]) > LEAF_ROWS and len(key) < MAX_BUCKET_DIGITS:
+            _compare(executor, polaris, carina, key, report)
+            continue
+
+        polaris_uuids, carina_uuids = executor.map(partial(RewardSide.uuids, prefix=key), (polaris, carina))
+        report.polaris_only.extend(sorted(polaris_uuids - carina_uuids))
+        report.carina_only.extend(sorted(carina_uuids - polaris_uuids))
+
+
+def reconcile_rewards(
+    carina_db_session: "Session", polaris_db_session: "Session", retailer_slug: str
+) -> ReconciliationReport:
+    _, retailer = get_reward_config_and_retailer(carina_db_session, retailer_slug)
+    polaris = RewardSide(
+        polaris_db_session.get_bind(),
+        AccountHolderReward.reward_uuid,
+        [AccountHolderReward.retailer_slug == retailer_slug, AccountHolderReward.reward_uuid.isnot(None)],
+    )
+    # unallocated rewards have no account holder reward to match
+    carina = RewardSide(
+        carina_db_session.get_bind(), Reward.id, [Reward.retailer_id == retailer.id, Reward.allocated.is_(true())]
+    )
+    report = ReconciliationReport()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        _compare(executor, polaris, carina, "", report)
+    return report
+
+
+def _chunks(values: list[Any]) -> list[list[Any]]:
+    return [values[i : i + REPAIR_CHUNK_SIZE] for i in range(0, len(values), REPAIR_CHUNK_SIZE)]
+
+
+def repair_orphans(
+    carina_db_session: "Session", polaris_db_session: "Session", retailer_slug: str, report: ReconciliationReport
+) -> None:
+    reward_config, retailer = get_reward_config_and_retailer(carina_db_session, retailer_slug)
+    # polaris rewards are committed first, the carina rows a crash left out are recreated from them
+    for chunk in _chunks(report.polaris_only):
+        reward_uuids, codes = [], []
+        for reward_uuid, code in polaris_db_session.execute(
+            select(AccountHolderReward.reward_uuid, AccountHolderReward.code).where(
+                AccountHolderReward.reward_uuid.in_(chunk)
+            )
+        ):
+            reward_uuids.append(reward_uuid)
+            codes.append(code)
+        copy_batch(
+            carina_db_session.connection(),
+            ColumnarBatch(
+                Reward.__tablename__,
+                {
+                    "id": reward_uuids,
+                    "code": codes,
+                    "reward_config_id": id_column([reward_config.id] * len(codes)),
+                    "allocated": [True] * len(codes),
+                    "retailer_id": id_column([retailer.id] * len(codes)),
+                    "deleted": [False] * len(codes),
+                },
+            ),
+        )
+    # allocated carina rewards whose account holder is gone, e.g. after the polaris side was cleared
+    for chunk in _chunks(report.carina_only):
+        delete_rewards(carina_db_session, chunk, commit=False)
+    polaris_db_session.commit()
+    carina_db_session.commit()
@@ -0,0 +1,102 @@
+from typing import TYPE_CHECKING, Sequence
+
+from progressbar import ProgressBar, UnknownLength
+
+from .carina.crud import get_reward_config_and_retailer
+from .enums import AccountHolderTypes
+from .polaris.crud import get_retailer_by_slug, replace_account_holders_rows, stream_generated_account_holders
+from .polaris.utils import parse_generated_email
+from .registry import BatchContext, build_batch
+from .stages import stage
+from .vela.crud import get_active_campaigns, get_reward_rule
+
+if TYPE_CHECKING:
+    from sqlalchemy.engine import Row
+    from sqlalchemy.orm import Session
+
+    from .columnar import ColumnarBatch
+    from .polaris.db import RetailerConfig
+    from .pools import FakeDataPools
+
+
+def _build_batches(
+    partition: Sequence["Row"], table_names: list[str], params: dict, fake_data_pools: "FakeDataPools | None"
+) -> list["ColumnarBatch"]:
+    # balances and pending rewards depend on the account holder type and number, both are read back from the email
+    by_type: dict[AccountHolderTypes, tuple[list[int], list[int]]] = {}
+    for row in partition:
+        account_holder_type, account_holder_n = parse_generated_email(row.email)
+        account_holder_ids, account_holder_ns = by_type.setdefault(account_holder_type, ([], []))
+        account_holder_ids.append(row.id)
+        account_holder_ns.append(account_holder_n)
+
+    return [
+        build_batch(
+            table_name,
+            BatchContext(
+                account_holder_ids,
+                account_holder_ns,
+                params={**params, "account_holder_type": account_holder_type},
+                fake_data_pools=fake_data_pools,
+            ),
+        )
+        for account_holder_type, (account_holder_ids, account_holder_ns) in by_type.items()
+        for table_name in table_names
+    ]
+
+
+def _batch_params(
+    carina_db_session: "Session",
+    vela_db_session: "Session",
+    retailer_config: "RetailerConfig",
+    campaign_slug: str,
+    max_val: int,
+    refund_window: int,
+    loyalty_type: str,
+) -> dict:
+    reward_config, _ = get_reward_config_and_retailer(carina_db_session, retailer_config.slug)
+    return {
+        "retailer_id": retailer_config.id,
+        "retailer_slug": retailer_config.slug,
+        "account_number_prefix": retailer_config.account_number_prefix,
+        "active_campaigns": get_active_campaigns(vela_db_session, retailer_config, campaign_slug, loyalty_type),
+        "max_val": max_val,
+        "reward_slug": reward_config.reward_slug,
+        "refund_window": refund_window,
+        "reward_goal": get_reward_rule(vela_db_session, campaign_slug).reward_goal,
+        "loyalty_type": loyalty_type,
+    }
+
+
+def regenerate_tables(
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    vela_db_session: "Session",
+    retailer_slug: str,
+    campaign_slug: str,
+    max_val: int,
+    refund_window: int,
+    loyalty_type: str,
+    table_names: list[str],
+    chunk_size: int,
+    fake_data_pools: "FakeDataPools | None" = None,
+) -> int:
+    with stage("setup_lookups"):
+        retailer_config = get_retailer_by_slug(polaris_db_session, retailer_slug)
+        params = _batch_params(
+            carina_db_session, vela_db_session, retailer_config, campaign_slug, max_val, refund_window, loyalty_type
+        )
+
+    account_holders = 0
+    with polaris_db_session.get_bind().connect() as read_connection, ProgressBar(
+        max_value=UnknownLength
+    ) as progress_bar:
+        for partition in stream_generated_account_holders(read_connection, retailer_config.id, chunk_size):
+            with stage("payload_build"):
+                batches = _build_batches(partition, table_names, params, fake_data_pools)
+            # the old rows of the chunk are replaced in the same transaction as the new ones are copied in
+            with stage("polaris_write"):
+                replace_account_holders_rows(polaris_db_session, table_names, [row.id for row in partition], batches)
+            account_holders += len(partition)
+            progress_bar.update(account_holders)
+    return account_holders
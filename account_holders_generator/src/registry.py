@@ -0,0 +1,157 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from random import choices
+from typing import TYPE_CHECKING, Any, Callable, Iterable, MutableSequence, Protocol, Sequence
+
+from .columnar import ColumnarBatch, id_column
+from .pools import fake_value_generators
+
+if TYPE_CHECKING:
+    from array import array
+
+    from .pools import FakeDataPools
+
+
+@dataclass
+class BatchContext:
+    account_holder_ids: Sequence[int]
+    # only read by tables derived from the account holder number
+    account_holder_ns: Sequence[int] = ()
+    # run level values derived columns may read, e.g. retailer_slug or active_campaigns
+    params: dict[str, Any] = field(default_factory=dict)
+    fake_data_pools: "FakeDataPools | None" = None
+    now: datetime = field(default_factory=lambda: datetime.now(tz=timezone.utc).replace(microsecond=0))
+
+
+@dataclass
+class Rows:
+    batch: BatchContext
+    # position in the batch's account holders of the parent of every row
+    parent_index: "array"
+    columns: dict[str, MutableSequence] = field(default_factory=dict)
+
+    @property
+    def size(self) -> int:
+        return len(self.parent_index)
+
+    def param(self, name: str) -> Any:
+        return self.batch.params[name]
+
+
+class ColumnGenerator(Protocol):
+    def produce(self, rows: Rows) -> MutableSequence:
+        ...
+
+
+@dataclass(frozen=True)
+class Constant:
+    value: Any
+
+    def produce(self, rows: Rows) -> MutableSequence:
+        return [self.value] * rows.size
+
+
+@dataclass(frozen=True)
+class Param:
+    name: str
+
+    def produce(self, rows: Rows) -> MutableSequence:
+        return [rows.param(self.name)] * rows.size
+
+
+@dataclass(frozen=True)
+class SequenceNumber:
+    start: int = 0
+    # restart the count for every parent account holder instead of numbering the whole batch
+    per_parent: bool = False
+
+    def produce(self, rows: Rows) -> MutableSequence:
+        if not self.per_parent:
+            return id_column(range(self.start, self.start + rows.size))
+
+        values = id_column()
+        previous_parent, sequence_number = -1, self.start
+        for parent in rows.parent_index:
+            sequence_number = sequence_number + 1 if parent == previous_parent else self.start
+            values.append(sequence_number)
+            previous_parent = parent
+        return values
+
+
+@dataclass(frozen=True)
+class FKReference:
+    # BatchContext attribute holding the parent values, one per account holder of the batch
+    parent_values: str = "account_holder_ids"
+
+    def produce(self, rows: Rows) -> MutableSequence:
+        parent_values = getattr(rows.batch, self.parent_values)
+        return id_column(parent_values[i] for i in rows.parent_index)
+
+
+@dataclass(frozen=True)
+class WeightedChoice:
+    weights: dict[Any, float]
+
+    def produce(self, rows: Rows) -> MutableSequence:
+        return choices(list(self.weights), weights=list(self.weights.values()), k=rows.size)
+
+
+@dataclass(frozen=True)
+class FakePoolSample:
+    pool: str
+
+    def produce(self, rows: Rows) -> MutableSequence:
+        if rows.batch.fake_data_pools:
+            return rows.batch.fake_data_pools[self.pool].sample(rows.size)
+
+        fake_value = fake_value_generators()[self.pool]
+        return [fake_value() for _ in range(rows.size)]
+
+
+@dataclass(frozen=True)
+class Derived:
+    # computed from the rows and the columns declared before it
+    fn: Callable[[Rows], Iterable]
+
+    def produce(self, rows: Rows) -> MutableSequence:
+        values = self.fn(rows)
+        return values if isinstance(values, list) else list(values)
+
+
+@dataclass(frozen=True)
+class TableSpec:
+    table_name: str
+    # columns are produced in declaration order, names starting with "_" are scratch columns and are not written
+    columns: dict[str, ColumnGenerator]
+    # rows generated for each account holder of the batch, one each when not set
+    rows_per_parent: Callable[[BatchContext], Iterable[int]] | None = None
+
+
+def _parent_index(spec: TableSpec, context: BatchContext) -> "array":
+    if spec.rows_per_parent is None:
+        return id_column(range(len(context.account_holder_ids)))
+    return id_column(parent for parent, how_many in enumerate(spec.rows_per_parent(context)) for _ in range(how_many))
+
+
+def compile_table(spec: TableSpec) -> Callable[[BatchContext], ColumnarBatch]:
+    generators = list(spec.columns.items())
+    written = [name for name, _ in generators if not name.startswith("_")]
+
+    def produce(context: BatchContext) -> ColumnarBatch:
+        rows = Rows(context, _parent_index(spec, context))
+        for name, generator in generators:
+            rows.columns[name] = generator.produce(rows)
+        return ColumnarBatch(spec.table_name, {name: rows.columns[name] for name in written})
+
+    return produce
+
+
+TABLE_PRODUCERS: dict[str, Callable[[BatchContext], ColumnarBatch]] = {}
+
+
+def register_table(spec: TableSpec) -> None:
+    TABLE_PRODUCERS[spec.table_name] = compile_table(spec)
+
+
+def build_batch(table_name: str, context: BatchContext) -> ColumnarBatch:
+    return TABLE_PRODUCERS[table_name](context)
@@ -0,0 +1,318 @@
+import json
+import threading
+import traceback
+
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from typing import TYPE_CHECKING, Any
+from uuid import uuid4
+
+import click
+
+from .carina.crud import delete_retailer_rewards
+from .enums import FetchTypesEnum, LoyaltyTypes
+from .generator import generate_account_holders_and_rewards, generate_retailer_base_config
+from .polaris.crud import clear_existing_account_holders, get_retailer_by_slug
+from .pools import get_fake
+
+if TYPE_CHECKING:
+    from sqlalchemy.orm import Session
+
+    from .pools import FakeDataPools
+
+JOB_DEFAULTS: dict[str, dict[str, Any]] = {
+    "generate": {
+        "account_holders": 10,
+        "retailer": "test-retailer",
+        "campaign": "test-campaign-1",
+        "max_val": 100,
+        "loyalty_type": "ACCUMULATOR",
+        "unallocated_rewards": 10,
+        "refund_window": 0,
+        "tx_history": True,
+        "bootstrap": False,
+        "reward_slug": "10percentoff",
+        "fetch_type": "PRE_LOADED",
+    },
+    "top-up": {
+        "account_holders": 10,
+        "retailer": "test-retailer",
+        "campaign": "test-campaign-1",
+        "max_val": 100,
+        "loyalty_type": "ACCUMULATOR",
+        "refund_window": 0,
+        "tx_history": True,
+    },
+    "cleanup": {
+        "retailer": "test-retailer",
+    },
+}
+# parameters limited to a set of values on top of the type of their default
+JOB_CHOICES: dict[str, set[str]] = {
+    "loyalty_type": {loyalty_type.value for loyalty_type in LoyaltyTypes},
+    "fetch_type": {fetch_type.name for fetch_type in FetchTypesEnum},
+}
+JSON_TYPE_NAMES = {bool: "boolean", int: "whole number", str: "string"}
+# numbers are never negative, some have to be positive
+JOB_MINIMUMS = {"account_holders": 1}
+# jobs kept for the status endpoints, the oldest finished ones are dropped first
+MAX_FINISHED_JOBS = 1000
+
+
+def _now() -> str:
+    return datetime.now(tz=timezone.utc).isoformat()
+
+
+def _check_params(job_type: str, params: Any) -> None:
+    # checked before the job is queued, a bad value would otherwise only fail on the worker thread
+    if not isinstance(params, dict):
+        raise ValueError("params must be a JSON object.")
+    if unknown := set(params) - set(JOB_DEFAULTS[job_type]):
+        raise ValueError(f"unknown {job_type} parameters: {', '.join(sorted(unknown))}.")
+
+    for name, value in params.items():
+        default = JOB_DEFAULTS[job_type][name]
+        # a JSON true is a python int as well, so booleans are told apart from numbers explicitly
+        if not isinstance(value, type(default)) or isinstance(value, bool) != isinstance(default, bool):
+            raise ValueError(f"{name} must be a {JSON_TYPE_NAMES[type(default)]}, got {json.dumps(value)}.")
+        if name in JOB_CHOICES and value not in JOB_CHOICES[name]:
+            raise ValueError(f"{name} must be one of {', '.join(sorted(JOB_CHOICES[name]))}, got {value}.")
+        minimum = JOB_MINIMUMS.get(name, 0)
+        if isinstance(value, int) and not isinstance(value, bool) and value < minimum:
+            raise ValueError(f"{name} must be at least {minimum}, got {value}.")
+
+
+@dataclass
+class JobTimes:
+    created_at: str = field(default_factory=_now)
+    started_at: str | None = None
+    finished_at: str | None = None
+
+
+@dataclass
+class Job:
+    type: str
+    params: dict[str, Any]
+    job_id: str = field(default_factory=lambda: str(uuid4()))
+    status: str = "queued"
+    error: str | None = None
+    times: JobTimes = field(default_factory=JobTimes)
+    finished: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "id": self.job_id,
+            "type": self.type,
+            "params": self.params,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.times.created_at,
+            "started_at": self.times.started_at,
+            "finished_at": self.times.finished_at,
+        }
+
+
+@dataclass(frozen=True)
+class DbSessions:
+    carina: "Session"
+    polaris: "Session"
+    vela: "Session"
+
+    def rollback(self) -> None:
+        self.polaris.rollback()
+        self.carina.rollback()
+        self.vela.rollback()
+
+
+class GeneratorService:
+    # jobs run one at a time on a single worker thread, which owns the warm sessions
+    def __init__(
+        self,
+        carina_db_session: "Session",
+        polaris_db_session: "Session",
+        vela_db_session: "Session",
+        fake_data_pools: "FakeDataPools | None",
+    ) -> None:
+        self.sessions = DbSessions(carina_db_session, polaris_db_session, vela_db_session)
+        self.fake_data_pools = fake_data_pools
+        self.jobs: dict[str, Job] = {}
+        self.queue: Queue[Job] = Queue()
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._work, name="generator-worker", daemon=True)
+
+    def start(self) -> None:
+        if not self.fake_data_pools:
+            # loads the faker locale now rather than during the first job
+            get_fake()
+        self._worker.start()
+
+    def submit(self, job_type: str, params: dict[str, Any]) -> Job:
+        if not isinstance(job_type, str) or job_type not in JOB_DEFAULTS:
+            raise ValueError(f"unknown job type {job_type}, expected one of {', '.join(JOB_DEFAULTS)}.")
+        _check_params(job_type, params)
+
+        job = Job(job_type, {**JOB_DEFAULTS[job_type], **params})
+        with self._lock:
+            self.jobs[job.job_id] = job
+            self._forget_finished_jobs()
+        self.queue.put(job)
+        return job
+
+    def _forget_finished_jobs(self) -> None:
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished.is_set()]
+        for job_id in finished[: max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def all_jobs(self) -> list[Job]:
+        with self._lock:
+            return list(self.jobs.values())
+
+    def _work(self) -> None:
+        while True:
+            job = self.queue.get()
+            job.status, job.times.started_at = "running", _now()
+            try:
+                getattr(self, "_run_" + job.type.replace("-", "_"))(**job.params)
+                job.status = "done"
+            # generation reports bad input with click.echo and sys.exit, that must not stop the worker
+            except (Exception, SystemExit):  # pylint: disable=broad-except
+                self.sessions.rollback()
+                job.status, job.error = "failed", traceback.format_exc(limit=5)
+            finally:
+                job.times.finished_at = _now()
+                job.finished.set()
+
+    def _run_generate(
+        self,
+        account_holders: int,
+        retailer: str,
+        campaign: str,
+        max_val: int,
+        loyalty_type: str,
+        unallocated_rewards: int,
+        refund_window: int,
+        tx_history: bool,
+        bootstrap: bool,
+        reward_slug: str,
+        fetch_type: str,
+    ) -> None:
+        if bootstrap:
+            generate_retailer_base_config(
+                self.sessions.carina,
+                self.sessions.polaris,
+                self.sessions.vela,
+                retailer,
+                campaign,
+                reward_slug,
+                refund_window,
+                fetch_type,
+                loyalty_type,
+            )
+        generate_account_holders_and_rewards(
+            self.sessions.carina,
+            self.sessions.polaris,
+            self.sessions.vela,
+            account_holders,
+            retailer,
+            campaign,
+            max_val,
+            unallocated_rewards,
+            refund_window,
+            tx_history,
+            loyalty_type,
+            fake_data_pools=self.fake_data_pools,
+        )
+
+    def _run_top_up(
+        self,
+        account_holders: int,
+        retailer: str,
+        campaign: str,
+        max_val: int,
+        loyalty_type: str,
+        refund_window: int,
+        tx_history: bool,
+    ) -> None:
+        generate_account_holders_and_rewards(
+            self.sessions.carina,
+            self.sessions.polaris,
+            self.sessions.vela,
+            account_holders,
+            retailer,
+            campaign,
+            max_val,
+            0,
+            refund_window,
+            tx_history,
+            loyalty_type,
+            fake_data_pools=self.fake_data_pools,
+            top_up=True,
+        )
+
+    def _run_cleanup(self, retailer: str) -> None:
+        retailer_config = get_retailer_by_slug(self.sessions.polaris, retailer)
+        clear_existing_account_holders(self.sessions.polaris, retailer_config.id)
+        delete_retailer_rewards(self.sessions.carina, retailer)
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    service: GeneratorService
+
+    def _respond(self, status: HTTPStatus, payload: Any) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        path = self.path.rstrip("/")
+        if path == "/health":
+            self._respond(HTTPStatus.OK, {"status": "ok", "queued": self.service.queue.qsize()})
+        elif path == "/jobs":
+            self._respond(HTTPStatus.OK, [job.to_dict() for job in self.service.all_jobs()])
+        elif path.startswith("/jobs/") and (job := self.service.get(path.removeprefix("/jobs/"))):
+            self._respond(HTTPStatus.OK, job.to_dict())
+        else:
+            self._respond(HTTPStatus.NOT_FOUND, {"error": "not found"})
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        if self.path.rstrip("/") != "/jobs":
+            self._respond(HTTPStatus.NOT_FOUND, {"error": "not found"})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            job = self.service.submit(request.pop("type", "generate"), request.pop("params", {}))
+        except (ValueError, AttributeError) as ex:
+            self._respond(HTTPStatus.BAD_REQUEST, {"error": str(ex)})
+            return
+
+        # "wait": true answers once the job has finished, small datasets are then usable as soon as the reply arrives
+        if request.get("wait"):
+            job.finished.wait()
+            self._respond(HTTPStatus.OK if job.status == "done" else HTTPStatus.INTERNAL_SERVER_ERROR, job.to_dict())
+        else:
+            self._respond(HTTPStatus.ACCEPTED, job.to_dict())
+
+    def log_message(self, format: str, *args: Any) -> None:  # pylint: disable=redefined-builtin
+        click.echo(f"{self.address_string()} - {format % args}", err=True)
+
+
+def serve(service: GeneratorService, host: str, port: int) -> None:
+    handler = type("BoundJobRequestHandler", (JobRequestHandler,), {"service": service})
+    service.start()
+    with ThreadingHTTPServer((host, port), handler) as server:
+        click.echo(f"Generator service listening on http://{host}:{port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            click.echo("\nShutting down, queued jobs are dropped.")
@@ -0,0 +1,30 @@
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class Shard:
+    index: int
+    count: int
+
+    @classmethod
+    def parse(cls, value: str) -> "Shard":
+        try:
+            index, count = (int(part) for part in value.split("/"))
+        except ValueError as ex:
+            raise ValueError(f"'{value}' is not in the k/N format.") from ex
+
+        if not 0 < index <= count:
+            raise ValueError(f"shard index must be between 1 and {count}, got {index}.")
+
+        return cls(index, count)
+
+    @property
+    def is_sharded(self) -> bool:
+        return self.count > 1
+
+    def slice(self, total: int) -> tuple[int, int]:
+        # 1-based inclusive range owned by this shard, the last shard absorbs the remainder
+        return total * (self.index - 1) // self.count + 1, total * self.index // self.count
+
+
+NO_SHARDING = Shard(1, 1)
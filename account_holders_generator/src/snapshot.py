@@ -0,0 +1,395 @@
+import gzip
+import json
+import os
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Callable
+
+import click
+
+from sqlalchemy import BIGINT, Text, case, cast, delete, func, insert, literal, select, text, true
+from sqlalchemy.dialects.postgresql import BIT, UUID
+from sqlalchemy.sql import column, table
+
+from .carina.crud import get_reward_config_and_retailer
+from .carina.db import Reward
+from .ids import random_salt
+from .pg_copy import copy_into, copy_query_to, create_staging_table
+from .polaris.crud import clear_existing_account_holders, get_retailer_by_slug
+from .polaris.db import ACCOUNT_HOLDER_CHILD_MODELS, AccountHolder, AccountHolderTransactionHistory
+from .polaris.utils import GENERATED_EMAIL_PATTERN
+from .vela.crud import get_retailer_campaign_slugs
+
+if TYPE_CHECKING:
+    from sqlalchemy.engine import Connection, Engine
+    from sqlalchemy.orm import Session
+    from sqlalchemy.sql import Delete, Select
+    from sqlalchemy.sql.elements import ColumnElement
+    from sqlalchemy.sql.selectable import TableClause
+
+    ColumnRemap = dict[str, Callable[["ColumnElement"], "ColumnElement"]]
+
+SNAPSHOT_VERSION = 1
+MANIFEST_FILE_NAME = "manifest.json"
+# unique values restored as fresh ones, so that a bundle can be restored next to its source retailer or more than once
+REGENERATED_COLUMNS = {
+    "account_holder": ("account_holder_uuid", "opt_out_token"),
+    "account_holder_reward": ("reward_uuid", "idempotency_token"),
+    "account_holder_pending_reward": ("pending_reward_uuid", "idempotency_token"),
+    "reward": ("id",),
+}
+
+
+@dataclass
+class SnapshotTable:
+    database: str
+    table: str
+    columns: list[str]
+    rows: int
+    file: str
+
+
+@dataclass
+class SnapshotManifest:
+    version: int
+    created_at: str
+    retailer_slug: str
+    campaign_slugs: list[str]
+    tables: list[SnapshotTable]
+
+    @classmethod
+    def load(cls, bundle_dir: str) -> "SnapshotManifest":
+        with open(os.path.join(bundle_dir, MANIFEST_FILE_NAME), encoding="utf-8") as manifest_file:
+            payload = json.load(manifest_file)
+
+        if payload["version"] != SNAPSHOT_VERSION:
+            click.echo(f"unsupported snapshot version {payload['version']}, expected {SNAPSHOT_VERSION}.")
+            sys.exit(-1)
+
+        payload["tables"] = [SnapshotTable(**snapshot_table) for snapshot_table in payload["tables"]]
+        return cls(**payload)
+
+    def dump(self, bundle_dir: str) -> None:
+        with open(os.path.join(bundle_dir, MANIFEST_FILE_NAME), "w", encoding="utf-8") as manifest_file:
+            json.dump(asdict(self), manifest_file, indent=2)
+
+    def get_table(self, database: str, table_name: str) -> SnapshotTable | None:
+        return next((t for t in self.tables if t.database == database and t.table == table_name), None)
+
+
+def _copied_columns(model: type) -> list[str]:
+    # serial primary keys are left to the target sequences, account_holder ids are remapped instead
+    return [
+        col.name
+        for col in model.__table__.columns
+        if model is AccountHolder or not (col.primary_key and col.server_default is not None)
+    ]
+
+
+def _dump_table(
+    engine: "Engine", bundle_dir: str, database: str, model: type, columns: list[str], query: "Select"
+) -> SnapshotTable:
+    file_name = f"{database}.{model.__tablename__}.copy.gz"
+    with engine.connect() as connection, gzip.open(os.path.join(bundle_dir, file_name), "wb") as fileobj:
+        rows = copy_query_to(connection, query, fileobj)
+
+    return SnapshotTable(database, model.__tablename__, columns, rows, file_name)
+
+
+def create_snapshot(
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    vela_db_session: "Session",
+    retailer_slug: str,
+    bundle_dir: str,
+    jobs: int,
+) -> SnapshotManifest:
+    retailer_config = get_retailer_by_slug(polaris_db_session, retailer_slug)
+    _, retailer = get_reward_config_and_retailer(carina_db_session, retailer_slug)
+    os.makedirs(bundle_dir, exist_ok=True)
+
+    generated_account_holder_ids = select(AccountHolder.id).where(
+        AccountHolder.retailer_id == retailer_config.id, AccountHolder.email.like(GENERATED_EMAIL_PATTERN)
+    )
+    dumps: list[tuple["Engine", str, type, "Select"]] = [
+        (
+            polaris_db_session.get_bind(),
+            "polaris",
+            AccountHolder,
+            select(AccountHolder.__table__).where(AccountHolder.id.in_(generated_account_holder_ids)),
+        ),
+        (
+            carina_db_session.get_bind(),
+            "carina",
+            Reward,
+            # the unallocated pool is not part of the generated account holders and stays with each database
+            select(Reward.__table__).where(Reward.retailer_id == retailer.id, Reward.allocated.is_(true())),
+        ),
+    ]
+    dumps.extend(
+        (
+            polaris_db_session.get_bind(),
+            "polaris",
+            model,
+            select(model.__table__).where(model.account_holder_id.in_(generated_account_holder_ids)),
+        )
+        for model in ACCOUNT_HOLDER_CHILD_MODELS
+    )
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for engine, database, model, query in dumps:
+            columns = _copied_columns(model)
+            query = query.with_only_columns(*(model.__table__.c[col] for col in columns))
+            futures.append(executor.submit(_dump_table, engine, bundle_dir, database, model, columns, query))
+
+        tables = [future.result() for future in futures]
+
+    manifest = SnapshotManifest(
+        version=SNAPSHOT_VERSION,
+        created_at=datetime.now(tz=timezone.utc).isoformat(),
+        retailer_slug=retailer_slug,
+        campaign_slugs=get_retailer_campaign_slugs(vela_db_session, retailer_slug),
+        tables=tables,
+    )
+    manifest.dump(bundle_dir)
+    return manifest
+
+
+def _stage_snapshot_table(connection: "Connection", bundle_dir: str, snapshot_table: SnapshotTable) -> "TableClause":
+    staging_table_name = f"snapshot_{snapshot_table.table}"
+    create_staging_table(connection, staging_table_name, snapshot_table.table, snapshot_table.columns)
+    with gzip.open(os.path.join(bundle_dir, snapshot_table.file), "rb") as fileobj:
+        copy_into(connection, staging_table_name, snapshot_table.columns, fileobj)
+
+    return table(staging_table_name, *(column(col) for col in snapshot_table.columns))
+
+
+def _regenerated_columns(table_name: str, salt: str) -> "ColumnRemap":
+    # md5 of the salt and the old value, the same new uuid wherever the old one appears, so that the reward uuids
+    # restored into polaris still match the reward ids restored into carina
+    return {
+        column_name: lambda col: cast(func.md5(literal(salt) + cast(col, Text)), UUID)
+        for column_name in REGENERATED_COLUMNS.get(table_name, ())
+    }
+
+
+def _regenerated_account_number(account_number_prefix: str, salt: str) -> Callable[["ColumnElement"], "ColumnElement"]:
+    # the target's prefix followed by 16 digits drawn from the md5 of the salt and the old number, generated retailers
+    # share their prefix, so a new prefix alone would not keep a restore apart from its source retailer
+    return lambda col: literal(account_number_prefix) + func.lpad(
+        cast(cast(cast(literal("x") + func.left(func.md5(literal(salt) + col), 13), BIT(52)), BIGINT), Text), 16, "0"
+    )
+
+
+def _insert_staged(
+    connection: "Connection",
+    model: type,
+    staged: "TableClause",
+    columns: list[str],
+    remap: "ColumnRemap",
+    *whereclause: "ColumnElement",
+) -> int:
+    result = connection.execute(
+        insert(model.__table__).from_select(
+            columns,
+            select(*(remap[col](staged.c[col]) if col in remap else staged.c[col] for col in columns)).where(
+                *whereclause
+            ),
+        )
+    )
+    return result.rowcount
+
+
+def _allocated_rewards_delete(retailer_id: int) -> "Delete":
+    return delete(Reward).where(Reward.retailer_id == retailer_id, Reward.allocated.is_(true()))
+
+
+def _restore_account_holders(
+    engine: "Engine",
+    bundle_dir: str,
+    snapshot_table: SnapshotTable,
+    retailer_id: int,
+    account_number_prefix: str,
+    salt: str,
+) -> tuple[int, int]:
+    with engine.connect() as connection, connection.begin():
+        # keeps other writers from drawing ids out of the block reserved below
+        connection.execute(text("LOCK TABLE account_holder IN SHARE ROW EXCLUSIVE MODE"))
+        staged = _stage_snapshot_table(connection, bundle_dir, snapshot_table)
+        min_id, max_id = connection.execute(select(func.min(staged.c.id), func.max(staged.c.id))).one()
+        if min_id is None:
+            return 0, 0
+
+        span = max_id - min_id + 1
+        sequence = func.pg_get_serial_sequence("account_holder", "id")
+        first_id = connection.execute(
+            select(func.setval(sequence, func.nextval(sequence) + span - 1) - span + 1)
+        ).scalar_one()
+        id_offset = first_id - min_id
+        rows = _insert_staged(
+            connection,
+            AccountHolder,
+            staged,
+            snapshot_table.columns,
+            {
+                **_regenerated_columns(AccountHolder.__tablename__, salt),
+                "id": lambda col: col + id_offset,
+                "retailer_id": lambda _: literal(retailer_id),
+                "account_number": _regenerated_account_number(account_number_prefix, salt),
+            },
+        )
+
+    return rows, id_offset
+
+
+def _restore_account_holder_child(
+    engine: "Engine",
+    bundle_dir: str,
+    snapshot_table: SnapshotTable,
+    model: type,
+    id_offset: int,
+    retailer_slug: str,
+    salt: str,
+) -> int:
+    with engine.connect() as connection, connection.begin():
+        staged = _stage_snapshot_table(connection, bundle_dir, snapshot_table)
+        remap: "ColumnRemap" = {
+            **_regenerated_columns(model.__tablename__, salt),
+            "account_holder_id": lambda col: col + id_offset,
+            "retailer_slug": lambda _: literal(retailer_slug),
+        }
+        if model is AccountHolderTransactionHistory:
+            # generated, appended and older transaction ids all start with the account holder id, whatever follows
+            # it, the id is moved along with the account holder and ids starting with anything else are kept
+            old_id = cast(staged.c.account_holder_id, Text)
+            remap["transaction_id"] = lambda col: case(
+                (
+                    func.left(col, func.length(old_id)) == old_id,
+                    func.concat(
+                        cast(staged.c.account_holder_id + id_offset, Text), func.substr(col, func.length(old_id) + 1)
+                    ),
+                ),
+                else_=col,
+            )
+
+        return _insert_staged(connection, model, staged, snapshot_table.columns, remap)
+
+
+def _restore_rewards(
+    engine: "Engine",
+    bundle_dir: str,
+    snapshot_table: SnapshotTable,
+    retailer_id: int,
+    reward_config_id: int,
+    salt: str,
+) -> int:
+    with engine.connect() as connection, connection.begin():
+        # the rewards of the account holders the restore replaces, the unallocated pool is left alone
+        connection.execute(_allocated_rewards_delete(retailer_id))
+        staged = _stage_snapshot_table(connection, bundle_dir, snapshot_table)
+        return _insert_staged(
+            connection,
+            Reward,
+            staged,
+            snapshot_table.columns,
+            {
+                **_regenerated_columns(Reward.__tablename__, salt),
+                "retailer_id": lambda _: literal(retailer_id),
+                "reward_config_id": lambda _: literal(reward_config_id),
+            },
+            # bundles snapshotted before the pool was left out of them
+            staged.c.allocated.is_(true()),
+        )
+
+
+def _clear_restored_rows(
+    carina_db_session: "Session", polaris_db_session: "Session", retailer_config_id: int, retailer_id: int
+) -> None:
+    clear_existing_account_holders(polaris_db_session, retailer_config_id)
+    carina_db_session.execute(_allocated_rewards_delete(retailer_id).execution_options(synchronize_session=False))
+    carina_db_session.commit()
+
+
+def restore_snapshot(
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    vela_db_session: "Session",
+    bundle_dir: str,
+    retailer_slug: str | None,
+    jobs: int,
+) -> None:
+    manifest = SnapshotManifest.load(bundle_dir)
+    retailer_slug = retailer_slug or manifest.retailer_slug
+    retailer_config = get_retailer_by_slug(polaris_db_session, retailer_slug)
+    reward_config, retailer = get_reward_config_and_retailer(carina_db_session, retailer_slug)
+    if missing_campaigns := set(manifest.campaign_slugs) - set(
+        get_retailer_campaign_slugs(vela_db_session, retailer_slug)
+    ):
+        click.echo(f"campaigns not active in Vela for '{retailer_slug}': {', '.join(sorted(missing_campaigns))}.")
+
+    click.echo("Deleting previously generated account holders for requested retailer.")
+    clear_existing_account_holders(polaris_db_session, retailer_config.id)
+    polaris_engine = polaris_db_session.get_bind()
+    salt = random_salt()
+
+    # every table is restored in a transaction of its own, a failure part way removes what was already restored on
+    # both sides rather than leave rewards without account holders or the other way round
+    try:
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            futures = []
+            if reward_table := manifest.get_table("carina", Reward.__tablename__):
+                futures.append(
+                    (
+                        reward_table,
+                        executor.submit(
+                            _restore_rewards,
+                            carina_db_session.get_bind(),
+                            bundle_dir,
+                            reward_table,
+                            retailer.id,
+                            reward_config.id,
+                            salt,
+                        ),
+                    )
+                )
+
+            # every other polaris table references account_holder, so it has to be committed first
+            account_holder_table = manifest.get_table("polaris", AccountHolder.__tablename__)
+            if account_holder_table:
+                rows, id_offset = _restore_account_holders(
+                    polaris_engine,
+                    bundle_dir,
+                    account_holder_table,
+                    retailer_config.id,
+                    retailer_config.account_number_prefix,
+                    salt,
+                )
+                click.echo(f"restored {rows} rows into polaris.{account_holder_table.table}.")
+                for model in ACCOUNT_HOLDER_CHILD_MODELS:
+                    if child_table := manifest.get_table("polaris", model.__tablename__):
+                        futures.append(
+                            (
+                                child_table,
+                                executor.submit(
+                                    _restore_account_holder_child,
+                                    polaris_engine,
+                                    bundle_dir,
+                                    child_table,
+                                    model,
+                                    id_offset,
+                                    retailer_slug,
+                                    salt,
+                                ),
+                            )
+                        )
+
+            for snapshot_table, future in futures:
+                click.echo(f"restored {future.result()} rows into {snapshot_table.database}.{snapshot_table.table}.")
+    except BaseException:
+        click.echo("restore failed, deleting the rows restored so far.")
+        _clear_restored_rows(carina_db_session, polaris_db_session, retailer_config.id, retailer.id)
+        raise
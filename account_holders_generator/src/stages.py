@@ -0,0 +1,80 @@
+import threading
+
+from contextlib import contextmanager
+from typing import Generator, Protocol
+
+
+class StageListener(Protocol):
+    def stage_started(self, name: str) -> None:
+        ...
+
+    def stage_finished(self, name: str) -> None:
+        ...
+
+
+_listeners: list[StageListener] = []
+_local = threading.local()
+
+
+def add_stage_listener(listener: StageListener) -> None:
+    _listeners.append(listener)
+
+
+def remove_stage_listener(listener: StageListener) -> None:
+    _listeners.remove(listener)
+
+
+def current_stage() -> str | None:
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else None
+
+
+def stage_owner() -> int:
+    # the thread whose stages the current thread works under, itself unless it inherited another's
+    return getattr(_local, "owner", threading.get_ident())
+
+
+def stage_context() -> tuple[int, tuple[str, ...]]:
+    return stage_owner(), tuple(getattr(_local, "stack", ()))
+
+
+@contextmanager
+def inherited_stages(context: tuple[int, tuple[str, ...]]) -> Generator[None, None, None]:
+    # work handed to a pool thread is attributed to the stages of the thread that handed it over, listeners are not
+    # told about stages that are only inherited
+    _local.owner, stack = context
+    _local.stack = list(stack)
+    try:
+        yield
+    finally:
+        del _local.owner
+        _local.stack = []
+
+
+@contextmanager
+def stage(name: str) -> Generator[None, None, None]:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+
+    _local.stack.append(name)
+    for listener in _listeners:
+        listener.stage_started(name)
+    try:
+        yield
+    except BaseException:
+        _stage_finished(name, failed=True)
+        raise
+    _stage_finished(name)
+
+
+def _stage_finished(name: str, failed: bool = False) -> None:
+    try:
+        for listener in reversed(_listeners):
+            try:
+                listener.stage_finished(name)
+            except Exception:  # pylint: disable=broad-except
+                # the exception of a failed stage is the one propagated, never replaced by a listener's
+                if not failed:
+                    raise
+    finally:
+        _local.stack.pop()
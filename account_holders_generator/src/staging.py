@@ -0,0 +1,58 @@
+from typing import TYPE_CHECKING, Callable
+from uuid import uuid4
+
+from sqlalchemy import text
+
+from .pg_copy import column_list, copy_batch, create_staging_table
+
+if TYPE_CHECKING:
+    from sqlalchemy.orm import Session
+
+    from .columnar import ColumnarBatch
+
+
+class StagingLoader:
+    def __init__(self, db_session: "Session") -> None:
+        self.db_session = db_session
+        self.staging_prefix = f"bestla_staging_{uuid4().hex[:8]}_"
+        # insertion ordered, so account_holder is always swapped in before the tables referencing it
+        self.staged_columns: dict[str, list[str]] = {}
+
+    def stage(self, batch: "ColumnarBatch") -> None:
+        if not batch:
+            return
+
+        connection = self.db_session.connection()
+        staging_table_name = self.staging_prefix + batch.table_name
+        if batch.table_name not in self.staged_columns:
+            create_staging_table(connection, staging_table_name, batch.table_name, batch.column_names, temporary=False)
+            self.staged_columns[batch.table_name] = batch.column_names
+
+        copy_batch(connection, batch, table_name=staging_table_name)
+
+    def swap(self, clear_existing: Callable[["Session"], None] | None) -> None:
+        # one transaction, readers see either the previous account holders or the complete new set
+        if clear_existing:
+            clear_existing(self.db_session)
+        connection = self.db_session.connection()
+        for table_name, columns in self.staged_columns.items():
+            columns_sql = column_list(connection, columns)
+            connection.execute(
+                text(
+                    f"INSERT INTO {table_name} ({columns_sql}) "
+                    f"SELECT {columns_sql} FROM {self.staging_prefix + table_name}"
+                )
+            )
+        self._drop()
+        self.db_session.commit()
+
+    def discard(self) -> None:
+        if self.staged_columns:
+            self.db_session.rollback()
+            self._drop()
+            self.db_session.commit()
+
+    def _drop(self) -> None:
+        for table_name in self.staged_columns:
+            self.db_session.execute(text(f"DROP TABLE IF EXISTS {self.staging_prefix + table_name}"))
+        self.staged_columns = {}
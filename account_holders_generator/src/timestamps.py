@@ -0,0 +1,67 @@
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from functools import cache, partial
+from itertools import accumulate
+from random import Random
+from typing import Iterable, Sequence
+
+DAY_SECONDS = 86400
+HOUR_SECONDS = 3600
+# relative activity of every UTC hour of the day, quiet nights and lunchtime and early evening peaks
+HOURLY_WEIGHTS = (1, 0.5, 0.3, 0.2, 0.2, 0.3, 0.8, 1.5, 2.5, 3, 3.5, 4, 5, 4.5, 4, 4, 4.5, 5.5, 6, 5, 4, 3, 2, 1.5)
+
+epoch_to_datetime = partial(datetime.fromtimestamp, tz=timezone.utc)
+
+
+def to_datetimes(epochs: Iterable[int]) -> list[datetime]:
+    return list(map(epoch_to_datetime, epochs))
+
+
+@dataclass
+class TimestampProfile:
+    # generated history is spread uniformly over the days of this many months before today
+    history_months: int = 6
+    # expiries fall on every n-th day at midnight, the way scheduled expiry jobs bunch them up
+    expiry_cluster_days: int = 7
+    # longest time a still valid reward has left before it expires
+    validity_days: int = 365
+
+
+class TimestampGenerator:
+    # timestamps are sampled for a whole column at once as epoch seconds, only turned into datetimes to be written
+    def __init__(self) -> None:
+        self.random = Random()
+        self.profile = TimestampProfile()
+        self._hour_cum_weights = list(accumulate(HOURLY_WEIGHTS))
+
+    def seed(self, seed: int) -> None:
+        self.random.seed(seed)
+
+    def history(self, how_many: int, now: datetime) -> array:
+        # one of the days before today, then an hour of that day following the daily seasonality
+        today = int(now.timestamp()) // DAY_SECONDS * DAY_SECONDS
+        days = self.profile.history_months * 30
+        random = self.random.random
+        return array(
+            "q",
+            (
+                today - (1 + int(random() * days)) * DAY_SECONDS + hour * HOUR_SECONDS + int(random() * HOUR_SECONDS)
+                for hour in self.random.choices(range(24), cum_weights=self._hour_cum_weights, k=how_many)
+            ),
+        )
+
+    def between(self, starts: Sequence[int], ends: Sequence[int]) -> array:
+        random = self.random.random
+        return array("q", (start + int(random() * (end - start)) for start, end in zip(starts, ends)))
+
+    def clustered(self, epochs: Sequence[int], round_up: bool = True) -> array:
+        cluster = self.profile.expiry_cluster_days * DAY_SECONDS
+        if round_up:
+            return array("q", (-(-epoch // cluster) * cluster for epoch in epochs))
+        return array("q", (epoch // cluster * cluster for epoch in epochs))
+
+
+@cache
+def get_timestamp_generator() -> TimestampGenerator:
+    return TimestampGenerator()
@@ -0,0 +1,266 @@
+import sys
+
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from functools import partial
+from itertools import cycle
+from random import choices
+from time import monotonic, perf_counter, sleep
+from typing import TYPE_CHECKING, Callable
+
+import click
+
+from progressbar import NullBar
+
+from .carina.crud import get_reward_config_and_retailer, persist_allocated_rewards
+from .enums import AccountHolderTypes
+from .generator import BATCH_SIZE
+from .ids import random_salt, random_tokens
+from .instrumentation import LatencyHistogram
+from .planner import EXPECTED_TX_HISTORY_ROWS
+from .polaris.crud import (
+    append_transactions,
+    batch_create_account_holders_and_rewards,
+    get_generated_account_holder_ids,
+    get_max_generated_account_holder_n,
+    get_retailer_by_slug,
+    redeem_issued_rewards,
+)
+from .polaris.db import AccountHolder, AccountHolderReward, AccountHolderTransactionHistory
+from .registry import BatchContext, build_batch
+from .vela.crud import get_active_campaigns, get_reward_rule
+
+if TYPE_CHECKING:
+    from sqlalchemy.orm import Session
+
+    from .carina.db import Retailer, RewardConfig
+    from .polaris.db import RetailerConfig
+    from .pools import FakeDataPools
+
+# most recent generated account holders transactions are appended to, reloaded at every report
+KNOWN_ACCOUNT_HOLDERS = 100000
+
+
+@dataclass
+class TokenBucket:
+    rate: float
+    # a second's worth of rows at most, a stalled database is not followed by an unbounded burst
+    capacity: float = field(init=False)
+    tokens: float = 0.0
+    updated: float = field(default_factory=monotonic)
+
+    def __post_init__(self) -> None:
+        self.capacity = max(self.rate, 1.0)
+
+    def available(self, now: float) -> int:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return int(self.tokens)
+
+    def consume(self, rows: int) -> None:
+        # may go negative when a write produced more rows than asked for, the next writes wait for the debt
+        self.tokens -= rows
+
+    def seconds_until_available(self) -> float:
+        return max((1 - self.tokens) / self.rate, 0.0)
+
+
+@dataclass
+class TrickleStream:
+    table_name: str
+    bucket: TokenBucket
+    # writes up to the given number of rows and returns how many were written
+    write: Callable[[int], int]
+    histogram: LatencyHistogram = field(default_factory=LatencyHistogram)
+
+
+@dataclass
+class _TrickleLookups:
+    retailer_config: "RetailerConfig"
+    reward_config: "RewardConfig"
+    retailer: "Retailer"
+    active_campaigns: list[str]
+    reward_goal: int
+    loyalty_type: str
+
+
+class _TrickleWriter:
+    def __init__(
+        self,
+        carina_db_session: "Session",
+        polaris_db_session: "Session",
+        vela_db_session: "Session",
+        retailer_slug: str,
+        campaign_slug: str,
+        max_val: int,
+        refund_window: int | None,
+        loyalty_type: str,
+        fake_data_pools: "FakeDataPools | None",
+    ) -> None:
+        self.carina_db_session = carina_db_session
+        self.polaris_db_session = polaris_db_session
+
+        retailer_config = get_retailer_by_slug(polaris_db_session, retailer_slug)
+        reward_config, retailer = get_reward_config_and_retailer(carina_db_session, retailer_slug)
+        self.lookups = _TrickleLookups(
+            retailer_config,
+            reward_config,
+            retailer,
+            get_active_campaigns(vela_db_session, retailer_config, campaign_slug, loyalty_type),
+            get_reward_rule(vela_db_session, campaign_slug).reward_goal,
+            loyalty_type,
+        )
+        self.create_batch = partial(
+            batch_create_account_holders_and_rewards,
+            db_session=polaris_db_session,
+            retailer=self.lookups.retailer,
+            retailer_config=self.lookups.retailer_config,
+            active_campaigns=self.lookups.active_campaigns,
+            max_val=max_val,
+            bar=NullBar(),
+            progress_counter=0,
+            reward_config=self.lookups.reward_config,
+            refund_window=refund_window,
+            tx_history=False,
+            reward_goal=self.lookups.reward_goal,
+            loyalty_type=loyalty_type,
+            fake_data_pools=fake_data_pools,
+        )
+        self.account_holder_types = cycle(AccountHolderTypes)
+        self.next_account_holder_n = get_max_generated_account_holder_n(polaris_db_session, retailer_config.id) + 1
+        self.known_account_holder_ids: list[int] = []
+        self.refresh_known_account_holders()
+
+    def refresh_known_account_holders(self) -> None:
+        self.known_account_holder_ids = get_generated_account_holder_ids(
+            self.polaris_db_session, self.lookups.retailer_config.id, KNOWN_ACCOUNT_HOLDERS
+        )
+
+    def create_account_holders(self, how_many: int) -> int:
+        how_many = min(how_many, BATCH_SIZE)
+        batch_end = self.next_account_holder_n - 1
+        _, rewards_batch = self.create_batch(
+            batch_start=batch_end + how_many,
+            batch_end=batch_end,
+            account_holder_type=next(self.account_holder_types),
+            account_holder_type_reward_code_salt=random_salt(),
+        )
+        persist_allocated_rewards(self.carina_db_session, rewards_batch)
+        self.next_account_holder_n += how_many
+        return how_many
+
+    def append_transactions(self, how_many: int) -> int:
+        if not self.known_account_holder_ids:
+            self.refresh_known_account_holders()
+        if not self.known_account_holder_ids:
+            return 0
+
+        account_holder_ids = choices(
+            self.known_account_holder_ids, k=max(round(min(how_many, BATCH_SIZE) / EXPECTED_TX_HISTORY_ROWS), 1)
+        )
+        transactions_batch = build_batch(
+            AccountHolderTransactionHistory.__tablename__,
+            BatchContext(
+                account_holder_ids,
+                params={
+                    "reward_goal": self.lookups.reward_goal,
+                    "retailer_slug": self.lookups.retailer_config.slug,
+                    "loyalty_type": self.lookups.loyalty_type,
+                },
+            ),
+        )
+        # generated transaction ids are only unique within a single run, appended ones get a random suffix
+        transaction_account_holder_ids = transactions_batch.columns["account_holder_id"]
+        transactions_batch.columns["transaction_id"] = [
+            f"{account_holder_id}-{token}"
+            for account_holder_id, token in zip(
+                transaction_account_holder_ids, random_tokens(len(transaction_account_holder_ids), 8)
+            )
+        ]
+        # the registry spreads transactions over past months, soak traffic happens now
+        transactions_batch.columns["datetime"] = [datetime.now(tz=timezone.utc)] * len(transaction_account_holder_ids)
+        append_transactions(self.polaris_db_session, transactions_batch)
+        return len(transactions_batch)
+
+    def redeem_rewards(self, how_many: int) -> int:
+        return redeem_issued_rewards(
+            self.polaris_db_session, self.lookups.retailer_config.slug, min(how_many, BATCH_SIZE)
+        )
+
+
+def _echo_report(streams: list[TrickleStream], elapsed: float) -> None:
+    click.echo(f"\nafter {elapsed:.0f}s:")
+    for stream in streams:
+        click.echo(
+            f"  {stream.table_name:<40}{stream.histogram.rows / elapsed:>10.1f} rows/s  {stream.histogram.summary()}"
+        )
+
+
+def trickle(
+    carina_db_session: "Session",
+    polaris_db_session: "Session",
+    vela_db_session: "Session",
+    retailer_slug: str,
+    campaign_slug: str,
+    max_val: int,
+    refund_window: int,
+    loyalty_type: str,
+    account_holders_rate: float,
+    transactions_rate: float,
+    redemptions_rate: float,
+    duration: float | None,
+    report_every: float,
+    fake_data_pools: "FakeDataPools | None" = None,
+) -> list[TrickleStream]:
+    writer = _TrickleWriter(
+        carina_db_session,
+        polaris_db_session,
+        vela_db_session,
+        retailer_slug,
+        campaign_slug,
+        max_val,
+        None if loyalty_type == "STAMPS" else refund_window,
+        loyalty_type,
+        fake_data_pools,
+    )
+    if transactions_rate and not account_holders_rate and not writer.known_account_holder_ids:
+        click.echo(f"retailer '{retailer_slug}' has no generated account holders to append transactions to.")
+        sys.exit(-1)
+
+    streams = [
+        TrickleStream(table_name, TokenBucket(rate), write)
+        for table_name, rate, write in [
+            (AccountHolder.__tablename__, account_holders_rate, writer.create_account_holders),
+            (AccountHolderTransactionHistory.__tablename__, transactions_rate, writer.append_transactions),
+            (AccountHolderReward.__tablename__, redemptions_rate, writer.redeem_rewards),
+        ]
+        if rate > 0
+    ]
+
+    started = monotonic()
+    next_report = started + report_every
+    try:
+        while duration is None or monotonic() - started < duration:
+            for stream in streams:
+                wanted = stream.bucket.available(monotonic())
+                if wanted < 1:
+                    continue
+
+                write_started = perf_counter()
+                written = stream.write(wanted)
+                stream.histogram.record((perf_counter() - write_started) * 1000, written)
+                # a write that found nothing to do still uses its tokens, it is not retried in a busy loop
+                stream.bucket.consume(max(wanted, written))
+
+            now = monotonic()
+            if now >= next_report:
+                _echo_report(streams, now - started)
+                next_report += report_every
+                # picks up the account holders created since the last report
+                writer.refresh_known_account_holders()
+            sleep(min(min(stream.bucket.seconds_until_available() for stream in streams), max(next_report - now, 0)))
+    except KeyboardInterrupt:
+        click.echo("\nStopping.")
+
+    _echo_report(streams, monotonic() - started)
+    return streams
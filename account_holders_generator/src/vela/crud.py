@@ -1,6 +1,6 @@
 from typing import TYPE_CHECKING
 
-from sqlalchemy import delete
+from sqlalchemy import delete, exists, insert
 from sqlalchemy.future import select
 
 from ..fixtures import campaign_payload, earn_rule_payload, reward_rule_payload
@@ -11,6 +11,8 @@ if TYPE_CHECKING:
 
     from account_holders_generator.src.polaris.db import RetailerConfig
 
+    from ..fixtures import RetailerSpec
+
 
 def get_active_campaigns(
     db_session: "Session", retailer: "RetailerConfig", campaign_default: str, loyalty_type: str
@@ -33,6 +35,20 @@ def get_active_campaigns(
     return campaigns
 
 
+def get_retailer_campaign_slugs(db_session: "Session", retailer_slug: str) -> list[str]:
+    return (
+        db_session.execute(
+            select(Campaign.slug).where(
+                Campaign.status == "ACTIVE",
+                Campaign.retailer_id == RetailerRewards.id,
+                RetailerRewards.slug == retailer_slug,
+            )
+        )
+        .scalars()
+        .all()
+    )
+
+
 def get_campaign(db_session: "Session", campaign_slug: str) -> Campaign:
     return db_session.execute(
         select(Campaign).where(
@@ -41,6 +57,18 @@ def get_campaign(db_session: "Session", campaign_slug: str) -> Campaign:
     ).scalar_one()
 
 
+def campaign_exists(db_session: "Session", retailer_slug: str, campaign_slug: str) -> bool:
+    return db_session.scalar(
+        select(
+            exists().where(
+                Campaign.slug == campaign_slug,
+                Campaign.retailer_id == RetailerRewards.id,
+                RetailerRewards.slug == retailer_slug,
+            )
+        )
+    )
+
+
 def get_reward_rule(db_session: "Session", campaign_slug: str) -> RewardRule:
     campaign = get_campaign(db_session, campaign_slug)
     return db_session.execute(
@@ -74,3 +102,57 @@ def setup_retailer_reward_and_campaign(
     db_session.add(RewardRule(**reward_rule_payload(campaign.id, reward_slug, refund_window)))
     db_session.add(EarnRule(**earn_rule_payload(campaign.id, loyalty_type)))
     db_session.commit()
+
+
+def _insert_payloads(db_session: "Session", model: type, payloads: list[dict]) -> None:
+    # payloads leaving out optional columns are inserted separately, an executemany needs the same keys in every row
+    by_keys: dict[tuple[str, ...], list[dict]] = {}
+    for payload in payloads:
+        by_keys.setdefault(tuple(payload), []).append(payload)
+    for same_keys_payloads in by_keys.values():
+        db_session.execute(insert(model), same_keys_payloads)
+
+
+def bulk_setup_retailer_rewards_and_campaigns(db_session: "Session", retailer_specs: list["RetailerSpec"]) -> None:
+    db_session.execute(
+        delete(RetailerRewards)
+        .where(RetailerRewards.slug.in_([spec.retailer_slug for spec in retailer_specs]))
+        .execution_options(synchronize_session=False)
+    )
+    retailer_ids = dict(
+        db_session.execute(
+            insert(RetailerRewards)
+            .values([{"slug": spec.retailer_slug} for spec in retailer_specs])
+            .returning(RetailerRewards.slug, RetailerRewards.id)
+        ).all()
+    )
+    campaign_ids = dict(
+        db_session.execute(
+            insert(Campaign)
+            .values(
+                [
+                    campaign_payload(retailer_ids[spec.retailer_slug], spec.campaign_slug, spec.loyalty_type)
+                    for spec in retailer_specs
+                ]
+            )
+            .returning(Campaign.slug, Campaign.id)
+        ).all()
+    )
+    _insert_payloads(
+        db_session,
+        RewardRule,
+        [
+            reward_rule_payload(
+                campaign_ids[spec.campaign_slug],
+                spec.reward_slug,
+                None if spec.loyalty_type == "STAMPS" else spec.refund_window,
+            )
+            for spec in retailer_specs
+        ],
+    )
+    _insert_payloads(
+        db_session,
+        EarnRule,
+        [earn_rule_payload(campaign_ids[spec.campaign_slug], spec.loyalty_type) for spec in retailer_specs],
+    )
+    db_session.commit()
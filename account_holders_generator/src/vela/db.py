@@ -3,7 +3,7 @@ from typing import TYPE_CHECKING
 from sqlalchemy import create_engine
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import NullPool, QueuePool
 from sqlalchemy.sql.schema import MetaData
 
 if TYPE_CHECKING:
@@ -31,7 +31,7 @@ class EarnRule(Base):
     __tablename__ = "earn_rule"
 
 
-def load_models(db_uri: str) -> "Session":
-    engine = create_engine(db_uri, poolclass=NullPool)
+def load_models(db_uri: str, pooled: bool = False) -> "Session":
+    engine = create_engine(db_uri, poolclass=QueuePool if pooled else NullPool, pool_pre_ping=pooled)
     Base.prepare(engine, reflect=True)
     return scoped_session(sessionmaker(bind=engine))